@@ -3,11 +3,35 @@
 # AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
 # License: Apache 2.0 License
 # =============================================================================
+import asyncio
 import neovim
+import os
+from .cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, FileCache
 from .client import RemoteClient
+from .constants import COMMAND_STREAM_STDERR
+from .debounce import CoalescingQueue
+from .index import DEFAULT_INDEX_PATH, DEFAULT_SERVER_INDEX_PATH, FileIndex
+from .prefetch import DEFAULT_PREFETCH_BUDGET
+from .reassembly import DEFAULT_TRANSFER_STATE_DIR
+from .scheduler import (
+    DEFAULT_MAX_CONCURRENT,
+    PRIORITY_BACKGROUND,
+    PRIORITY_CURRENT,
+    PRIORITY_VISIBLE,
+)
 from .server import RemoteServer
+from .timer import TimingWheel
 from .utils import is_int, to_int
-from . import logger
+from . import logger, metrics
+
+
+# Evaluated on writes: the file, whether its buffer is the current buffer,
+# and whether its buffer is visible in a window
+_WRITE_EVAL = ('[expand("<afile>"), '
+               'str2nr(expand("<abuf>")) == bufnr("%"), '
+               'bufwinnr(str2nr(expand("<abuf>"))) != -1]')
+
+metrics.gauge('log.dropped', logger.dropped)
 
 
 @neovim.plugin
@@ -16,13 +40,25 @@ class RemoteHandlers(logger.LoggingMixin):
         self.nvim = nvim
         self.client = None
         self.server = None
+        self.update_queue = None
+
+        # Commands running on the server with their output streamed back
+        self.commands = set()
+
+        # Map of path -> priority of its latest queued update
+        self.update_priorities = {}
 
         # TODO: Add logging variables to enable globally
         self.is_debug_enabled = True
         logger.setup(
             nvim,
-            level='DEBUG',
-            output_file='remote.log'
+            level=nvim.vars.get('remote_log_level', 'DEBUG'),
+            output_file=os.path.expanduser(
+                nvim.vars.get('remote_log_file', 'remote.log')),
+            max_bytes=nvim.vars.get('remote_log_max_bytes',
+                                    logger.DEFAULT_LOG_MAX_BYTES),
+            backup_count=nvim.vars.get('remote_log_backup_count',
+                                       logger.DEFAULT_LOG_BACKUP_COUNT),
         )
 
     @neovim.command('RemoteSend', nargs='*', range='')
@@ -34,6 +70,9 @@ class RemoteHandlers(logger.LoggingMixin):
 
     @neovim.command('RemoteStop', nargs='*', range='')
     def cmd_remote_stop(self, args, range):
+        if (self.update_queue is not None):
+            self.update_queue.clear()
+        self.update_priorities.clear()
         if (self.client is not None):
             self.client.stop()
             self.client = None
@@ -67,10 +106,185 @@ class RemoteHandlers(logger.LoggingMixin):
 
         self.nvim.out_write('Attempting to connect to {}:{}...\n'
                             .format(addr, port))
-        self.client = RemoteClient(self.nvim, self.nvim.loop, addr, port, key)
+        index = FileIndex(os.path.expanduser(
+            self.nvim.vars.get('remote_index_file', DEFAULT_INDEX_PATH)))
+        max_rate = self.nvim.vars.get('remote_max_transfer_rate', 0)
+        cache = FileCache(
+            os.path.expanduser(self.nvim.vars.get(
+                'remote_cache_dir', DEFAULT_CACHE_DIR)),
+            self.nvim.vars.get('remote_cache_size', DEFAULT_CACHE_SIZE),
+        )
+        self.client = RemoteClient(
+            self.nvim, self.nvim.loop, addr, port, key,
+            index=index,
+            max_concurrent=self.nvim.vars.get(
+                'remote_max_concurrent_transfers', DEFAULT_MAX_CONCURRENT),
+            max_rate=max_rate if (max_rate > 0) else None,
+            cache=cache,
+            capture=self._capture_path('remote_client_capture_file'),
+            root=self.nvim.call('getcwd'),
+        )
         self.client.run(lambda err: self.nvim.out_write(
             'Connected to {}:{}!\n'.format(addr, port)))
 
+        if (self.nvim.vars.get('remote_prefetch', 1)):
+            self.client.enable_prefetch(self.nvim.vars.get(
+                'remote_prefetch_budget', DEFAULT_PREFETCH_BUDGET))
+
+        # Opt into streaming line edits of buffers instead of whole files
+        if (self.nvim.vars.get('remote_buffer_sync', 0)):
+            self.client.enable_buffer_sync(
+                window=self.nvim.vars.get('remote_buffer_sync_window', 50)
+                / 1000.0,
+                checksum_interval=self.nvim.vars.get(
+                    'remote_buffer_sync_checksum_interval', 5000) / 1000.0,
+            )
+
+    @neovim.command('RemoteOpen', nargs='1', range='')
+    def cmd_remote_open(self, args, range):
+        if (self.client is None):
+            self.nvim.out_write('Not connected to a server\n')
+            return
+        self.nvim.loop.create_task(self._open(args[0]))
+
+    async def _open(self, path):
+        """Opens a read-only copy of a file retrieved from the server.
+
+        :param path: The path of the file relative to the root of the server
+        """
+        local_path = await self.client.retrieve_file(path)
+        if (local_path is None):
+            self.nvim.async_call(lambda nvim, path: nvim.err_write(
+                'Unable to retrieve {}\n'.format(path)), self.nvim, path)
+            return
+        if (self.client.prefetcher is not None):
+            self.client.prefetcher.opened(path, local_path)
+        self.nvim.async_call(lambda nvim, path: nvim.command(
+            'view {}'.format(nvim.funcs.fnameescape(path))),
+            self.nvim, local_path)
+
+    @neovim.command('RemoteRun', nargs='+', range='')
+    def cmd_remote_run(self, args, range):
+        if (self.client is None):
+            self.nvim.out_write('Not connected to a server\n')
+            return
+        self.nvim.loop.create_task(self._run_command(args[0], args[1:]))
+
+    @neovim.command('RemoteCancel', nargs='*', range='')
+    def cmd_remote_cancel(self, args, range):
+        for command in list(self.commands):
+            command.cancel()
+
+    async def _run_command(self, name, args):
+        """Runs a command on the server, showing its output as it arrives.
+
+        :param name: The name of the program to run
+        :param args: The list of arguments to the program
+        """
+        command = self.client.run_command(name, args)
+        self.commands.add(command)
+        try:
+            async for stream, data in command:
+                text = data.decode('utf-8', errors='replace')
+                if (stream == COMMAND_STREAM_STDERR):
+                    self.nvim.async_call(lambda nvim, text: nvim.err_write(
+                        text), self.nvim, text)
+                else:
+                    self.nvim.async_call(lambda nvim, text: nvim.out_write(
+                        text), self.nvim, text)
+        except asyncio.TimeoutError:
+            # The server went quiet, so stop it rather than wait forever
+            command.cancel()
+            self.nvim.async_call(lambda nvim, text: nvim.err_write(text),
+                                 self.nvim, 'Gave up waiting on {}\n'.format(
+                                     name))
+            return
+        finally:
+            self.commands.discard(command)
+        self.nvim.async_call(lambda nvim, text: nvim.out_write(text),
+                             self.nvim, '{} exited with {}\n'.format(
+                                 name, command.exit_code))
+
+    @neovim.command('RemoteReconcile', nargs='*', range='')
+    def cmd_remote_reconcile(self, args, range):
+        if (self.client is None):
+            self.nvim.out_write('Not connected to a server\n')
+            return
+        self.nvim.loop.create_task(self._reconcile(self.nvim.call('getcwd')))
+
+    async def _reconcile(self, root):
+        """Reports the files that differ between the current directory and
+        the root of the server.
+
+        :param root: The local directory matching the root of the server
+        """
+        tree = await self.client.build_tree(root, self._index_progress)
+        changed = await self.client.reconcile(tree)
+
+        lines = ['{} files differ from the server\n'.format(len(changed))]
+        for path, local, remote in changed:
+            state = 'modified'
+            if (local is None):
+                state = 'remote only'
+            elif (remote is None):
+                state = 'local only'
+            lines.append('  {} ({})\n'.format(path, state))
+        self.nvim.async_call(lambda nvim, text: nvim.out_write(text),
+                             self.nvim, ''.join(lines))
+
+    @neovim.command('RemoteSync', nargs='?', range='')
+    def cmd_remote_sync(self, args, range):
+        if (self.client is None):
+            self.nvim.out_write('Not connected to a server\n')
+            return
+        root = args[0] if (args) else self.nvim.call('getcwd')
+        self.nvim.loop.create_task(self._sync(os.path.expanduser(root)))
+
+    async def _sync(self, root):
+        """Sends a whole directory to the server as a single archive.
+
+        :param root: The local directory to send
+        """
+        count = await self.client.sync_tree(root)
+        if (count is None):
+            text = 'Failed to send {}\n'.format(root)
+        else:
+            text = 'Sent {} files from {}\n'.format(count, root)
+        self.nvim.async_call(lambda nvim, text: nvim.out_write(text),
+                             self.nvim, text)
+
+    @neovim.command('RemoteStats', nargs='?', range='')
+    def cmd_remote_stats(self, args, range):
+        handlers = {}
+        for name, remote in [('client', self.client), ('server', self.server)]:
+            protocol = remote.protocol if (remote is not None) else None
+            if (protocol is not None):
+                handlers[name] = protocol.handler
+
+        # With a file, the metrics are dumped there as JSON instead
+        if (len(args) > 0):
+            path = os.path.expanduser(args[0])
+            try:
+                metrics.write_json(path, {
+                    'metrics': metrics.default_registry.snapshot(),
+                    'packets': {name: handler.stats.snapshot()
+                                for name, handler in handlers.items()},
+                })
+            except OSError as ex:
+                self.nvim.err_write('Failed to write {}: {}\n'
+                                    .format(path, ex))
+                return
+            self.nvim.out_write('Wrote metrics to {}\n'.format(path))
+            return
+
+        lines = metrics.default_registry.format()
+        for name, handler in sorted(handlers.items()):
+            lines.append('Packets handled by the {}:'.format(name))
+            lines.extend(handler.stats.format())
+        if (not handlers):
+            lines.append('Not connected to a server or listening')
+        self.nvim.out_write('\n'.join(lines) + '\n')
+
     @neovim.command('RemoteListen', nargs='*', range='')
     def cmd_remote_listen(self, args, range):
         addr = '127.0.0.1'
@@ -97,44 +311,146 @@ class RemoteHandlers(logger.LoggingMixin):
 
         self.nvim.out_write('Attempting to listen on {}:{}...\n'
                             .format(addr, port))
-        self.server = RemoteServer(self.nvim, self.nvim.loop, addr, port, key)
+        state_dir = os.path.expanduser(self.nvim.vars.get(
+            'remote_transfer_state_dir', DEFAULT_TRANSFER_STATE_DIR))
+        index = FileIndex(os.path.expanduser(self.nvim.vars.get(
+            'remote_server_index_file', DEFAULT_SERVER_INDEX_PATH)))
+        self.server = RemoteServer(self.nvim, self.nvim.loop, addr, port, key,
+                                   root=self.nvim.call('getcwd'),
+                                   state_dir=state_dir,
+                                   index=index,
+                                   watch=bool(self.nvim.vars.get(
+                                       'remote_watch_files', 1)),
+                                   prepare=bool(self.nvim.vars.get(
+                                       'remote_index_on_listen', 1)),
+                                   progress=self._index_progress,
+                                   capture=self._capture_path(
+                                       'remote_server_capture_file'))
         self.server.run(lambda err: self.nvim.out_write(
             'Listening on {}:{}!\n'.format(addr, port)))
 
+    @neovim.autocmd('BufEnter',
+                    pattern='*',
+                    eval='[expand("<abuf>"), expand("<afile>"), &buftype]',
+                    sync=False)
+    def on_bufenter(self, info):
+        bufnr, filename, buftype = info
+        bufnr = to_int(bufnr)
+        if (bufnr is None or buftype != '' or filename == ''):
+            return
+
+        buffer_sync = self._buffer_sync()
+        if (buffer_sync is not None):
+            buffer_sync.attach(bufnr, filename)
+
+    @neovim.rpc_export('nvim_buf_lines_event', sync=False)
+    def on_buf_lines_event(self, buffer, changedtick, firstline, lastline,
+                           linedata, more):
+        buffer_sync = self._buffer_sync()
+        if (buffer_sync is not None):
+            buffer_sync.on_lines(buffer.number, changedtick,
+                                 firstline, lastline, linedata)
+
+    @neovim.rpc_export('nvim_buf_detach_event', sync=False)
+    def on_buf_detach_event(self, buffer):
+        buffer_sync = self._buffer_sync()
+        if (buffer_sync is not None):
+            buffer_sync.detach(buffer.number)
+
     @neovim.autocmd('BufWritePost',
                     pattern='*',
-                    eval='expand("<afile>")',
+                    eval=_WRITE_EVAL,
                     sync=False)
-    def on_bufwritepost(self, filename):
-        self._on_fileupdate(filename)
+    def on_bufwritepost(self, info):
+        self._queue_fileupdate(*info)
 
     @neovim.autocmd('FilterWritePost',
                     pattern='*',
-                    eval='expand("<afile>")',
+                    eval=_WRITE_EVAL,
                     sync=False)
-    def on_filterwritepost(self, filename):
-        self._on_fileupdate(filename)
+    def on_filterwritepost(self, info):
+        self._queue_fileupdate(*info)
 
     @neovim.autocmd('FileAppendPost',
                     pattern='*',
-                    eval='expand("<afile>")',
+                    eval=_WRITE_EVAL,
                     sync=False)
-    def on_fileappendpost(self, filename):
-        self._on_fileupdate(filename)
+    def on_fileappendpost(self, info):
+        self._queue_fileupdate(*info)
 
     @neovim.autocmd('FileWritePost',
                     pattern='*',
-                    eval='expand("<afile>")',
+                    eval=_WRITE_EVAL,
                     sync=False)
-    def on_filewritepost(self, filename):
-        self._on_fileupdate(filename)
+    def on_filewritepost(self, info):
+        self._queue_fileupdate(*info)
+
+    def _queue_fileupdate(self, filename, is_current=False, is_visible=False):
+        """Queues a sync of the file, collapsing the write events fired
+        for it within the debounce window (g:remote_write_debounce, in
+        milliseconds) into a single sync.
+
+        :param filename: The full path to the file relative to neovim
+        :param is_current: Whether the file is in the current buffer
+        :param is_visible: Whether the file is visible in a window
+        """
+        if (self.client is None and self.server is None):
+            return
+
+        if (self.update_queue is None):
+            window = self.nvim.vars.get('remote_write_debounce', 100)
+            self.update_queue = CoalescingQueue(
+                self.nvim.loop, self._on_fileupdate, window / 1000.0,
+                wheel=TimingWheel(self.nvim.loop))
+        self.update_queue.push(filename)
+
+        # Only uploads by the client are prioritized
+        if (self.client is None):
+            return
+        if (is_current):
+            self.update_priorities[filename] = PRIORITY_CURRENT
+        elif (is_visible):
+            self.update_priorities[filename] = PRIORITY_VISIBLE
+        else:
+            self.update_priorities[filename] = PRIORITY_BACKGROUND
 
     def _on_fileupdate(self, filename):
         """Kicks off a sync with the remote server to update the file.
 
         :param filename: The full path to the file relative to neovim
+        :returns: The in-flight transfer if one was started, otherwise None
         """
-        if (self.client is not None):
-            self.client.send_start_file_update(filename)
+        transfer = None
+        priority = self.update_priorities.pop(filename, PRIORITY_BACKGROUND)
+        buffer_sync = self._buffer_sync()
+        if (buffer_sync is not None and buffer_sync.is_attached(filename)):
+            # Remote copy is already current, so only verify it
+            buffer_sync.send_path_checksum(filename)
+        elif (self.client is not None):
+            transfer = self.client.send_start_file_update(filename, priority)
         if (self.server is not None):
             self.server.broadcast_file_change(filename)
+        return transfer
+
+    def _capture_path(self, name):
+        """Returns the path of the capture file named by a variable, or None
+        if traffic is not captured."""
+        path = self.nvim.vars.get(name, '')
+        return os.path.expanduser(path) if (path) else None
+
+    def _index_progress(self, done, total):
+        """Reports the progress of indexing files, which may take a while
+        the first time a large directory is indexed.
+
+        :param done: The number of files hashed so far
+        :param total: The number of files to hash
+        """
+        self.nvim.async_call(lambda nvim, text: nvim.out_write(text),
+                             self.nvim, 'Indexed {}/{} files\n'.format(
+                                 done, total))
+
+    def _buffer_sync(self):
+        """Returns the buffer synchronizer of the client, if enabled."""
+        if (self.client is not None):
+            return self.client.buffer_sync
+        return None
@@ -0,0 +1,356 @@
+# =============================================================================
+# FILE: archive.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import os
+import tarfile
+import tempfile
+import threading
+import zlib
+from hashlib import sha256
+from . import logger
+from .reassembly import ChunkBitmap, ChunkReassembler
+
+# Compression level of archives, trading time spent compressing for bytes
+# sent over the link
+DEFAULT_COMPRESS_LEVEL = 6
+
+# Number of times chunks the receiver is missing are resent before giving up
+DEFAULT_MAX_ROUNDS = 5
+
+# Default directory of archives being received
+DEFAULT_ARCHIVE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'remote', 'archives')
+
+# Size of blocks copied when extracting a file
+_COPY_BLOCK_SIZE = 64 * 1024
+
+# Failures of an archive that cannot be extracted any further
+_EXTRACT_ERRORS = (tarfile.TarError, zlib.error, EOFError, OSError)
+
+
+class _HashingReader(object):
+    def __init__(self, f):
+        self._f = f
+        self.hash = sha256()
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.hash.update(data)
+        return data
+
+
+def write_archive(root, paths, fileobj, level=DEFAULT_COMPRESS_LEVEL):
+    """Writes files as a compressed tar stream, hashing each file as it is
+    archived so the archive and the index entries take a single read.
+
+    :param root: The directory the paths are relative to
+    :param paths: The relative paths of the files to archive
+    :param fileobj: The file object to write the archive to
+    :param level: The compression level from 0 to 9
+    :returns: A list of (path, size, mtime_ns, digest) tuples for the files
+              archived, skipping those that could not be read
+    """
+    results = []
+    with tarfile.open(fileobj=fileobj, mode='w:gz',
+                      compresslevel=level) as tar:
+        for rel in paths:
+            try:
+                f = open(os.path.join(root, rel), 'rb')
+            except OSError:
+                continue
+            with f:
+                st = os.fstat(f.fileno())
+                info = tar.gettarinfo(arcname=rel.replace(os.sep, '/'),
+                                      fileobj=f)
+                reader = _HashingReader(f)
+                tar.addfile(info, reader)
+            results.append((rel, st.st_size, st.st_mtime_ns,
+                            reader.hash.digest()))
+    return results
+
+
+class ArchiveAborted(Exception):
+    """Raised when reading an archive whose transfer was abandoned."""
+
+
+class _PrefixReader(object):
+    def __init__(self, path, length):
+        """Creates a reader of an archive still being received, where a read
+        blocks until every chunk before its end has arrived.
+
+        :param path: The path of the file chunks are written to
+        :param length: The length of the archive in bytes
+        """
+        self._f = open(path, 'rb')
+        self._length = length
+        self._available = 0
+        self._aborted = False
+        self._cond = threading.Condition()
+
+    def advance(self, available):
+        with self._cond:
+            self._available = max(self._available,
+                                  min(available, self._length))
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+
+    def read(self, size=-1):
+        pos = self._f.tell()
+        end = self._length if (size < 0) else min(pos + size, self._length)
+        with self._cond:
+            while self._available < end and not self._aborted:
+                self._cond.wait()
+            if (self._aborted):
+                raise ArchiveAborted()
+        return self._f.read(end - pos)
+
+    def close(self):
+        self._f.close()
+
+
+class ArchiveReceiver(logger.LoggingMixin):
+    def __init__(self, loop, root, archive_path, file_length, total_chunks,
+                 chunk_size, index=None, extracted=None, done=None):
+        """Creates a new receiver of a compressed tar stream, whose chunks
+        are written to disk in any order while a worker thread unpacks the
+        files beneath the root as soon as the chunks before them arrive.
+
+        :param loop: The event loop chunks are received on
+        :param root: The directory files are extracted beneath
+        :param archive_path: The path the archive is received at
+        :param file_length: The length of the archive in bytes
+        :param total_chunks: The total number of chunks of the archive
+        :param chunk_size: The number of bytes within each chunk but the last
+        :param index: If provided, the file index to record each extracted
+                      file within
+        :param extracted: If provided, the function taking the path of each
+                          extracted file, called on the loop
+        :param done: If provided, the function taking the receiver once
+                     extraction has finished, called on the loop
+        """
+        self._loop = loop
+        self.root = os.path.abspath(root)
+        self._index = index
+        self._extracted = extracted
+        self._done = done
+        self._chunk_size = chunk_size
+        self._next = 0
+        self.count = 0
+        self.failed = False
+        self.is_debug_enabled = True
+
+        self.reassembler = ChunkReassembler(
+            archive_path, file_length, total_chunks, chunk_size)
+        self._reader = _PrefixReader(self.reassembler.temp_path, file_length)
+        self._thread = threading.Thread(target=self._extract, daemon=True)
+        self._thread.start()
+
+    def write(self, index, data):
+        """Writes a chunk of the archive, letting the worker unpack further
+        if it completes the run of chunks from the start.
+
+        :param index: The index of the chunk
+        :param data: The bytes of the chunk
+        :returns: True if written, False if out of range, already received
+                  or not the length of the chunk at the index
+        """
+        if (not self.reassembler.write(index, data)):
+            return False
+
+        bitmap = self.reassembler.bitmap
+        if (index == self._next):
+            while self._next < bitmap.total() and bitmap.has(self._next):
+                self._next += 1
+            self._reader.advance(self._next * self._chunk_size)
+        return True
+
+    def abort(self):
+        """Stops extracting and discards the partially-received archive."""
+        self._reader.abort()
+
+    def _extract(self):
+        try:
+            with tarfile.open(fileobj=self._reader, mode='r|gz') as tar:
+                for member in tar:
+                    self._extract_member(tar, member)
+        except ArchiveAborted:
+            self.debug('Abandoned archive extracted to %s', self.root)
+            self.failed = True
+        except _EXTRACT_ERRORS as ex:
+            self.error('Failed to extract archive to %s: %s', self.root, ex)
+            self.failed = True
+        finally:
+            self._reader.close()
+            self._loop.call_soon_threadsafe(self._finish)
+
+    def _extract_member(self, tar, member):
+        path = self._member_path(member.name)
+        if (path is None):
+            self.warning('Skipping %s outside of %s', member.name, self.root)
+            return
+        if (member.isdir()):
+            os.makedirs(path, exist_ok=True)
+            return
+        if (not member.isfile()):
+            return
+
+        # Files are written aside and moved into place like single updates
+        directory, name = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(
+            prefix='.{}.'.format(name), suffix='.part', dir=directory)
+        h = sha256()
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                src = tar.extractfile(member)
+                for block in iter(lambda: src.read(_COPY_BLOCK_SIZE), b''):
+                    h.update(block)
+                    out.write(block)
+                os.fchmod(out.fileno(), member.mode & 0o777)
+            os.utime(temp_path, (member.mtime, member.mtime))
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        if (self._index is not None):
+            st = os.stat(path)
+            self._index.update(path, st.st_size, st.st_mtime_ns, h.digest())
+        self.count += 1
+        if (self._extracted is not None):
+            self._loop.call_soon_threadsafe(self._extracted, path)
+
+    def _member_path(self, name):
+        rel = os.path.normpath(name)
+        if (os.path.isabs(rel) or rel == os.curdir or rel == os.pardir or
+                rel.startswith(os.pardir + os.sep)):
+            return None
+        return os.path.join(self.root, rel)
+
+    def _finish(self):
+        self.reassembler.abort()
+        if (self._index is not None):
+            self._index.flush()
+        if (self._done is not None):
+            self._done(self)
+
+
+class ArchiveManager(logger.LoggingMixin):
+    def __init__(self, loop, index=None, archive_dir=DEFAULT_ARCHIVE_DIR,
+                 extracted=None):
+        """Creates a new manager of incoming archives of whole trees.
+
+        :param loop: The event loop archives are received on
+        :param index: If provided, the file index to record extracted files
+        :param archive_dir: The directory archives are received within
+        :param extracted: If provided, the function taking the path of each
+                          extracted file
+        """
+        self._loop = loop
+        self._index = index
+        self._archive_dir = archive_dir
+        self._extracted = extracted
+        self.is_debug_enabled = True
+
+        # Map of (session, root) -> (version, receiver)
+        self._archives = {}
+
+        # Map of (session, root) -> last version fully received
+        self._completed = {}
+
+    def start(self, session, root, version, file_length, total_chunks,
+              chunk_size):
+        """Starts receiving a version of an archive of a tree, superseding
+        any archive of an older version of the same tree.
+
+        :param session: The session sending the archive
+        :param root: The directory the archive is extracted beneath
+        :param version: The version of the archive
+        :param file_length: The length of the archive in bytes
+        :param total_chunks: The total number of chunks of the archive
+        :param chunk_size: The number of bytes within each chunk but the last
+        :returns: The receiver of the archive, or None if already received
+        """
+        key = (session, root)
+        if (self._completed.get(key, -1) >= version):
+            return None
+
+        current = self._archives.get(key)
+        if (current is not None):
+            if (current[0] == version):
+                return current[1]
+            current[1].abort()
+
+        self.info('Receiving archive of %s', root)
+        r = ArchiveReceiver(
+            loop=self._loop,
+            root=root,
+            archive_path=os.path.join(self._archive_dir, 'archive'),
+            file_length=file_length,
+            total_chunks=total_chunks,
+            chunk_size=chunk_size,
+            index=self._index,
+            extracted=self._extracted,
+            done=lambda r: self._finish(key, version, r),
+        )
+        self._archives[key] = (version, r)
+        return r
+
+    def receive(self, session, root, version, index, data):
+        """Receives a chunk of an archive, dropping it if the archive has not
+        started since it will be resent when found missing.
+
+        :param session: The session sending the archive
+        :param root: The directory the archive is extracted beneath
+        :param version: The version of the archive the chunk belongs to
+        :param index: The index of the chunk
+        :param data: The bytes of the chunk
+        :returns: True if written, otherwise False
+        """
+        current = self._archives.get((session, root))
+        if (current is None or current[0] != version):
+            return False
+        return current[1].write(index, data)
+
+    def received(self, session, root, version, total_chunks):
+        """Returns the chunks of a version of an archive already received.
+
+        :param session: The session sending the archive
+        :param root: The directory the archive is extracted beneath
+        :param version: The version of the archive
+        :param total_chunks: The total number of chunks of the archive
+        :returns: The bitmap of received chunks, or None if the archive is
+                  not known
+        """
+        key = (session, root)
+        current = self._archives.get(key)
+        if (current is not None and current[0] == version):
+            return current[1].reassembler.bitmap
+        if (self._completed.get(key, -1) >= version):
+            bitmap = ChunkBitmap(total_chunks)
+            for index in range(total_chunks):
+                bitmap.set(index)
+            return bitmap
+        return None
+
+    def abort_all(self):
+        """Stops extracting every archive being received."""
+        for _, r in list(self._archives.values()):
+            r.abort()
+
+    def _finish(self, key, version, r):
+        current = self._archives.get(key)
+        if (current is not None and current[1] is r):
+            del self._archives[key]
+            if (not r.failed):
+                self._completed[key] = version
+                self.info('Extracted %s files to %s', r.count, r.root)
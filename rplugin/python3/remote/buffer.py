@@ -0,0 +1,344 @@
+# =============================================================================
+# FILE: buffer.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import zlib
+from . import builders
+from . import logger
+from .packet import MAX_CONTENT_SIZE
+from .timer import Timer
+
+# Estimated msgpack overhead of a single edit and of a single line within it
+_EDIT_OVERHEAD = 16
+_LINE_OVERHEAD = 5
+
+
+def coalesce_edits(edits):
+    """Collapses a series of line edits into the fewest equivalent edits.
+
+    Each edit is a list of [first, last, lines] where lines replace the
+    range [first, last) of the buffer; a last of -1 represents the end of the
+    buffer. Edits are merged when the later edit falls within or completely
+    covers the region produced by the edit before it, which is the case for
+    repeated typing on the same line(s).
+
+    :param edits: The edits to coalesce, in the order they were applied
+    :returns: A new list of edits that produces the same buffer
+    """
+    result = []
+    for edit in edits:
+        f2, l2, lines2 = edit
+        if (result):
+            f1, l1, lines1 = result[-1]
+            end1 = f1 + len(lines1)
+
+            # Later edit is within the region produced by the earlier edit
+            if (f1 <= f2 and 0 <= l2 <= end1):
+                result[-1] = [
+                    f1, l1, lines1[:f2 - f1] + list(lines2) + lines1[l2 - f1:]
+                ]
+                continue
+
+            # Later edit replaces the entire region of the earlier edit
+            if (f2 <= f1 and l2 >= end1 and l1 >= 0):
+                result[-1] = [f2, l2 - end1 + l1, list(lines2)]
+                continue
+
+        result.append([f2, l2, list(lines2)])
+    return result
+
+
+def split_edits(edits, limit=MAX_CONTENT_SIZE):
+    """Splits edits into groups whose estimated encoded size fits the limit.
+
+    An edit too large for a single group is broken into an initial
+    replacement followed by insertions, which applied in order produce the
+    same buffer.
+
+    :param edits: The edits to split, in the order they should be applied
+    :param limit: The maximum estimated size in bytes of a group
+    :returns: A generator of lists of edits
+    """
+    group = []
+    size = 0
+    for first, last, lines in edits:
+        pending = []
+        pending_size = _EDIT_OVERHEAD
+        offset = first
+        for line in lines:
+            line_size = len(line.encode('utf-8')) + _LINE_OVERHEAD
+            if (size + pending_size + line_size > limit):
+                if (pending):
+                    group.append([offset, last, pending])
+                    yield group
+                    offset += len(pending)
+                    last = offset
+                    pending = []
+                    pending_size = _EDIT_OVERHEAD
+                elif (group):
+                    yield group
+                group = []
+                size = 0
+            pending.append(line)
+            pending_size += line_size
+
+        if (size + pending_size > limit and group):
+            yield group
+            group = []
+            size = 0
+        group.append([offset, last, pending])
+        size += pending_size
+
+    if (group):
+        yield group
+
+
+class LineMirror(object):
+    def __init__(self, lines=None):
+        """Creates a new mirror of the lines of a buffer.
+
+        :param lines: The initial lines of the mirror
+        """
+        self._lines = list(lines) if (lines is not None) else []
+        self._changedtick = -1
+        self._dirty = False
+
+    def apply(self, first, last, lines):
+        """Replaces the lines in the range [first, last) with new lines.
+
+        :param first: The index of the first line to replace
+        :param last: The index past the last line to replace, or -1 for the
+                     end of the buffer
+        :param lines: The new lines to place in the range
+        :returns: The updated mirror
+        """
+        if (last < 0):
+            last = len(self._lines)
+        self._lines[first:last] = lines
+        self._dirty = True
+        return self
+
+    def apply_all(self, edits):
+        """Applies a series of [first, last, lines] edits in order.
+
+        :param edits: The edits to apply
+        :returns: The updated mirror
+        """
+        for first, last, lines in edits:
+            self.apply(first, last, lines)
+        return self
+
+    def lines(self):
+        """Returns the lines held by the mirror.
+
+        :returns: The list of lines
+        """
+        return self._lines
+
+    def checksum(self):
+        """Computes a cheap checksum of the lines for drift detection.
+
+        :returns: The checksum as an integer
+        """
+        crc = 0
+        for line in self._lines:
+            crc = zlib.crc32(line.encode('utf-8'), crc)
+            crc = zlib.crc32(b'\n', crc)
+        return crc
+
+    def set_changedtick(self, changedtick):
+        self._changedtick = changedtick
+        return self
+
+    def changedtick(self):
+        return self._changedtick
+
+    def set_dirty(self, dirty):
+        self._dirty = dirty
+        return self
+
+    def dirty(self):
+        return self._dirty
+
+
+class BufferSync(logger.LoggingMixin):
+    def __init__(self, nvim, loop, send, username, session,
+                 window=0.05, checksum_interval=5.0):
+        """Creates a new incremental synchronizer of attached buffers.
+
+        :param nvim: The neovim instance used to attach to buffers
+        :param loop: The event loop used to schedule flushes and checksums
+        :param send: The function that takes a packet to send to the server
+        :param username: The username to set in outgoing packets
+        :param session: The session to set in outgoing packets
+        :param window: The number of seconds to coalesce edits before they
+                       are sent
+        :param checksum_interval: The number of seconds inbetween checksums
+                                  sent to detect drift
+        """
+        self.nvim = nvim
+        self.loop = loop
+        self.send = send
+        self.username = username
+        self.session = session
+        self.window = window
+        self.is_debug_enabled = True
+
+        # Map of buffer number -> [path, mirror, pending edits, flush handle]
+        self._buffers = {}
+        self._timer = Timer(loop, checksum_interval).set_handler(
+            self.send_checksums)
+
+    def start(self):
+        """Starts sending periodic checksums.
+
+        :returns: The updated synchronizer
+        """
+        self._timer.start()
+        return self
+
+    def stop(self):
+        """Stops all synchronization, flushing pending edits first.
+
+        :returns: The updated synchronizer
+        """
+        self._timer.stop()
+        for bufnr in list(self._buffers):
+            self.detach(bufnr)
+        return self
+
+    def attach(self, bufnr, path):
+        """Attaches to a buffer so its line changes are streamed.
+
+        :param bufnr: The number of the buffer to attach to
+        :param path: The full path of the file represented by the buffer
+        :returns: True if newly attached, otherwise False
+        """
+        if (bufnr in self._buffers):
+            return False
+
+        # Sending the buffer on attach produces an initial edit of the
+        # entire buffer, which seeds the remote copy
+        if (not self.nvim.request('nvim_buf_attach', bufnr, True, {})):
+            return False
+
+        self._buffers[bufnr] = [path, LineMirror(), [], None]
+        return True
+
+    def detach(self, bufnr):
+        """Flushes and stops tracking a buffer.
+
+        :param bufnr: The number of the buffer to detach from
+        """
+        if (bufnr in self._buffers):
+            self.flush(bufnr)
+            del self._buffers[bufnr]
+
+    def is_attached(self, path):
+        """Returns whether or not a buffer of the path is being streamed.
+
+        :param path: The full path of the file
+        :returns: True if attached, otherwise False
+        """
+        return any(b[0] == path for b in self._buffers.values())
+
+    def on_lines(self, bufnr, changedtick, first, last, lines):
+        """Records a line change reported by neovim for an attached buffer.
+
+        :param bufnr: The number of the buffer that changed
+        :param changedtick: The changedtick of the buffer after the change
+        :param first: The index of the first line replaced
+        :param last: The index past the last line replaced, or -1 for the
+                     end of the buffer
+        :param lines: The new lines
+        """
+        tracked = self._buffers.get(bufnr)
+        if (tracked is None):
+            return
+
+        mirror = tracked[1]
+        mirror.apply(first, last, lines)
+        if (changedtick is not None):
+            mirror.set_changedtick(changedtick)
+        tracked[2].append([first, last, lines])
+
+        if (tracked[3] is None):
+            tracked[3] = self.loop.call_later(self.window, self.flush, bufnr)
+
+    def flush(self, bufnr):
+        """Sends all pending edits of a buffer as coalesced edit packets.
+
+        :param bufnr: The number of the buffer to flush
+        """
+        tracked = self._buffers.get(bufnr)
+        if (tracked is None):
+            return
+
+        path, mirror, pending, handle = tracked
+        if (handle is not None):
+            handle.cancel()
+        tracked[2] = []
+        tracked[3] = None
+        if (not pending):
+            return
+
+        groups = list(split_edits(coalesce_edits(pending)))
+        for i, edits in enumerate(groups):
+            # Only the final group leaves the remote copy matching our mirror
+            is_last = (i == len(groups) - 1)
+            self.send(builders.build_tell_buffer_edit(
+                username=self.username,
+                session=self.session,
+                file_path=path,
+                edits=edits,
+                changedtick=mirror.changedtick(),
+                checksum=mirror.checksum() if (is_last) else None,
+            ))
+
+    def send_checksums(self):
+        """Sends the checksum of every attached buffer to detect drift."""
+        for bufnr in list(self._buffers):
+            self.send_checksum(bufnr)
+
+    def send_checksum(self, bufnr):
+        """Flushes a buffer and sends its checksum to detect drift.
+
+        :param bufnr: The number of the buffer whose checksum to send
+        """
+        tracked = self._buffers.get(bufnr)
+        if (tracked is None):
+            return
+
+        self.flush(bufnr)
+        path, mirror = tracked[0], tracked[1]
+        self.send(builders.build_tell_buffer_checksum(
+            username=self.username,
+            session=self.session,
+            file_path=path,
+            changedtick=mirror.changedtick(),
+            checksum=mirror.checksum(),
+        ))
+
+    def send_path_checksum(self, path):
+        """Sends the checksum of the buffer attached for a path.
+
+        :param path: The full path of the file
+        """
+        for bufnr, tracked in list(self._buffers.items()):
+            if (tracked[0] == path):
+                self.send_checksum(bufnr)
+
+    def resync(self, path):
+        """Resends the entire content of the buffer attached for a path.
+
+        :param path: The full path of the file that drifted
+        """
+        for bufnr, tracked in self._buffers.items():
+            if (tracked[0] == path):
+                self.warning('Resyncing drifted buffer %s', path)
+
+                # The mirror already holds any pending edits, and the server
+                # only accepts a whole buffer leading a batch once drifted
+                tracked[2] = [[0, -1, list(tracked[1].lines())]]
+                self.flush(bufnr)
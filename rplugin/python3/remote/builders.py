@@ -57,3 +57,435 @@ def build_tell_heartbeat(username, session):
     """
     return build_bare_packet(username, session, c.PACKET_TYPE_TELL_HEARTBEAT)
 
+
+def build_tell_buffer_edit(username, session, file_path, edits,
+                           changedtick, checksum=None):
+    """Builds a new packet containing line edits of a buffer.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param file_path: The path of the file whose buffer was edited
+    :param edits: The list of [first, last, lines] edits to apply in order
+    :param changedtick: The changedtick of the buffer after the edits
+    :param checksum: If provided, the checksum of the buffer after the edits
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_TELL_BUFFER_EDIT)
+    m = (p.get_metadata()
+         .set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+         .set_value(c.MESSAGE_METADATA_CHANGEDTICK, changedtick))
+    if (checksum is not None):
+        m.set_value(c.MESSAGE_METADATA_CHECKSUM, checksum)
+    p.get_content().set_data(edits)
+    return p
+
+
+def build_tell_buffer_checksum(username, session, file_path,
+                               changedtick, checksum):
+    """Builds a new packet containing the checksum of a buffer.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param file_path: The path of the file whose buffer is checked
+    :param changedtick: The changedtick of the buffer when checked
+    :param checksum: The checksum of the buffer
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session,
+                          c.PACKET_TYPE_TELL_BUFFER_CHECKSUM)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+     .set_value(c.MESSAGE_METADATA_CHANGEDTICK, changedtick)
+     .set_value(c.MESSAGE_METADATA_CHECKSUM, checksum))
+    return p
+
+
+def build_tell_buffer_drift(username, session, file_path, parent_header=None):
+    """Builds a new packet reporting that a remote copy of a buffer drifted.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param file_path: The path of the file whose buffer drifted
+    :param parent_header: If provided, will use as the parent header
+                          of the packet
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session,
+                          c.PACKET_TYPE_TELL_BUFFER_DRIFT, parent_header)
+    p.get_metadata().set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+    return p
+
+
+def build_update_file_start(username, session, file_path, file_version,
+                            file_length, total_chunks, chunk_size):
+    """Builds a new packet starting an update of a file.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param file_path: The path of the file being updated
+    :param file_version: The version of the file being sent
+    :param file_length: The length of the file in bytes
+    :param total_chunks: The total number of chunks that will be sent
+    :param chunk_size: The number of bytes within each chunk but the last
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_UPDATE_FILE_START)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+     .set_value(c.MESSAGE_METADATA_FILE_VERSION, file_version)
+     .set_value(c.MESSAGE_METADATA_FILE_LENGTH, file_length)
+     .set_value(c.MESSAGE_METADATA_TOTAL_CHUNKS, total_chunks)
+     .set_value(c.MESSAGE_METADATA_CHUNK_SIZE, chunk_size))
+    return p
+
+
+def build_update_file_data(username, session, file_path, file_version,
+                           chunk_index, total_chunks, data):
+    """Builds a new packet containing a chunk of a file being updated.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param file_path: The path of the file being updated
+    :param file_version: The version of the file being sent
+    :param chunk_index: The index of the chunk within the file
+    :param total_chunks: The total number of chunks of the file
+    :param data: The bytes (or memoryview) of the chunk
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_UPDATE_FILE_DATA)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+     .set_value(c.MESSAGE_METADATA_FILE_VERSION, file_version)
+     .set_value(c.MESSAGE_METADATA_CHUNK_INDEX, chunk_index)
+     .set_value(c.MESSAGE_METADATA_TOTAL_CHUNKS, total_chunks))
+    p.get_content().set_data(data)
+    return p
+
+
+def build_update_archive_start(username, session, root, version,
+                               file_length, total_chunks, chunk_size):
+    """Builds a new packet starting an update of a whole tree sent as a
+    single compressed archive.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param root: The directory the archive is extracted beneath
+    :param version: The version of the archive being sent
+    :param file_length: The length of the archive in bytes
+    :param total_chunks: The total number of chunks that will be sent
+    :param chunk_size: The number of bytes within each chunk but the last
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session,
+                          c.PACKET_TYPE_UPDATE_ARCHIVE_START)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_FILE_PATH, root)
+     .set_value(c.MESSAGE_METADATA_FILE_VERSION, version)
+     .set_value(c.MESSAGE_METADATA_FILE_LENGTH, file_length)
+     .set_value(c.MESSAGE_METADATA_TOTAL_CHUNKS, total_chunks)
+     .set_value(c.MESSAGE_METADATA_CHUNK_SIZE, chunk_size))
+    return p
+
+
+def build_update_archive_data(username, session, root, version,
+                              chunk_index, total_chunks, data):
+    """Builds a new packet containing a chunk of an archive of a tree.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param root: The directory the archive is extracted beneath
+    :param version: The version of the archive being sent
+    :param chunk_index: The index of the chunk within the archive
+    :param total_chunks: The total number of chunks of the archive
+    :param data: The bytes (or memoryview) of the chunk
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session,
+                          c.PACKET_TYPE_UPDATE_ARCHIVE_DATA)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_FILE_PATH, root)
+     .set_value(c.MESSAGE_METADATA_FILE_VERSION, version)
+     .set_value(c.MESSAGE_METADATA_CHUNK_INDEX, chunk_index)
+     .set_value(c.MESSAGE_METADATA_TOTAL_CHUNKS, total_chunks))
+    p.get_content().set_data(data)
+    return p
+
+
+def build_ask_file_chunks(username, session, file_path, file_version,
+                          total_chunks):
+    """Builds a new packet asking which chunks of a file being updated have
+    already been received, so an interrupted transfer can be resumed.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param file_path: The path of the file being updated
+    :param file_version: The version of the file being sent
+    :param total_chunks: The total number of chunks of the file
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_ASK_FILE_CHUNKS)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+     .set_value(c.MESSAGE_METADATA_FILE_VERSION, file_version)
+     .set_value(c.MESSAGE_METADATA_TOTAL_CHUNKS, total_chunks))
+    return p
+
+
+def build_answer_file_chunks(username, session, parent_header, file_path,
+                             file_version, total_chunks, bitmap):
+    """Builds a new packet answering which chunks of a file have been
+    received.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param parent_header: The header of the packet being answered
+    :param file_path: The path of the file being updated
+    :param file_version: The version of the file being sent
+    :param total_chunks: The total number of chunks of the file
+    :param bitmap: The bytes of the bitmap of received chunks
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_ANSWER_FILE_CHUNKS,
+                          parent_header)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+     .set_value(c.MESSAGE_METADATA_FILE_VERSION, file_version)
+     .set_value(c.MESSAGE_METADATA_TOTAL_CHUNKS, total_chunks))
+    p.get_content().set_data(bitmap)
+    return p
+
+
+def build_ask_file_list(username, session, file_path):
+    """Builds a new packet asking for the files beneath a directory.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param file_path: The directory relative to the root of the server
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_ASK_FILE_LIST)
+    p.get_metadata().set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+    return p
+
+
+def build_answer_file_list(username, session, parent_header, page_index,
+                           is_last, entries):
+    """Builds a new packet containing a single page of a file list.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param parent_header: The header of the packet being answered
+    :param page_index: The index of the page within the list
+    :param is_last: Whether or not this is the final page of the list
+    :param entries: The list of [path, size, mtime_ns] entries of the page
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_ANSWER_FILE_LIST,
+                          parent_header)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_PAGE_INDEX, page_index)
+     .set_value(c.MESSAGE_METADATA_LAST_PAGE, is_last))
+    p.get_content().set_data(entries)
+    return p
+
+
+def build_tell_file_changed(username, session, changes):
+    """Builds a new packet telling clients that files have changed.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param changes: The list of [path, version, size] entries of the files
+                    changed, where deleted files have the default version
+                    and length
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_TELL_FILE_CHANGED)
+    p.get_content().set_data(changes)
+    return p
+
+
+def build_ask_tree(username, session, file_path):
+    """Builds a new packet asking for the hashes of the children of a
+    directory within the server's tree.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param file_path: The directory relative to the root of the server
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_ASK_TREE)
+    p.get_metadata().set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+    return p
+
+
+def build_answer_tree(username, session, parent_header, page_index,
+                      is_last, entries):
+    """Builds a new packet containing a single page of the children of a
+    directory within the server's tree.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param parent_header: The header of the packet being answered
+    :param page_index: The index of the page within the children
+    :param is_last: Whether or not this is the final page of the children
+    :param entries: The list of [name, is_dir, digest] entries of the page
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_ANSWER_TREE,
+                          parent_header)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_PAGE_INDEX, page_index)
+     .set_value(c.MESSAGE_METADATA_LAST_PAGE, is_last))
+    p.get_content().set_data(entries)
+    return p
+
+
+def build_ask_file_version(username, session, file_path):
+    """Builds a new packet asking for the current version of a file.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param file_path: The path of the file relative to the root of the server
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_ASK_FILE_VERSION)
+    p.get_metadata().set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+    return p
+
+
+def build_answer_file_version(username, session, parent_header, file_path,
+                              file_version, file_length):
+    """Builds a new packet containing the current version of a file.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param parent_header: The header of the packet being answered
+    :param file_path: The path of the file relative to the root of the server
+    :param file_version: The version of the file, or the default version if
+                         the file does not exist
+    :param file_length: The length of the file in bytes, or the default
+                        length if the file does not exist
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session,
+                          c.PACKET_TYPE_ANSWER_FILE_VERSION, parent_header)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+     .set_value(c.MESSAGE_METADATA_FILE_VERSION, file_version)
+     .set_value(c.MESSAGE_METADATA_FILE_LENGTH, file_length))
+    return p
+
+
+def build_retrieve_file_ask(username, session, file_path, file_version):
+    """Builds a new packet asking for the contents of a file.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param file_path: The path of the file relative to the root of the server
+    :param file_version: The version of the file expected
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_RETRIEVE_FILE_ASK)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+     .set_value(c.MESSAGE_METADATA_FILE_VERSION, file_version))
+    return p
+
+
+def build_retrieve_file(username, session, parent_header, file_path,
+                        file_version, file_length, chunk_index, total_chunks,
+                        chunk_size, data):
+    """Builds a new packet containing a single chunk of a retrieved file;
+    every chunk describes the whole file.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param parent_header: The header of the packet asking for the file
+    :param file_path: The path of the file relative to the root of the server
+    :param file_version: The version of the file being sent
+    :param file_length: The length of the file in bytes
+    :param chunk_index: The index of the chunk within the file
+    :param total_chunks: The total number of chunks of the file
+    :param chunk_size: The size of every chunk but the last in bytes
+    :param data: The bytes of the chunk
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_RETRIEVE_FILE,
+                          parent_header)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_FILE_PATH, file_path)
+     .set_value(c.MESSAGE_METADATA_FILE_VERSION, file_version)
+     .set_value(c.MESSAGE_METADATA_FILE_LENGTH, file_length)
+     .set_value(c.MESSAGE_METADATA_CHUNK_INDEX, chunk_index)
+     .set_value(c.MESSAGE_METADATA_TOTAL_CHUNKS, total_chunks)
+     .set_value(c.MESSAGE_METADATA_CHUNK_SIZE, chunk_size))
+    p.get_content().set_data(data)
+    return p
+
+
+def build_ask_command(username, session, name, args):
+    """Builds a new packet asking for a command to be run.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param name: The name of the program to run
+    :param args: The list of arguments to the program
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_ASK_COMMAND)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_COMMAND_NAME, name)
+     .set_value(c.MESSAGE_METADATA_COMMAND_ARGS, args))
+    return p
+
+
+def build_answer_command(username, session, parent_header, sequence, stream,
+                         data, exit_code=None):
+    """Builds a new packet containing a piece of the output of a command.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param parent_header: The header of the packet asking for the command
+    :param sequence: The position of the packet within the output
+    :param stream: The stream the output was written to
+    :param data: The bytes of output
+    :param exit_code: If provided, the exit code of the command, set only
+                      on the final packet
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_ANSWER_COMMAND,
+                          parent_header)
+    (p.get_metadata()
+     .set_value(c.MESSAGE_METADATA_SEQUENCE, sequence)
+     .set_value(c.MESSAGE_METADATA_OUTPUT_STREAM, stream))
+    if (exit_code is not None):
+        p.get_metadata().set_value(c.MESSAGE_METADATA_EXIT_CODE, exit_code)
+    p.get_content().set_data(data)
+    return p
+
+
+def build_tell_command_ack(username, session, parent_header, sequence):
+    """Builds a new packet acknowledging the output of a command.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param parent_header: The header of the packet asking for the command
+    :param sequence: The sequence up to which all output was received
+    :returns: A new packet instance
+    """
+    p = build_bare_packet(username, session, c.PACKET_TYPE_TELL_COMMAND_ACK,
+                          parent_header)
+    p.get_metadata().set_value(c.MESSAGE_METADATA_SEQUENCE, sequence)
+    return p
+
+
+def build_tell_command_cancel(username, session, parent_header):
+    """Builds a new packet cancelling a command.
+
+    :param username: The username to set in the header
+    :param session: The session to set in the header
+    :param parent_header: The header of the packet asking for the command
+    :returns: A new packet instance
+    """
+    return build_bare_packet(username, session,
+                             c.PACKET_TYPE_TELL_COMMAND_CANCEL, parent_header)
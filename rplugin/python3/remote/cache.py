@@ -0,0 +1,176 @@
+# =============================================================================
+# FILE: cache.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import msgpack
+import os
+from collections import OrderedDict
+from hashlib import sha256
+from . import logger
+
+# Default directory of cached copies of files retrieved from a server
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'remote', 'files')
+
+# Default maximum total size of cached copies in bytes
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Name of the manifest of cached copies within the cache directory
+_MANIFEST_NAME = 'manifest'
+
+
+class FileCache(logger.LoggingMixin):
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR,
+                 max_size=DEFAULT_CACHE_SIZE):
+        """Creates a new disk cache of the latest retrieved version of remote
+        files. Copies are stored under a name derived from their path and
+        version, and the least recently used copies are evicted once the
+        total size exceeds the cap. The manifest is not read until the cache
+        is first used.
+
+        :param cache_dir: The directory to keep cached copies within
+        :param max_size: The maximum total size of cached copies in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.is_debug_enabled = True
+
+        # Map of path -> (version, size) of cached copies, least recently
+        # used first
+        self._entries = None
+        self._size = 0
+
+    def blob_path(self, path, version):
+        """Returns where the copy of a version of a file is stored.
+
+        :param path: The path of the file on the server
+        :param version: The version of the file
+        :returns: The local path of the copy
+        """
+        key = sha256('{}\0{}'.format(path, version).encode('utf-8'))
+        name = key.hexdigest()
+        return os.path.join(self.cache_dir, name[:2], name[2:])
+
+    def lookup(self, path):
+        """Returns the cached copy of a file, marking it as recently used.
+
+        :param path: The path of the file on the server
+        :returns: The tuple of (version, local path) if cached, otherwise None
+        """
+        entries = self._load()
+        entry = entries.get(path)
+        if (entry is None):
+            return None
+
+        version, _ = entry
+        blob_path = self.blob_path(path, version)
+        if (not os.path.exists(blob_path)):
+            self._drop(path)
+            self._save()
+            return None
+        entries.move_to_end(path)
+        return version, blob_path
+
+    def add(self, path, version, size):
+        """Records a copy written to blob_path(path, version), replacing any
+        older copy of the file and evicting copies over the size cap.
+
+        :param path: The path of the file on the server
+        :param version: The version of the file
+        :param size: The size of the copy in bytes
+        :returns: The local path of the copy
+        """
+        entries = self._load()
+        old = entries.get(path)
+        if (old is not None and old[0] != version):
+            self._unlink(self.blob_path(path, old[0]))
+        self._drop(path, unlink=False)
+
+        entries[path] = (version, size)
+        self._size += size
+        self._evict(keep=path)
+        self._save()
+        return self.blob_path(path, version)
+
+    def remove(self, path):
+        """Removes the cached copy of a file.
+
+        :param path: The path of the file on the server
+        """
+        if (self._drop(path)):
+            self._save()
+
+    def size(self):
+        """Returns the total size of cached copies in bytes."""
+        self._load()
+        return self._size
+
+    def paths(self):
+        """Returns the paths of cached files, least recently used first."""
+        return list(self._load())
+
+    def flush(self):
+        """Persists the order in which copies were used."""
+        if (self._entries is not None):
+            self._save()
+
+    def _load(self):
+        if (self._entries is not None):
+            return self._entries
+
+        self._entries = OrderedDict()
+        self._size = 0
+        try:
+            with open(self._manifest_path(), 'rb') as f:
+                records = msgpack.unpackb(f.read(), raw=False)
+        except (OSError, ValueError):
+            records = []
+        if (not isinstance(records, list)):
+            records = []
+
+        for record in records:
+            try:
+                path, version, size = record
+            except (TypeError, ValueError):
+                continue
+            self._entries[path] = (version, size)
+            self._size += size
+        return self._entries
+
+    def _save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        manifest_path = self._manifest_path()
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(msgpack.packb(
+                [[p, v, s] for p, (v, s) in self._entries.items()],
+                use_bin_type=True,
+            ))
+        os.replace(tmp_path, manifest_path)
+
+    def _evict(self, keep):
+        for path in list(self._entries):
+            if (self._size <= self.max_size):
+                break
+            if (path != keep):
+                self.debug('Evicting cached copy of %s', path)
+                self._drop(path)
+
+    def _drop(self, path, unlink=True):
+        entry = self._entries.pop(path, None)
+        if (entry is None):
+            return False
+        self._size -= entry[1]
+        if (unlink):
+            self._unlink(self.blob_path(path, entry[0]))
+        return True
+
+    def _unlink(self, blob_path):
+        try:
+            os.unlink(blob_path)
+        except FileNotFoundError:
+            pass
+
+    def _manifest_path(self):
+        return os.path.join(self.cache_dir, _MANIFEST_NAME)
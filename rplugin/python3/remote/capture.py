@@ -0,0 +1,215 @@
+# =============================================================================
+# FILE: capture.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import argparse
+import asyncio
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+
+# Leads every capture file, ending with the version of the format
+CAPTURE_MAGIC = b'RCAP\x01'
+
+# Directions of captured datagrams
+DIRECTION_IN = 0
+DIRECTION_OUT = 1
+
+# Each record is its time, direction, length of the peer host, peer port
+# and length of the datagram, followed by the host and the datagram
+_RECORD = struct.Struct('<dBBHI')
+
+CapturedDatagram = namedtuple(
+    'CapturedDatagram', ['time', 'direction', 'addr', 'data'])
+
+
+class CaptureWriter(object):
+    def __init__(self, path, clock=time.time):
+        """Creates a new writer appending datagrams to a capture file.
+
+        Records are buffered, so only a closed capture is guaranteed to hold
+        every datagram written.
+
+        :param path: The path of the capture file, created if missing
+        :param clock: The function returning the current time in seconds
+        """
+        self.path = path
+        self._clock = clock
+        self.count = 0
+
+        directory = os.path.dirname(path)
+        if (directory):
+            os.makedirs(directory, exist_ok=True)
+        self._f = open(path, 'ab')
+        if (self._f.tell() == 0):
+            self._f.write(CAPTURE_MAGIC)
+
+    def write(self, direction, addr, data):
+        """Appends a datagram to the capture.
+
+        :param direction: The direction the datagram travelled
+        :param addr: The (host, port) of the peer, or None if not known
+        :param data: The bytes of the datagram
+        """
+        host, port = (addr[0], addr[1]) if (addr is not None) else ('', 0)
+        host = str(host).encode('utf-8')
+        self._f.write(_RECORD.pack(self._clock(), direction, len(host),
+                                   port, len(data)) + host + data)
+        self.count += 1
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+def read_capture(path):
+    """Reads the datagrams of a capture file in the order they were written,
+    stopping at a record cut short by a crash.
+
+    :param path: The path of the capture file
+    :returns: An iterator of CapturedDatagram
+    """
+    with open(path, 'rb') as f:
+        if (f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC):
+            raise ValueError('{} is not a capture file'.format(path))
+        while True:
+            header = f.read(_RECORD.size)
+            if (len(header) < _RECORD.size):
+                return
+            t, direction, host_length, port, length = _RECORD.unpack(header)
+            host = f.read(host_length)
+            data = f.read(length)
+            if (len(host) < host_length or len(data) < length):
+                return
+            yield CapturedDatagram(t, direction,
+                                   (host.decode('utf-8'), port), data)
+
+
+class CaptureTransport(object):
+    def __init__(self, transport, writer):
+        """Wraps a datagram transport, capturing every datagram sent before
+        passing it on.
+
+        :param transport: The transport to wrap
+        :param writer: The capture writer to record datagrams with
+        """
+        self._transport = transport
+        self._writer = writer
+        self._peer = transport.get_extra_info('peername')
+
+    def sendto(self, data, addr=None):
+        self._writer.write(DIRECTION_OUT,
+                           addr if (addr is not None) else self._peer, data)
+        self._transport.sendto(data, addr)
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+
+class NullTransport(object):
+    """Transport discarding every datagram sent, standing in for a socket
+    when replaying a capture offline."""
+
+    def __init__(self):
+        self.sent = 0
+
+    def sendto(self, data, addr=None):
+        self.sent += 1
+
+    def close(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+async def replay(path, protocol, loop, speed=1.0, direction=DIRECTION_IN):
+    """Feeds the datagrams of a capture to a protocol as if received.
+
+    :param path: The path of the capture file
+    :param protocol: The datagram protocol to feed
+    :param loop: The event loop the protocol runs on
+    :param speed: The factor to speed up the original timing by, or None to
+                  replay as fast as the protocol keeps up
+    :param direction: The direction of the datagrams to replay, where those
+                      received by the captured end are the ones to feed back
+    :returns: The number of datagrams replayed
+    """
+    count = 0
+    first = None
+    began = loop.time()
+    for record in read_capture(path):
+        if (record.direction != direction):
+            continue
+        if (first is None):
+            first = record.time
+        if (speed):
+            delay = began + (record.time - first) / speed - loop.time()
+            await asyncio.sleep(max(delay, 0))
+        else:
+            await asyncio.sleep(0)
+        protocol.datagram_received(record.data, record.addr)
+        count += 1
+    return count
+
+
+async def _replay_main(args, loop):
+    # Imported here so reading captures needs nothing of the protocols
+    from .client import RemoteClientProtocol
+    from .security import new_hmac_from_key
+    from .server import RemoteServerProtocol
+
+    hmac = new_hmac_from_key(args.key)
+    if (args.client):
+        protocol = RemoteClientProtocol(None, hmac)
+    else:
+        protocol = RemoteServerProtocol(None, hmac, loop=loop, root=args.root)
+    protocol.transport = NullTransport()
+
+    count = await replay(args.capture, protocol, loop,
+                         speed=args.speed if (args.speed > 0) else None)
+    await protocol.handler.registry.join()
+    print('Replayed {} datagrams, {} sent back'.format(
+        count, protocol.transport.sent))
+    print('\n'.join(protocol.handler.stats.format()))
+
+
+def main(argv=None):
+    """Replays a capture into a server or client that is not connected to
+    anything, printing the stats of the packets handled; run beneath a
+    profiler to see where the time goes.
+
+    Files sent to a server in the capture are written to the paths they were
+    sent to, so replay file updates only where those paths are disposable.
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m remote.capture',
+        description='Replays captured traffic into a server or client. '
+                    'Captured file updates are written to the paths they '
+                    'name.')
+    parser.add_argument('capture', help='path of the capture file')
+    parser.add_argument('--key', default='',
+                        help='key the captured packets were signed with')
+    parser.add_argument('--client', action='store_true',
+                        help='replay into a client instead of a server')
+    parser.add_argument('--root', default='.',
+                        help='directory the server serves')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='factor to speed up replay by, 0 for as fast '
+                             'as possible')
+    args = parser.parse_args(argv)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_replay_main(args, loop))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+# =============================================================================
+# FILE: chunks.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import mmap
+import os
+from .packet import MAX_CONTENT_SIZE
+
+# Number of bytes of a file sent within a single packet
+CHUNK_SIZE = MAX_CONTENT_SIZE
+
+
+def count_chunks(length, chunk_size=CHUNK_SIZE):
+    """Returns the number of chunks needed to send a file.
+
+    :param length: The length of the file in bytes
+    :param chunk_size: The maximum number of bytes within a chunk
+    :returns: The total number of chunks, which is at least one
+    """
+    return max(1, (length + chunk_size - 1) // chunk_size)
+
+
+def iter_file_chunks(path, chunk_size=CHUNK_SIZE):
+    """Yields the chunks of a file as slices of a memory map of the file,
+    so neither the whole file nor any chunk is copied into memory.
+
+    The yielded views are only valid until the generator advances past them
+    or is closed, and should not be held onto afterwards.
+
+    :param path: The path of the file to read
+    :param chunk_size: The maximum number of bytes within a chunk
+    :returns: A generator of (chunk index, total chunks, memoryview) tuples
+    """
+    with open(path, 'rb') as f:
+        length = os.fstat(f.fileno()).st_size
+
+        # Empty files cannot be mapped, but are still sent as a single chunk
+        if (length == 0):
+            yield 0, 1, memoryview(b'')
+            return
+
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(m)
+        try:
+            total = count_chunks(length, chunk_size)
+            for index in range(total):
+                start = index * chunk_size
+                chunk = view[start:start + chunk_size]
+                try:
+                    yield index, total, chunk
+                finally:
+                    chunk.release()
+        finally:
+            view.release()
+            try:
+                m.close()
+            except BufferError:
+                # A consumer still holds a view, so the map is left for the
+                # garbage collector to close once the view is gone
+                pass
@@ -4,22 +4,75 @@
 # License: Apache 2.0 License
 # =============================================================================
 import asyncio
+import os
+import tempfile
 from asyncio import DatagramProtocol
+from collections import deque
+from functools import partial
 from uuid import uuid4
-from . import logger
+from . import logger, metrics
+from .archive import DEFAULT_MAX_ROUNDS, write_archive
+from .buffer import BufferSync
+from .builders import (
+    build_ask_command,
+    build_ask_file_chunks,
+    build_ask_file_list,
+    build_ask_file_version,
+    build_ask_tree,
+    build_retrieve_file_ask,
+    build_tell_command_ack,
+    build_tell_command_cancel,
+    build_update_archive_data,
+    build_update_archive_start,
+    build_update_file_data,
+    build_update_file_start,
+)
+from .chunks import CHUNK_SIZE, count_chunks, iter_file_chunks
+from .commands import DEFAULT_ACK_EVERY, DEFAULT_OUTPUT_TIMEOUT
+from .capture import DIRECTION_IN, CaptureTransport, CaptureWriter
+from .dirindex import DirectoryIndex
 from .handlers.client import ClientHandler
-from .packet import (
-    Content,
-    Header,
-    Metadata,
-    Packet,
+from .index import FileIndex
+from .indexer import ParallelIndexer
+from .merkle import MerkleTree, diff_children
+from .packet import Packet
+from .prefetch import DEFAULT_PREFETCH_BUDGET, Prefetcher
+from .reassembly import ChunkBitmap
+from .scheduler import (
+    DEFAULT_MAX_CONCURRENT,
+    PRIORITY_BACKGROUND,
+    TransferScheduler,
+)
+from .constants import (
+    COMMAND_STREAM_EXIT,
+    MESSAGE_DEFAULT_COMMAND_OUTPUT,
+    MESSAGE_DEFAULT_FILE_LIST,
+    MESSAGE_METADATA_EXIT_CODE,
+    MESSAGE_METADATA_FILE_LENGTH,
+    MESSAGE_METADATA_FILE_VERSION,
+    MESSAGE_METADATA_LAST_PAGE,
+    MESSAGE_METADATA_OUTPUT_STREAM,
+    MESSAGE_METADATA_PAGE_INDEX,
+    MESSAGE_METADATA_SEQUENCE,
+    packet_type_name,
 )
 from .security import new_hmac_from_key
 
 
 class RemoteClient(logger.LoggingMixin):
-    def __init__(self, nvim, addr, port, key=None):
+    def __init__(self, nvim, loop, addr, port, key=None, index=None,
+                 max_concurrent=DEFAULT_MAX_CONCURRENT, max_rate=None,
+                 cache=None, capture=None, root=None):
         self.nvim = nvim
+        self.loop = loop
+        self.root = os.path.abspath(root if (root is not None)
+                                    else os.getcwd())
+        self.capture_path = capture
+        self.capture = None
+        self.index = index if (index is not None) else FileIndex()
+        self.cache = cache
+        self.scheduler = TransferScheduler(
+            loop, max_concurrent=max_concurrent, max_rate=max_rate)
         self.is_debug_enabled = True
 
         self.info = {}
@@ -30,9 +83,31 @@ class RemoteClient(logger.LoggingMixin):
         self.info['username'] = 'senkwich'
 
         self.hmac = new_hmac_from_key(key)
-        self.loop = None
         self.transport = None
         self.protocol = None
+        self.buffer_sync = None
+        self.prefetcher = None
+
+        # Map of path -> version last sent to the server
+        self._sent_versions = {}
+
+        # Number of retrievals underway that someone is waiting on
+        self._foreground = 0
+
+        # Version of the last archive of a tree sent to the server
+        self._archive_version = 0
+
+        # Round trips of asks answered in time across every session, and
+        # of this session alone until the client stops
+        self._rtt = metrics.histogram('client.rtt')
+        self._session_rtt = metrics.histogram(
+            'client.rtt.{}'.format(self.info['session']))
+        self._ask_timeouts = metrics.counter('client.ask_timeouts')
+        self._resent = metrics.counter('client.chunks_resent')
+
+        # Removed once stopped, so the registry does not keep the client
+        self._pending_gauge = lambda: len(self.scheduler.pending())
+        metrics.gauge('client.transfers_pending', self._pending_gauge)
 
     def is_running(self):
         return self.transport is not None
@@ -47,34 +122,514 @@ class RemoteClient(logger.LoggingMixin):
         self.transport.sendto(data)
         self.nvim.out_write('Sent "{}"\n'.format(data))
 
-    def send_start_file_update(self, filename):
-        """Starts a new request to the server to update a file.
+    def send_packet(self, packet):
+        """Signs and sends a packet to the server.
+
+        :param packet: The packet to send
+        """
+        if (not self.is_running()):
+            raise Exception('Client is not running or connected!')
+
+        self.transport.sendto(packet.gen_signature(self.hmac).to_bytes())
+
+    async def ask(self, packet, timeout=1.0):
+        """Sends an ask packet and waits for its answer.
+
+        :param packet: The ask packet to send
+        :param timeout: The number of seconds to wait for the answer
+        :returns: The answer packet, or None if no answer arrived in time
+        """
+        if (self.protocol is None):
+            return None
+
+        handler = self.protocol.handler
+        future = handler.expect_answer(packet, self.loop)
+        start = self.loop.time()
+        try:
+            self.send_packet(packet)
+            answer = await asyncio.wait_for(future, timeout)
+            rtt = self.loop.time() - start
+            self._rtt.observe(rtt)
+            self._session_rtt.observe(rtt)
+            return answer
+        except asyncio.TimeoutError:
+            self._ask_timeouts.inc()
+            return None
+        finally:
+            handler.forget_answer(packet)
+
+    def list_files(self, path='', timeout=5.0):
+        """Lists the files beneath a directory on the server.
+
+        :param path: The directory relative to the root of the server
+        :param timeout: The number of seconds to wait for each page
+        :returns: An async iterator of [path, size, mtime_ns] entries,
+                  yielded as soon as their page arrives
+        """
+        return FileListStream(self, build_ask_file_list(
+            username=self.info['username'],
+            session=self.info['session'],
+            file_path=path,
+        ), timeout)
+
+    def is_idle(self):
+        """Checks if nothing is being sent or retrieved on demand.
+
+        :returns: True if idle, otherwise False
+        """
+        return self._foreground == 0 and not self.scheduler.pending()
+
+    async def retrieve_file(self, path, timeout=1.0, transfer_timeout=30.0,
+                            max_length=None, background=False):
+        """Retrieves a file from the server, reusing the cached copy if the
+        server still has the same version so only a single small ask is
+        needed.
+
+        :param path: The path of the file relative to the root of the server
+        :param timeout: The number of seconds to wait for the version
+        :param transfer_timeout: The number of seconds to wait for the
+                                 contents of the file to arrive
+        :param max_length: If provided, the length in bytes above which the
+                           file is not retrieved
+        :param background: Whether or not the retrieval is speculative, so it
+                           does not keep the client from being idle
+        :returns: The local path of the retrieved copy, or None if the file
+                  does not exist, could not be retrieved or there is no
+                  cache to retrieve it into
+        """
+        if (self.cache is None):
+            return None
+        if (background):
+            return await self._retrieve_file(path, timeout, transfer_timeout,
+                                             max_length)
+        self._foreground += 1
+        try:
+            return await self._retrieve_file(path, timeout, transfer_timeout,
+                                             max_length)
+        finally:
+            self._foreground -= 1
+
+    async def _retrieve_file(self, path, timeout, transfer_timeout,
+                             max_length):
+        # A copy of the version the server last reported is already current
+        cached = self.cache.lookup(path)
+        remote_files = (self.protocol.handler.remote_files
+                        if (self.protocol is not None) else {})
+        known = remote_files.get(path)
+        if (cached is not None and known is not None and
+                known[0] == cached[0]):
+            return cached[1]
+
+        answer = await self.ask(build_ask_file_version(
+            username=self.info['username'],
+            session=self.info['session'],
+            file_path=path,
+        ), timeout)
+        if (answer is None):
+            return None
+        m = answer.get_metadata()
+        version = m.get_value(MESSAGE_METADATA_FILE_VERSION)
+        if (not version):
+            return None
+
+        if (cached is not None and cached[0] == version):
+            return cached[1]
+        length = m.get_value(MESSAGE_METADATA_FILE_LENGTH)
+        if (max_length is not None and
+                (length is None or length > max_length)):
+            return None
+
+        local_path = await self.ask(build_retrieve_file_ask(
+            username=self.info['username'],
+            session=self.info['session'],
+            file_path=path,
+            file_version=version,
+        ), transfer_timeout)
+        if (local_path is None):
+            self.debug('Failed to retrieve %s', path)
+        return local_path
+
+    def run_command(self, name, args=None, timeout=DEFAULT_OUTPUT_TIMEOUT):
+        """Runs a command on the server, streaming its output back while it
+        runs.
+
+        :param name: The name of the program to run
+        :param args: The list of arguments to the program
+        :param timeout: If provided, the number of seconds to wait for each
+                        piece of output
+        :returns: An async iterator of (stream, data) tuples
+        """
+        return CommandStream(self, build_ask_command(
+            username=self.info['username'],
+            session=self.info['session'],
+            name=name,
+            args=list(args or []),
+        ), timeout)
+
+    def list_tree(self, path='', timeout=5.0):
+        """Lists the children of a directory within the server's tree.
+
+        :param path: The directory relative to the root of the server
+        :param timeout: The number of seconds to wait for each page
+        :returns: An async iterator of [name, is_dir, digest] entries
+        """
+        return FileListStream(self, build_ask_tree(
+            username=self.info['username'],
+            session=self.info['session'],
+            file_path=path,
+        ), timeout)
+
+    async def build_tree(self, root, progress=None):
+        """Builds the tree of a local directory off the event loop, only
+        hashing files that changed since they were last indexed and hashing
+        those across a pool of workers.
+
+        :param root: The local directory matching the root of the server
+        :param progress: If provided, the function taking the number of files
+                         hashed so far and the number to hash
+        :returns: The new tree
+        """
+        dir_index = await ParallelIndexer(
+            self.loop, self.index, progress=progress).index_tree(root)
+        paths = [e[0] for e in dir_index.iter_entries()]
+        return await self.loop.run_in_executor(
+            None, MerkleTree.build, dir_index.root, paths, self.index)
+
+    async def reconcile(self, tree, timeout=5.0):
+        """Finds the files that differ between a local tree and the
+        server's, descending only into directories whose hashes differ so
+        the number of asks grows with the changes rather than the files.
+        Each level of the tree is asked for at once.
+
+        :param tree: The local tree of the directory matching the server
+        :param timeout: The number of seconds to wait for each page
+        :returns: A list of (path, local digest, remote digest) tuples
+                  sorted by path, where a missing file has a None digest
+        """
+        changed = []
+        level = ['']
+        while level:
+            listings = await asyncio.gather(
+                *[self._list_tree_all(path, timeout) for path in level])
+
+            next_level = []
+            for path, remote in zip(level, listings):
+                for name, a, b in diff_children(tree.children(path), remote):
+                    child = os.path.join(path, name) if (path) else name
+                    a_dir = a is not None and a[1]
+                    b_dir = b is not None and b[1]
+                    a_file = a[2] if (a is not None and not a_dir) else None
+                    b_file = b[2] if (b is not None and not b_dir) else None
+                    if (a_file != b_file):
+                        changed.append((child, a_file, b_file))
+
+                    if (b_dir):
+                        next_level.append(child)
+                    elif (a_dir):
+                        changed.extend((f, tree.hash(f), None)
+                                       for f in tree.files(child))
+            level = next_level
+        changed.sort()
+        return changed
+
+    async def _list_tree_all(self, path, timeout):
+        entries = []
+        async for entry in self.list_tree(path, timeout):
+            entries.append(entry)
+        return entries
+
+    def enable_prefetch(self, budget=DEFAULT_PREFETCH_BUDGET):
+        """Enables warming the cache in the background with the files
+        likely to be opened after each file opened through the client.
+
+        :param budget: The maximum number of bytes to prefetch
+        :returns: The prefetcher
+        """
+        if (self.prefetcher is None and self.cache is not None):
+            def cached(path):
+                entry = self.cache.lookup(path)
+                return entry[1] if (entry is not None) else None
+
+            self.prefetcher = Prefetcher(
+                loop=self.loop,
+                retrieve=lambda path, max_length: self.retrieve_file(
+                    path, max_length=max_length, background=True),
+                list_tree=self.list_tree,
+                is_idle=self.is_idle,
+                cached=cached,
+                budget=budget,
+            )
+        return self.prefetcher
+
+    def enable_buffer_sync(self, window=0.05, checksum_interval=5.0):
+        """Enables streaming of line edits of attached buffers to the
+        server instead of sending whole files when they are written.
+
+        :param window: The number of seconds to coalesce edits
+        :param checksum_interval: The number of seconds inbetween checksums
+        :returns: The buffer synchronizer
+        """
+        if (self.buffer_sync is None):
+            self.buffer_sync = BufferSync(
+                nvim=self.nvim,
+                loop=self.loop,
+                send=self.send_packet,
+                username=self.info['username'],
+                session=self.info['session'],
+                window=window,
+                checksum_interval=checksum_interval,
+            ).start()
+            if (self.protocol is not None):
+                self.protocol.handler.buffer_sync = self.buffer_sync
+        return self.buffer_sync
+
+    def remote_path(self, filename):
+        """Returns the path of a local file as known by the server.
+
+        :param filename: The path of the local file
+        :returns: The path relative to the root, or None if the file is not
+                  beneath the root
+        """
+        path = os.path.relpath(os.path.abspath(filename), self.root)
+        if (path == os.pardir or path.startswith(os.pardir + os.sep)):
+            return None
+        return path
+
+    def send_start_file_update(self, filename, priority=PRIORITY_BACKGROUND):
+        """Starts a new request to the server to update a file, skipping the
+        update if the file's version has already been sent.
 
         :param filename: The full, local path of the file to update
+        :param priority: The priority class of the transfer, such as
+                         PRIORITY_CURRENT for the file being edited
+        :returns: The task sending the file, whose result is True if the
+                  server received the file and False if no update was needed
+                  or the server did not receive it
         """
-        # TODO: Lookup file version, file length from filename
-        r = file.UpdateFileStartRequest(
+        return self.loop.create_task(
+            self._send_file_update(filename, priority))
+
+    async def _send_file_update(self, filename, priority):
+        """Hashes a file off the event loop and, if its version has not been
+        sent, sends it to the server.
+
+        :param filename: The full, local path of the file to update
+        :param priority: The priority class of the transfer
+        :returns: True if the server received the file, otherwise False
+        """
+        path = self.remote_path(filename)
+        if (path is None):
+            self.warning('Not updating %s outside of %s', filename, self.root)
+            return False
+
+        entry = await self.loop.run_in_executor(
+            None, self.index.refresh, filename)
+        if (entry is None or
+                self._sent_versions.get(filename) == entry.version):
+            return False
+
+        self.send_packet(build_update_file_start(
             username=self.info['username'],
             session=self.info['session'],
-            file_path=filename,
-            file_version=1.0,
-        )
-        p = (Packet()
-             .set_parent_header(Header.empty())
-             .set_header(Header()
-                         .set_random_id()
-                         .set_username(self.info['username'])
-                         .set_session(self.info['session'])
-                         .set_date_now()
-                         .set_type()
-                         .set_version_current())
-             .set_metadata(Metadata.empty())
-             .set_content(Content().set_data())
-             .gen_signature(self.hmac))
-        self.send(p.to_bytes())
+            file_path=path,
+            file_version=entry.version,
+            file_length=entry.size,
+            total_chunks=count_chunks(entry.size),
+            chunk_size=CHUNK_SIZE,
+        ))
+        await self.loop.run_in_executor(None, self.index.flush)
         self.nvim.async_call(lambda nvim, filename, addr, port: nvim.out_write(
             'Updating %s on %s:%s' % (filename, addr, port)),
             self.nvim, filename, self.info['addr'], self.info['port'])
+        return await self._send_file_data(filename, path, entry, priority)
+
+    async def _send_file_data(self, filename, path, entry, priority,
+                              max_rounds=DEFAULT_MAX_ROUNDS):
+        """Sends the chunks of a file through the transfer scheduler.
+        Chunks the server already has from an interrupted transfer of the
+        same version are skipped, and chunks the server dropped are resent
+        once it says which arrived, so the file is sent no faster than the
+        server writes it.
+
+        :param filename: The full, local path of the file to send
+        :param path: The path of the file relative to the root
+        :param entry: The index entry of the version being sent
+        :param priority: The priority class of the transfer
+        :param max_rounds: The number of times chunks the server is missing
+                           are resent before giving up
+        :returns: True if the server confirmed receiving every chunk,
+                  otherwise False
+        """
+        total = count_chunks(entry.size)
+        received = await self._ask_file_chunks(path, entry.version, total)
+        for attempt in range(max_rounds):
+            if (attempt > 0):
+                self._count_resent(total, received)
+            await self.scheduler.submit(
+                filename,
+                self._iter_file_sends(path, entry.version, received,
+                                      source=filename),
+                priority,
+            )
+
+            # Without an answer there is no telling what is missing
+            received = await self._ask_file_chunks(
+                path, entry.version, total)
+            if (received is None):
+                break
+            if (received.complete()):
+                self._sent_versions[filename] = entry.version
+                return True
+
+        # Left unrecorded so the next update of the file sends it again
+        self.warning('Server did not receive all of %s', filename)
+        return False
+
+    async def sync_tree(self, root, paths=None, priority=PRIORITY_BACKGROUND,
+                        max_rounds=DEFAULT_MAX_ROUNDS):
+        """Sends a tree to the server as a single compressed archive, which
+        the server unpacks as it arrives, instead of one transfer per file.
+        Files sent are recorded in the index so later updates of them are
+        skipped until they change.
+
+        :param root: The local path of the directory to send, which must be
+                     beneath the root
+        :param paths: If provided, the paths relative to the root of the
+                      files to send, otherwise every file beneath the root
+        :param priority: The priority class of the transfer
+        :param max_rounds: The number of times chunks the server is missing
+                           are resent before giving up
+        :returns: The number of files sent, or None if the directory is not
+                  beneath the root or the server did not receive the whole
+                  archive
+        """
+        root = os.path.abspath(root)
+        remote_root = self.remote_path(root)
+        if (remote_root is None):
+            self.warning('Not sending %s outside of %s', root, self.root)
+            return None
+        if (paths is None):
+            dir_index = DirectoryIndex(root)
+            await self.loop.run_in_executor(None, dir_index.build)
+            paths = [path for path, _, _ in dir_index.iter_entries()]
+
+        # The archive is spooled so its length is known up front and lost
+        # chunks can be resent from it
+        fd, archive_path = tempfile.mkstemp(prefix='remote-',
+                                            suffix='.tar.gz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                files = await self.loop.run_in_executor(
+                    None, write_archive, root, paths, f)
+            length = os.path.getsize(archive_path)
+            total = count_chunks(length)
+            self._archive_version += 1
+            version = self._archive_version
+            self.debug('Sending %s files from %s in %s chunks',
+                       len(files), root, total)
+
+            received = None
+            for attempt in range(max_rounds):
+                if (attempt > 0):
+                    self._count_resent(total, received)
+                self.send_packet(build_update_archive_start(
+                    username=self.info['username'],
+                    session=self.info['session'],
+                    root=remote_root,
+                    version=version,
+                    file_length=length,
+                    total_chunks=total,
+                    chunk_size=CHUNK_SIZE,
+                ))
+                await self.scheduler.submit(root, self._iter_file_sends(
+                    remote_root, version, received,
+                    source=archive_path,
+                    build=build_update_archive_data,
+                ), priority)
+                received = await self._ask_file_chunks(
+                    remote_root, version, total)
+                if (received is not None and received.complete()):
+                    break
+            else:
+                self.warning('Server did not receive archive of %s', root)
+                return None
+        finally:
+            os.unlink(archive_path)
+
+        for path, size, mtime_ns, digest in files:
+            entry = self.index.update(
+                os.path.join(root, path), size, mtime_ns, digest)
+            self._sent_versions[entry.path] = entry.version
+        self.index.flush()
+        return len(files)
+
+    def _count_resent(self, total, received):
+        # Every chunk the server is missing is sent again
+        missing = total
+        if (received is not None):
+            missing -= received.count()
+        self._resent.inc(missing)
+
+    def _iter_file_sends(self, filename, version, received, source=None,
+                         build=build_update_file_data):
+        """Sends the chunks of a file straight from a memory map of it, one
+        chunk per step so the scheduler can interleave other transfers.
+
+        :param filename: The path of the file as known by the server
+        :param version: The version of the file being sent
+        :param received: If provided, the bitmap of chunks to skip
+        :param source: If provided, the path of the file to read the chunks
+                       from instead of the file being updated
+        :param build: The function building the packet of a chunk
+        :returns: A generator of the number of bytes sent per step
+        """
+        chunks = iter_file_chunks(source if (source is not None)
+                                  else filename)
+        try:
+            for index, total, data in chunks:
+                if (received is not None and received.has(index)):
+                    continue
+                self.send_packet(build(
+                    self.info['username'],
+                    self.info['session'],
+                    filename,
+                    version,
+                    chunk_index=index,
+                    total_chunks=total,
+                    data=data,
+                ))
+                n = len(data)
+                del data
+                yield n
+        finally:
+            chunks.close()
+
+    async def _ask_file_chunks(self, filename, version, total):
+        """Asks the server which chunks of a file it already has.
+
+        :param filename: The path of the file as known by the server
+        :param version: The version of the file being sent
+        :param total: The total number of chunks of the file
+        :returns: The bitmap of received chunks, or None if unknown
+        """
+        answer = await self.ask(build_ask_file_chunks(
+            username=self.info['username'],
+            session=self.info['session'],
+            file_path=filename,
+            file_version=version,
+            total_chunks=total,
+        ))
+        if (answer is None):
+            return None
+
+        bitmap = answer.get_content().get_data()
+        if (not isinstance(bitmap, bytes)):
+            return None
+        received = ChunkBitmap.from_bytes(total, bitmap)
+        if (received.count() > 0):
+            self.debug('Resuming %s with %s of %s chunks already sent',
+                       filename, received.count(), total)
+        return received
 
     def run(self, cb):
         """Starts the remote client, adding it to the event loop and running
@@ -84,17 +639,25 @@ class RemoteClient(logger.LoggingMixin):
 
         :param cb: The callback to invoke when the client is ready
         """
-        self.loop = asyncio.get_event_loop()
+        if (self.capture_path is not None):
+            self.capture = CaptureWriter(self.capture_path)
         connect = self.loop.create_datagram_endpoint(
-            lambda: RemoteClientProtocol(self.nvim, self.hmac),
+            lambda: RemoteClientProtocol(self.nvim, self.hmac,
+                                         self.buffer_sync, self.cache,
+                                         self.capture),
             remote_addr=(self.info['addr'], self.info['port'])
         )
 
         def ready(future):
             transport, protocol = future.result()
-            self.transport = transport
             self.protocol = protocol
 
+            # Sends go through the transport of the protocol so they can be
+            # captured
+            self.transport = transport
+            if (protocol is not None and protocol.transport is not None):
+                self.transport = protocol.transport
+
             err = None
             if (transport is None or protocol is None):
                 err = Exception('Failed to connect to {}:{}'
@@ -105,24 +668,252 @@ class RemoteClient(logger.LoggingMixin):
 
     def stop(self):
         """Stops the remote client, removing it from the event loop."""
+        self.scheduler.clear()
+        if (self.prefetcher is not None):
+            self.prefetcher.cancel()
+            self.prefetcher = None
+        if (self.buffer_sync is not None):
+            self.buffer_sync.stop()
+            self.buffer_sync = None
         if (self.transport is not None):
             self.transport.close()
             self.transport = None
+        if (self.protocol is not None):
+            self.protocol.remove_gauges()
         self.protocol = None
+        metrics.remove('client.transfers_pending', self._pending_gauge)
+        metrics.remove('client.rtt.{}'.format(self.info['session']))
+        self.index.close()
+        if (self.cache is not None):
+            self.cache.flush()
+        if (self.capture is not None):
+            self.capture.close()
+            self.capture = None
+
+
+class FileListStream(object):
+    def __init__(self, client, packet, timeout):
+        """Creates a new async iterator over the entries of a list, such as
+        a file list, answered as a series of pages, which may arrive in any
+        order.
+
+        :param client: The client to send the ask packet with
+        :param packet: The ask packet to send on first iteration
+        :param timeout: The number of seconds to wait for each page, after
+                        which asyncio.TimeoutError is raised
+        """
+        self._client = client
+        self._packet = packet
+        self._timeout = timeout
+        self._queue = None
+        self._pages = {}
+        self._next_page = 0
+        self._last_page = None
+        self._entries = deque()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if (self._queue is None):
+            handler = self._client.protocol.handler
+            self._queue = handler.expect_stream(self._packet)
+            self._client.send_packet(self._packet)
+
+        while not self._entries:
+            if (self._last_page is not None and
+                    self._next_page > self._last_page):
+                self.close()
+                raise StopAsyncIteration
+            if (self._next_page in self._pages):
+                self._entries.extend(self._pages.pop(self._next_page))
+                self._next_page += 1
+                continue
+
+            try:
+                p = await asyncio.wait_for(self._queue.get(), self._timeout)
+            except asyncio.TimeoutError:
+                self.close()
+                raise
+
+            m = p.get_metadata()
+            index = m.get_value(MESSAGE_METADATA_PAGE_INDEX)
+            if (index is None or index < self._next_page):
+                continue
+            if (m.get_value(MESSAGE_METADATA_LAST_PAGE)):
+                self._last_page = index
+            entries = p.get_content().get_data()
+            if (not isinstance(entries, list)):
+                entries = MESSAGE_DEFAULT_FILE_LIST
+            self._pages[index] = entries
+
+        return self._entries.popleft()
+
+    def close(self):
+        """Stops receiving pages of the file list."""
+        if (self._client.protocol is not None):
+            self._client.protocol.handler.forget_answer(self._packet)
+
+
+class CommandStream(object):
+    def __init__(self, client, packet, timeout=DEFAULT_OUTPUT_TIMEOUT,
+                 ack_every=DEFAULT_ACK_EVERY):
+        """Creates a new async iterator over the output of a command run on
+        the server, delivered in order and acknowledged as it arrives so the
+        server can keep sending.
+
+        :param client: The client to send packets with
+        :param packet: The ask packet to send on first iteration
+        :param timeout: If provided, the number of seconds to wait for each
+                        packet, after which asyncio.TimeoutError is raised
+        :param ack_every: The number of packets inbetween acknowledgements
+        """
+        self._client = client
+        self._packet = packet
+        self._timeout = timeout
+        self._ack_every = ack_every
+        self._queue = None
+        self._next = 0
+        self._unacked = 0
+        self._pending = {}
+        self._output = deque()
+        self.exit_code = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if (self._queue is None):
+            handler = self._client.protocol.handler
+            self._queue = handler.expect_stream(self._packet)
+            self._client.send_packet(self._packet)
+
+        while not self._output:
+            if (self.exit_code is not None):
+                self.close()
+                raise StopAsyncIteration
+
+            try:
+                p = await asyncio.wait_for(self._queue.get(), self._timeout)
+            except asyncio.TimeoutError:
+                self.close()
+                raise
+            self._receive(p)
+
+        return self._output.popleft()
+
+    async def wait(self):
+        """Waits for the command to exit, discarding remaining output.
+
+        :returns: The exit code of the command
+        """
+        async for _ in self:
+            pass
+        return self.exit_code
+
+    def cancel(self):
+        """Asks the server to stop the command."""
+        if (self._queue is not None and self.exit_code is None):
+            h = self._packet.get_header()
+            self._client.send_packet(build_tell_command_cancel(
+                username=h.get_username(),
+                session=h.get_session(),
+                parent_header=h,
+            ))
+
+    def close(self):
+        """Stops receiving output of the command."""
+        if (self._client.protocol is not None):
+            self._client.protocol.handler.forget_answer(self._packet)
+
+    def _receive(self, p):
+        m = p.get_metadata()
+        seq = m.get_value(MESSAGE_METADATA_SEQUENCE)
+        if (seq is None):
+            return
+
+        # A repeat means the server missed an acknowledgement
+        if (seq < self._next):
+            self._ack()
+            return
+
+        data = p.get_content().get_data()
+        if (not isinstance(data, bytes)):
+            data = MESSAGE_DEFAULT_COMMAND_OUTPUT
+        self._pending[seq] = (
+            m.get_value(MESSAGE_METADATA_OUTPUT_STREAM),
+            data,
+            m.get_value(MESSAGE_METADATA_EXIT_CODE),
+        )
+        while self._next in self._pending:
+            stream, data, exit_code = self._pending.pop(self._next)
+            self._next += 1
+            self._unacked += 1
+            if (stream == COMMAND_STREAM_EXIT):
+                self.exit_code = exit_code if (exit_code is not None) else -1
+            elif (data):
+                self._output.append((stream, data))
+
+        if (self._unacked >= self._ack_every or self.exit_code is not None):
+            self._ack()
+
+    def _ack(self):
+        self._unacked = 0
+        h = self._packet.get_header()
+        self._client.send_packet(build_tell_command_ack(
+            username=h.get_username(),
+            session=h.get_session(),
+            parent_header=h,
+            sequence=self._next - 1,
+        ))
 
 
 class RemoteClientProtocol(DatagramProtocol, logger.LoggingMixin):
-    def __init__(self, nvim, hmac):
+    def __init__(self, nvim, hmac, buffer_sync=None, cache=None,
+                 capture=None):
         self.nvim = nvim
         self.hmac = hmac
+
+        # If provided, the capture writer recording every datagram
+        self.capture = capture
         self.handler = ClientHandler(
             nvim=nvim,
-            send=lambda data: self.transport.send(data),
+            send=lambda packet: self.transport.sendto(
+                packet.gen_signature(self.hmac).to_bytes()),
+            buffer_sync=buffer_sync,
+            cache=cache,
         )
         self.is_debug_enabled = True
         self.transport = None
 
+        # Traffic of every client
+        self._packets_in = metrics.counter('client.packets_in')
+        self._bytes_in = metrics.counter('client.bytes_in')
+        self._packets_out = metrics.counter('client.packets_out')
+        self._bytes_out = metrics.counter('client.bytes_out')
+        self._invalid = metrics.counter('client.invalid_dropped')
+        self._malformed = metrics.counter('client.malformed_dropped')
+
+        # Map of name -> function of the gauges reading the depth of each
+        # queue of packets
+        self.gauges = {}
+        registry = self.handler.registry
+        for packet_type in registry.queue_types():
+            name = 'client.queued.{}'.format(packet_type_name(packet_type))
+            fn = self.gauges[name] = partial(registry.queued, packet_type)
+            metrics.gauge(name, fn)
+
+    def remove_gauges(self):
+        """Removes the gauges reading the queues, unless taken over by
+        another protocol, so the registry does not keep this one."""
+        for name, fn in self.gauges.items():
+            metrics.remove(name, fn)
+
     def connection_made(self, transport):
+        transport = metrics.MeteredTransport(
+            transport, self._packets_out, self._bytes_out)
+        if (self.capture is not None):
+            transport = CaptureTransport(transport, self.capture)
         self.transport = transport
         self.nvim.async_call(lambda nvim, transport: nvim.out_write(
             'Established connection to %s\n' % transport),
@@ -135,6 +926,10 @@ class RemoteClientProtocol(DatagramProtocol, logger.LoggingMixin):
         # If no transport, drop the packet
         if (self.transport is not None):
             packet = None
+            self._packets_in.inc()
+            self._bytes_in.inc(len(data))
+            if (self.capture is not None):
+                self.capture.write(DIRECTION_IN, addr, data)
 
             try:
                 packet = Packet.read(data)
@@ -143,8 +938,10 @@ class RemoteClientProtocol(DatagramProtocol, logger.LoggingMixin):
                 if (is_valid):
                     self.handler.process(packet)
                 elif (not is_valid):
-                    self.error('Dropping invalid packet: %s\n'.format(packet))
+                    self._invalid.inc()
+                    self.error('Dropping invalid packet: %s', packet)
                 else:
-                    self.error('Dropping unknown packet: %s\n'.format(packet))
+                    self.error('Dropping unknown packet: %s', packet)
             except Exception as ex:
-                self.error('Unexpected failure: %s\n'.format(ex))
+                self._malformed.inc()
+                self.error('Unexpected failure: %s', ex)
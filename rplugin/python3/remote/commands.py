@@ -0,0 +1,261 @@
+# =============================================================================
+# FILE: commands.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+import signal
+from asyncio.subprocess import DEVNULL, PIPE
+from collections import OrderedDict
+from . import logger, metrics
+from .constants import (
+    COMMAND_STREAM_EXIT,
+    COMMAND_STREAM_STDERR,
+    COMMAND_STREAM_STDOUT,
+)
+
+# Default maximum number of commands run at the same time per session,
+# with any more waiting for a slot
+DEFAULT_MAX_COMMANDS = 4
+
+# Default maximum number of output packets sent but not yet acknowledged
+DEFAULT_WINDOW = 32
+
+# Number of output packets received inbetween acknowledgements
+DEFAULT_ACK_EVERY = DEFAULT_WINDOW // 4
+
+# Number of seconds to wait for an acknowledgement before resending
+DEFAULT_ACK_TIMEOUT = 1.0
+
+# Number of resends without an acknowledgement before giving up
+DEFAULT_MAX_RETRIES = 5
+
+# Maximum number of bytes of output sent within a single packet
+DEFAULT_READ_SIZE = 16 * 1024
+
+# Number of seconds a cancelled command has to exit before being killed
+DEFAULT_KILL_GRACE = 2.0
+
+# Number of seconds a client waits for the next output of a command before
+# giving up on it
+DEFAULT_OUTPUT_TIMEOUT = 300.0
+
+# Exit code reported when a command could not be started
+EXIT_CODE_NOT_STARTED = 127
+
+
+class CommandLost(Exception):
+    """Raised when the client stops acknowledging the output of a command."""
+
+
+class _Command(object):
+    def __init__(self, key, session, send):
+        self.key = key
+        self.session = session
+        self.send = send
+        self.task = None
+        self.process = None
+        self.sequence = 0
+        self.unacked = OrderedDict()
+        self.credit = asyncio.Event()
+        self.retries = 0
+        self.cancelled = False
+
+        # Whether or not the exit of a cancelled command goes unconfirmed,
+        # such as when shutting down
+        self.abandoned = False
+
+
+class CommandRunner(logger.LoggingMixin):
+    def __init__(self, loop, cwd=None, max_per_session=DEFAULT_MAX_COMMANDS,
+                 window=DEFAULT_WINDOW, ack_timeout=DEFAULT_ACK_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 read_size=DEFAULT_READ_SIZE, kill_grace=DEFAULT_KILL_GRACE):
+        """Creates a new runner of commands whose output is streamed back as
+        it is written. At most a window of output is unacknowledged at a
+        time, and while the window is full the command's pipes are not read
+        so a chatty command is slowed to the pace of the link.
+
+        :param loop: The event loop to run commands on
+        :param cwd: The directory commands are run within
+        :param max_per_session: The maximum number of commands run at the
+                                same time for a single session
+        :param window: The maximum number of unacknowledged output packets
+        :param ack_timeout: The number of seconds to wait for an
+                            acknowledgement before resending output
+        :param max_retries: The number of resends without acknowledgement
+                            after which the command is killed
+        :param read_size: The maximum number of bytes of output per packet
+        :param kill_grace: The number of seconds a cancelled command has to
+                           exit before being killed
+        """
+        self._loop = loop
+        self._cwd = cwd
+        self._max_per_session = max_per_session
+        self._window = window
+        self._ack_timeout = ack_timeout
+        self._max_retries = max_retries
+        self._read_size = read_size
+        self._kill_grace = kill_grace
+        self._resent = metrics.counter('server.command_output_resent')
+        self._commands = {}
+        self._slots = {}
+        self.is_debug_enabled = True
+
+    def start(self, session, key, name, args, send):
+        """Starts a command, ignoring repeats of the same request.
+
+        :param session: The session of the client running the command
+        :param key: The key identifying the command
+        :param name: The name of the program to run
+        :param args: The list of arguments to the program
+        :param send: The function taking a sequence, stream, data, and exit
+                     code (None but for the final packet) that sends a
+                     packet of output to the client
+        :returns: The task running the command
+        """
+        cmd = self._commands.get(key)
+        if (cmd is None):
+            cmd = self._commands[key] = _Command(key, session, send)
+            cmd.task = self._loop.create_task(self._run(cmd, name, args))
+        return cmd.task
+
+    def ack(self, key, sequence):
+        """Acknowledges all output of a command up to a sequence.
+
+        :param key: The key identifying the command
+        :param sequence: The sequence up to which output was received
+        """
+        cmd = self._commands.get(key)
+        if (cmd is None):
+            return
+        for s in list(cmd.unacked):
+            if (s > sequence):
+                break
+            del cmd.unacked[s]
+        cmd.retries = 0
+        cmd.credit.set()
+
+    def cancel(self, key):
+        """Cancels a command, stopping its process.
+
+        :param key: The key identifying the command
+        :returns: True if a command was cancelled, otherwise False
+        """
+        cmd = self._commands.get(key)
+        if (cmd is None):
+            return False
+        if (not cmd.cancelled):
+            cmd.cancelled = True
+            cmd.task.cancel()
+        return True
+
+    def cancel_all(self):
+        """Cancels every command without waiting for clients to
+        acknowledge their exit."""
+        for cmd in list(self._commands.values()):
+            cmd.cancelled = True
+            cmd.abandoned = True
+            cmd.task.cancel()
+
+    def running(self, session=None):
+        """Returns the keys of the commands not yet finished.
+
+        :param session: If provided, only includes commands of the session
+        :returns: A list of keys
+        """
+        return [k for k, c in self._commands.items()
+                if session is None or c.session == session]
+
+    async def _run(self, cmd, name, args):
+        slots = self._slots.get(cmd.session)
+        if (slots is None):
+            slots = self._slots[cmd.session] = asyncio.Semaphore(
+                self._max_per_session)
+        try:
+            async with slots:
+                exit_code = await self._execute(cmd, name, args)
+            await self._emit(cmd, COMMAND_STREAM_EXIT, b'', exit_code)
+            await self._drain(cmd)
+        except asyncio.CancelledError:
+            # Let the client know, resending any output it is missing until
+            # it hears unless shutting down
+            await self._stop(cmd)
+            code = cmd.process.returncode if (cmd.process) else None
+            self._send(cmd, COMMAND_STREAM_EXIT, b'',
+                       code if (code is not None) else -signal.SIGTERM)
+            if (not cmd.abandoned):
+                try:
+                    await self._drain(cmd)
+                except CommandLost:
+                    self.warning('Client stopped acknowledging %s', cmd.key)
+        except CommandLost:
+            self.warning('Client stopped acknowledging %s', cmd.key)
+            await self._stop(cmd)
+        finally:
+            self._commands.pop(cmd.key, None)
+
+    async def _execute(self, cmd, name, args):
+        try:
+            cmd.process = await asyncio.create_subprocess_exec(
+                name, *args,
+                stdin=DEVNULL, stdout=PIPE, stderr=PIPE, cwd=self._cwd)
+        except OSError as ex:
+            await self._emit(cmd, COMMAND_STREAM_STDERR,
+                             '{}\n'.format(ex).encode('utf-8'))
+            return EXIT_CODE_NOT_STARTED
+
+        await asyncio.gather(
+            self._pump(cmd, cmd.process.stdout, COMMAND_STREAM_STDOUT),
+            self._pump(cmd, cmd.process.stderr, COMMAND_STREAM_STDERR),
+        )
+        return await cmd.process.wait()
+
+    async def _pump(self, cmd, reader, stream):
+        while True:
+            data = await reader.read(self._read_size)
+            if (not data):
+                return
+            await self._emit(cmd, stream, data)
+
+    async def _emit(self, cmd, stream, data, exit_code=None):
+        while len(cmd.unacked) >= self._window:
+            await self._wait_for_ack(cmd)
+        self._send(cmd, stream, data, exit_code)
+
+    def _send(self, cmd, stream, data, exit_code=None):
+        seq = cmd.sequence
+        cmd.sequence += 1
+        cmd.unacked[seq] = (seq, stream, data, exit_code)
+        cmd.send(seq, stream, data, exit_code)
+
+    async def _drain(self, cmd):
+        while cmd.unacked:
+            await self._wait_for_ack(cmd)
+
+    async def _wait_for_ack(self, cmd):
+        cmd.credit.clear()
+        try:
+            await asyncio.wait_for(cmd.credit.wait(), self._ack_timeout)
+        except asyncio.TimeoutError:
+            cmd.retries += 1
+            if (cmd.retries > self._max_retries):
+                raise CommandLost(cmd.key)
+
+            # Output or its acknowledgement was lost, so resend the window
+            for args in list(cmd.unacked.values()):
+                cmd.send(*args)
+            self._resent.inc(len(cmd.unacked))
+
+    async def _stop(self, cmd):
+        p = cmd.process
+        if (p is None or p.returncode is not None):
+            return
+        try:
+            p.terminate()
+            await asyncio.wait_for(asyncio.shield(p.wait()), self._kill_grace)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            p.kill()
+            await p.wait()
@@ -9,59 +9,115 @@
 ###############################################################################
 
 # Represents overall packet api version
-PACKET_API_VERSION = '0.1'
+PACKET_API_VERSION = '0.2'
 
 ###############################################################################
 # PACKET TYPE HELPERS
 ###############################################################################
 
+# Packet types travel as integer codes whose low bits hold the kind of the
+# packet and whose high bits number the type, so an ask and its answer
+# share a number
+PACKET_KIND_BITS = 2
+PACKET_KIND_MASK = (1 << PACKET_KIND_BITS) - 1
+PACKET_KIND_TELL = 1
+PACKET_KIND_ASK = 2
+PACKET_KIND_ANSWER = 3
+
+# Number of distinct packet type codes, sizing the tables indexed by them
+PACKET_TYPE_LIMIT = 1 << 8
+PACKET_TYPE_MASK = PACKET_TYPE_LIMIT - 1
+
+# Map of packet type code -> name, used when logging
+PACKET_TYPE_NAMES: dict[int, str] = {}
+
 _TELL_SUFFIX = '_TELL'
 _ASK_SUFFIX = '_ASK'
 _ANSWER_SUFFIX = '_ANSWER'
 
 
-def _tell(text): return text + _TELL_SUFFIX
+def _code(name, number, kind):
+    code = (number << PACKET_KIND_BITS) | kind
+    assert code < PACKET_TYPE_LIMIT and code not in PACKET_TYPE_NAMES
+    PACKET_TYPE_NAMES[code] = name
+    return code
+
+
+def _tell(text, number):
+    return _code(text + _TELL_SUFFIX, number, PACKET_KIND_TELL)
+
 
+def _ask(text, number):
+    return _code(text + _ASK_SUFFIX, number, PACKET_KIND_ASK)
 
-def _ask(text): return text + _ASK_SUFFIX
 
+def _answer(text, number):
+    return _code(text + _ANSWER_SUFFIX, number, PACKET_KIND_ANSWER)
 
-def _answer(text): return text + _ANSWER_SUFFIX
+
+# Kind of packet represented by the packet type
+def kind_of(packet_type): return packet_type & PACKET_KIND_MASK
 
 
 # True if packet type represents a packet with no answer expected
-def is_tell(packet_type): return packet_type.endswith(_TELL_SUFFIX)
+def is_tell(packet_type): return kind_of(packet_type) == PACKET_KIND_TELL
 
 
 # True if packet type represents a packet expecting an answer
-def is_ask(packet_type): return packet_type.endswith(_ASK_SUFFIX)
+def is_ask(packet_type): return kind_of(packet_type) == PACKET_KIND_ASK
 
 
 # True if packet type represents an answer to an ask packet
-def is_answer(packet_type): return packet_type.endswith(_ANSWER_SUFFIX)
+def is_answer(packet_type): return kind_of(packet_type) == PACKET_KIND_ANSWER
+
+
+def packet_type_name(packet_type):
+    """Returns the name of a packet type for logging, or the type itself if
+    it is not a known code."""
+    if (not isinstance(packet_type, int)):
+        return packet_type
+    return PACKET_TYPE_NAMES.get(packet_type, packet_type)
 
 
 ###############################################################################
 # PACKET TYPE CONSTANTS
 ###############################################################################
 
-PACKET_TYPE_TELL_ERROR = _tell('ERROR')
-PACKET_TYPE_TELL_FILE_CHANGED = _tell('FILE_CHANGED')
-PACKET_TYPE_TELL_HEARTBEAT = _tell('HEARTBEAT')
-
-PACKET_TYPE_ASK_COMMAND = _ask('COMMAND')
-PACKET_TYPE_ASK_FILE_LIST = _ask('FILE_LIST')
-
-PACKET_TYPE_ANSWER_COMMAND = _answer('COMMAND')
-PACKET_TYPE_ANSWER_ERROR = _answer('ERROR')
-PACKET_TYPE_ANSWER_FILE_LIST = _answer('FILE_LIST')
-
-PACKET_TYPE_RETRIEVE_FILE_ASK = 'RETRIEVE_FILE'
-PACKET_TYPE_RETRIEVE_FILE = 'RETRIEVE_FILE'
-PACKET_TYPE_UPDATE_FILE_START = 'UPDATE_FILE_START'
-PACKET_TYPE_UPDATE_FILE_START = 'UPDATE_FILE_START'
-PACKET_TYPE_UPDATE_FILE_DATA = 'UPDATE_FILE_DATA'
-PACKET_TYPE_UPDATE_FILE_DATA = 'UPDATE_FILE_DATA'
+# Numbers are part of the wire format, so existing ones must never change
+
+PACKET_TYPE_TELL_BUFFER_CHECKSUM = _tell('BUFFER_CHECKSUM', 1)
+PACKET_TYPE_TELL_BUFFER_DRIFT = _tell('BUFFER_DRIFT', 2)
+PACKET_TYPE_TELL_BUFFER_EDIT = _tell('BUFFER_EDIT', 3)
+PACKET_TYPE_TELL_COMMAND_ACK = _tell('COMMAND_ACK', 4)
+PACKET_TYPE_TELL_COMMAND_CANCEL = _tell('COMMAND_CANCEL', 5)
+PACKET_TYPE_TELL_ERROR = _tell('ERROR', 6)
+PACKET_TYPE_TELL_FILE_CHANGED = _tell('FILE_CHANGED', 7)
+PACKET_TYPE_TELL_HEARTBEAT = _tell('HEARTBEAT', 8)
+
+PACKET_TYPE_ASK_COMMAND = _ask('COMMAND', 9)
+PACKET_TYPE_ASK_FILE_CHUNKS = _ask('FILE_CHUNKS', 10)
+PACKET_TYPE_ASK_FILE_LIST = _ask('FILE_LIST', 11)
+PACKET_TYPE_ASK_FILE_VERSION = _ask('FILE_VERSION', 12)
+PACKET_TYPE_ASK_TREE = _ask('TREE', 13)
+
+PACKET_TYPE_ANSWER_COMMAND = _answer('COMMAND', 9)
+PACKET_TYPE_ANSWER_ERROR = _answer('ERROR', 6)
+PACKET_TYPE_ANSWER_FILE_CHUNKS = _answer('FILE_CHUNKS', 10)
+PACKET_TYPE_ANSWER_FILE_LIST = _answer('FILE_LIST', 11)
+PACKET_TYPE_ANSWER_FILE_VERSION = _answer('FILE_VERSION', 12)
+PACKET_TYPE_ANSWER_TREE = _answer('TREE', 13)
+
+PACKET_TYPE_RETRIEVE_FILE_ASK = _code('RETRIEVE_FILE_ASK', 14,
+                                      PACKET_KIND_ASK)
+PACKET_TYPE_RETRIEVE_FILE = _code('RETRIEVE_FILE', 14, PACKET_KIND_ANSWER)
+PACKET_TYPE_UPDATE_FILE_START = _code('UPDATE_FILE_START', 15,
+                                      PACKET_KIND_TELL)
+PACKET_TYPE_UPDATE_FILE_DATA = _code('UPDATE_FILE_DATA', 16,
+                                     PACKET_KIND_TELL)
+PACKET_TYPE_UPDATE_ARCHIVE_START = _code('UPDATE_ARCHIVE_START', 17,
+                                         PACKET_KIND_TELL)
+PACKET_TYPE_UPDATE_ARCHIVE_DATA = _code('UPDATE_ARCHIVE_DATA', 18,
+                                        PACKET_KIND_TELL)
 
 ###############################################################################
 # BASE CONSTANTS
@@ -70,13 +126,41 @@ PACKET_TYPE_UPDATE_FILE_DATA = 'UPDATE_FILE_DATA'
 MESSAGE_DEFAULT_USERNAME = '<UNKNOWN>'
 MESSAGE_DEFAULT_SESSION = '<UNKNOWN>'
 
+###############################################################################
+# BUFFER CONSTANTS
+###############################################################################
+
+# Represents buffer edit/checksum metadata
+MESSAGE_METADATA_CHANGEDTICK = 'K'
+MESSAGE_METADATA_CHECKSUM = 'H'
+
+# Defaults for non-provided data
+MESSAGE_DEFAULT_BUFFER_EDITS: list[list] = []
+MESSAGE_DEFAULT_CHANGEDTICK = -1
+MESSAGE_DEFAULT_CHECKSUM = -1
+
 ###############################################################################
 # COMMAND CONSTANTS
 ###############################################################################
 
+# Represents command request/output metadata
+MESSAGE_METADATA_COMMAND_NAME = 'X'
+MESSAGE_METADATA_COMMAND_ARGS = 'R'
+MESSAGE_METADATA_SEQUENCE = 'Q'
+MESSAGE_METADATA_OUTPUT_STREAM = 'S'
+MESSAGE_METADATA_EXIT_CODE = 'Z'
+
+# Streams of command output; the final packet of a command carries its exit
+# code on the exit stream
+COMMAND_STREAM_EXIT = 0
+COMMAND_STREAM_STDOUT = 1
+COMMAND_STREAM_STDERR = 2
+
 # Defaults for non-provided data
 MESSAGE_DEFAULT_COMMAND_NAME = '<NAME>'
 MESSAGE_DEFAULT_COMMAND_ARGS = '<ARGS>'
+MESSAGE_DEFAULT_COMMAND_OUTPUT = b''
+MESSAGE_DEFAULT_SEQUENCE = -1
 
 ###############################################################################
 # ERROR CONSTANTS
@@ -90,12 +174,18 @@ MESSAGE_DEFAULT_ERROR_TEXT = '<ERROR>'
 ###############################################################################
 
 # Common metadata across file information
+MESSAGE_METADATA_FILE_PATH = 'P'
 MESSAGE_METADATA_FILE_VERSION = 'V'
 
 # Represents file retrieval/update metadata
 MESSAGE_METADATA_FILE_LENGTH = 'L'
 MESSAGE_METADATA_TOTAL_CHUNKS = 'T'
 MESSAGE_METADATA_CHUNK_INDEX = 'I'
+MESSAGE_METADATA_CHUNK_SIZE = 'C'
+
+# Represents file list metadata
+MESSAGE_METADATA_PAGE_INDEX = 'N'
+MESSAGE_METADATA_LAST_PAGE = 'E'
 
 # Defaults for not-provided data
 MESSAGE_DEFAULT_FILE_PATH = ''
@@ -106,3 +196,4 @@ MESSAGE_DEFAULT_TOTAL_CHUNKS = 1
 MESSAGE_DEFAULT_CHUNK_INDEX = 0
 MESSAGE_DEFAULT_CHUNK_DATA = b''
 MESSAGE_DEFAULT_CHUNKS_RECEIVED = 0
+MESSAGE_DEFAULT_CHUNK_BITMAP = b''
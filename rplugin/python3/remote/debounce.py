@@ -0,0 +1,111 @@
+# =============================================================================
+# FILE: debounce.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+from . import logger
+
+
+class CoalescingQueue(logger.LoggingMixin):
+    def __init__(self, loop, callback, window=0.1, wheel=None):
+        """Creates a new queue that collapses repeated events per key.
+
+        :param loop: The event loop used to schedule callbacks
+        :param callback: The function to invoke with the key once its events
+                         settle; if it returns an awaitable, the awaitable is
+                         tracked as in-flight and cancelled when superseded
+        :param window: The number of seconds to wait after the latest event
+                       for a key before invoking the callback
+        :param wheel: If provided, the timing wheel to schedule the windows
+                      of keys on instead of a loop callback per key
+        """
+        self._loop = loop
+        self._timers = wheel if (wheel is not None) else loop
+        self._callback = callback
+        self._window = window
+        self._pending = {}
+        self._in_flight = {}
+        self.is_debug_enabled = True
+
+    def push(self, key):
+        """Records an event for a key, restarting its debounce window.
+
+        :param key: The key (such as a path) the event is for
+        :returns: The updated queue
+        """
+        handle = self._pending.get(key)
+        if (handle is not None):
+            handle.cancel()
+        self._pending[key] = self._timers.call_later(
+            self._window, self._fire, key)
+        return self
+
+    def cancel(self, key):
+        """Cancels any pending event and in-flight work for a key.
+
+        :param key: The key whose work to cancel
+        :returns: The updated queue
+        """
+        handle = self._pending.pop(key, None)
+        if (handle is not None):
+            handle.cancel()
+        task = self._in_flight.pop(key, None)
+        if (task is not None):
+            task.cancel()
+        return self
+
+    def clear(self):
+        """Cancels all pending events and in-flight work.
+
+        :returns: The updated queue
+        """
+        for key in set(self._pending) | set(self._in_flight):
+            self.cancel(key)
+        return self
+
+    def pending(self):
+        """Returns the keys waiting for their debounce window to elapse.
+
+        :returns: A list of keys
+        """
+        return list(self._pending)
+
+    def in_flight(self):
+        """Returns the keys whose work is still running.
+
+        :returns: A list of keys
+        """
+        return list(self._in_flight)
+
+    def window(self):
+        """Returns the debounce window in seconds.
+
+        :returns: The number of seconds
+        """
+        return self._window
+
+    def _fire(self, key):
+        del self._pending[key]
+
+        # Newer event supersedes whatever is still being sent for the key
+        task = self._in_flight.pop(key, None)
+        if (task is not None and not task.done()):
+            self.debug('Cancelling superseded work for %s', key)
+            task.cancel()
+
+        try:
+            result = self._callback(key)
+        except Exception as ex:
+            self.error('Failed to process %s: %s', key, ex)
+            return
+
+        if (result is not None and (asyncio.iscoroutine(result) or
+                                    asyncio.isfuture(result))):
+            task = asyncio.ensure_future(result, loop=self._loop)
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+
+    def _done(self, key, task):
+        if (self._in_flight.get(key) is task):
+            del self._in_flight[key]
@@ -0,0 +1,196 @@
+# =============================================================================
+# FILE: dirindex.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import fnmatch
+import os
+from . import logger
+from .packet import MAX_CONTENT_SIZE
+
+# Names never indexed by default
+DEFAULT_IGNORE = ['.git', '.hg', '.svn', '__pycache__', '*.part']
+
+# Estimated msgpack overhead of a single [path, size, mtime_ns] entry
+_ENTRY_OVERHEAD = 24
+
+
+class DirectoryIndex(logger.LoggingMixin):
+    def __init__(self, root, ignore=None):
+        """Creates a new in-memory index of the files beneath a directory,
+        built once and then kept current through incremental updates.
+
+        :param root: The directory to index
+        :param ignore: The list of glob patterns of names to skip, defaulting
+                       to DEFAULT_IGNORE
+        """
+        self.root = os.path.abspath(root)
+        self.ignore = list(DEFAULT_IGNORE if (ignore is None) else ignore)
+        self.is_debug_enabled = True
+
+        # Map of directory relative to root -> {name: (size, mtime_ns)} of
+        # the files within; a directory with no files still has an entry
+        self._dirs = None
+
+    def is_built(self):
+        return self._dirs is not None
+
+    def is_ignored(self, path):
+        """Checks if any component of a path is ignored.
+
+        :param path: The path relative to the root
+        :returns: True if ignored, otherwise False
+        """
+        for name in path.split(os.sep):
+            for pattern in self.ignore:
+                if (fnmatch.fnmatch(name, pattern)):
+                    return True
+        return False
+
+    def build(self):
+        """Walks the directory once to fill the index.
+
+        :returns: The number of files indexed
+        """
+        dirs = {}
+        count = 0
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            files = dirs[rel] = {}
+            try:
+                it = os.scandir(os.path.join(self.root, rel))
+            except OSError:
+                continue
+            with it:
+                for e in it:
+                    if (self._is_ignored_name(e.name)):
+                        continue
+                    child = os.path.join(rel, e.name) if (rel) else e.name
+                    try:
+                        if (e.is_dir(follow_symlinks=False)):
+                            pending.append(child)
+                        elif (e.is_file()):
+                            st = e.stat()
+                            files[e.name] = (st.st_size, st.st_mtime_ns)
+                            count += 1
+                    except OSError:
+                        continue
+        self._dirs = dirs
+        self.debug('Indexed %s files under %s', count, self.root)
+        return count
+
+    def update(self, path):
+        """Brings the index up to date for a single changed path.
+
+        :param path: The path that was created or modified, either absolute
+                     or relative to the current directory
+        """
+        if (self._dirs is None):
+            return
+        rel = self._relpath(path)
+        if (rel is None or self.is_ignored(rel)):
+            return
+
+        full = os.path.join(self.root, rel)
+        try:
+            st = os.stat(full)
+        except OSError:
+            self._remove(rel)
+            return
+
+        if (os.path.isdir(full)):
+            if (rel not in self._dirs):
+                self._add_dir(rel)
+            return
+
+        parent, name = os.path.split(rel)
+        self._ensure_dir(parent)
+        self._dirs[parent][name] = (st.st_size, st.st_mtime_ns)
+
+    def remove(self, path):
+        """Removes a path, and everything beneath it, from the index.
+
+        :param path: The path that was deleted, either absolute or relative
+                     to the current directory
+        """
+        if (self._dirs is None):
+            return
+        rel = self._relpath(path)
+        if (rel is not None):
+            self._remove(rel)
+
+    def iter_entries(self, prefix=''):
+        """Yields the files within the index beneath a directory.
+
+        :param prefix: The directory relative to the root to list
+        :returns: A generator of [path, size, mtime_ns] lists
+        """
+        prefix = os.path.normpath(prefix) if (prefix) else ''
+        if (prefix == '.'):
+            prefix = ''
+
+        # Directories are snapshotted so updates while iterating are safe
+        for rel in sorted(self._dirs or {}):
+            if (prefix and rel != prefix and
+                    not rel.startswith(prefix + os.sep)):
+                continue
+            files = self._dirs.get(rel)
+            if (files is None):
+                continue
+            for name, (size, mtime_ns) in sorted(files.items()):
+                path = os.path.join(rel, name) if (rel) else name
+                yield [path, size, mtime_ns]
+
+    def pages(self, prefix='', max_bytes=MAX_CONTENT_SIZE):
+        """Yields the files beneath a directory in pages sized to fit a
+        single packet.
+
+        :param prefix: The directory relative to the root to list
+        :param max_bytes: The maximum estimated encoded size of a page
+        :returns: A generator of lists of [path, size, mtime_ns] lists
+        """
+        page = []
+        size = 0
+        for entry in self.iter_entries(prefix):
+            n = len(entry[0].encode('utf-8')) + _ENTRY_OVERHEAD
+            if (page and size + n > max_bytes):
+                yield page
+                page = []
+                size = 0
+            page.append(entry)
+            size += n
+        yield page
+
+    def _is_ignored_name(self, name):
+        return any(fnmatch.fnmatch(name, p) for p in self.ignore)
+
+    def _relpath(self, path):
+        rel = os.path.relpath(os.path.abspath(path), self.root)
+        if (rel == os.pardir or rel.startswith(os.pardir + os.sep)):
+            return None
+        return '' if (rel == os.curdir) else rel
+
+    def _ensure_dir(self, rel):
+        if (rel in self._dirs):
+            return
+        self._dirs[rel] = {}
+        if (rel):
+            self._ensure_dir(os.path.dirname(rel))
+
+    def _add_dir(self, rel):
+        sub = DirectoryIndex(os.path.join(self.root, rel), self.ignore)
+        sub.build()
+        self._ensure_dir(rel)
+        for sub_rel, files in sub._dirs.items():
+            key = os.path.join(rel, sub_rel) if (sub_rel) else rel
+            self._dirs[key] = files
+
+    def _remove(self, rel):
+        parent, name = os.path.split(rel)
+        files = self._dirs.get(parent)
+        if (files is not None):
+            files.pop(name, None)
+        for key in [k for k in self._dirs
+                    if k == rel or k.startswith(rel + os.sep)]:
+            del self._dirs[key]
@@ -3,6 +3,8 @@
 # AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
 # License: Apache 2.0 License
 # =============================================================================
+import asyncio
+from ..metrics import PacketStats
 from ..registry import ActionRegistry
 
 
@@ -12,13 +14,23 @@ class BaseHandler(object):
         perform vim-specific operations and a send function to relay responses.
 
         :param nvim: The neovim instance to use for various operations
-        :param send: The function that takes a series of bytes to send to
-                     the server
+        :param send: The function that takes a packet to sign and send to
+                     the remote end
         """
         self.nvim = nvim
         self.send = send
         self.registry = ActionRegistry()
 
+        # Count, bytes, errors and latency of the packets of each type
+        self.stats = PacketStats()
+        self.use(self.stats)
+
+        # Map of header id of an ask packet -> future of its answer
+        self.answers = {}
+
+        # Map of header id of an ask packet -> queue of its many answers
+        self.streams = {}
+
     def process(self, msg):
         """Processes the provided message using the appropriate action.
 
@@ -28,6 +40,61 @@ class BaseHandler(object):
         """
         return self.registry.process(msg)
 
+    def use(self, middleware):
+        """Adds a middleware wrapped around the action of every message,
+        within those added before it.
+
+        :param middleware: The function taking the next function in the
+                           chain, the action and the message, returning the
+                           result of calling the next function with the
+                           action and message
+        """
+        self.registry.use(middleware)
+
+    def expect_answer(self, packet, loop):
+        """Creates a future resolved when an answer to the packet arrives.
+
+        :param packet: The ask packet about to be sent
+        :param loop: The event loop to create the future on
+        :returns: The future whose result will be the answer packet
+        """
+        future = loop.create_future()
+        self.answers[packet.get_header().get_id()] = future
+        return future
+
+    def expect_stream(self, packet):
+        """Creates a queue receiving every answer to the packet that arrives,
+        for asks answered by a series of packets.
+
+        :param packet: The ask packet about to be sent
+        :returns: The queue the answer packets will be put into
+        """
+        queue = asyncio.Queue()
+        self.streams[packet.get_header().get_id()] = queue
+        return queue
+
+    def forget_answer(self, packet):
+        """Stops waiting for an answer to a packet.
+
+        :param packet: The ask packet whose answer is no longer wanted
+        """
+        packet_id = packet.get_header().get_id()
+        self.answers.pop(packet_id, None)
+        self.streams.pop(packet_id, None)
+
+    def _answer(self, packet):
+        """Executed when receiving an answer, resolving whoever awaits it."""
+        parent_id = packet.get_parent_header().get_id()
+        queue = self.streams.get(parent_id)
+        if (queue is not None):
+            queue.put_nowait(packet)
+            return None
+
+        future = self.answers.pop(parent_id, None)
+        if (future is not None and not future.done()):
+            future.set_result(packet)
+        return None
+
     def initialize(self):
         """Initializes the internal registry so it can respond to messages."""
         raise NotImplementedError()
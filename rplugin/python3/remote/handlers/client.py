@@ -4,20 +4,130 @@
 # License: Apache 2.0 License
 # =============================================================================
 from .base import BaseHandler
+from ..constants import (
+    MESSAGE_DEFAULT_CHUNK_DATA,
+    MESSAGE_DEFAULT_CHUNK_INDEX,
+    MESSAGE_DEFAULT_FILE_LENGTH,
+    MESSAGE_DEFAULT_FILE_VERSION,
+    MESSAGE_DEFAULT_TOTAL_CHUNKS,
+    MESSAGE_METADATA_CHUNK_INDEX,
+    MESSAGE_METADATA_CHUNK_SIZE,
+    MESSAGE_METADATA_FILE_LENGTH,
+    MESSAGE_METADATA_FILE_PATH,
+    MESSAGE_METADATA_FILE_VERSION,
+    MESSAGE_METADATA_TOTAL_CHUNKS,
+    PACKET_TYPE_ANSWER_COMMAND,
+    PACKET_TYPE_ANSWER_FILE_CHUNKS,
+    PACKET_TYPE_ANSWER_FILE_LIST,
+    PACKET_TYPE_ANSWER_FILE_VERSION,
+    PACKET_TYPE_ANSWER_TREE,
+    PACKET_TYPE_RETRIEVE_FILE,
+    PACKET_TYPE_TELL_BUFFER_DRIFT,
+    PACKET_TYPE_TELL_FILE_CHANGED,
+)
+from ..reassembly import ReassemblyManager
+from ..registry import PRIORITY_BULK
 
 
 class ClientHandler(BaseHandler):
-    def __init__(self, nvim, send):
+    def __init__(self, nvim, send, buffer_sync=None, cache=None):
         """Initializes client actions with with neovim instance to use to
         perform vim-specific operations and a send function to relay responses.
 
         :param nvim: The neovim instance to use for various operations
-        :param send: The function that takes a series of bytes to send to
+        :param send: The function that takes a packet to sign and send to
                      the server
+        :param buffer_sync: If provided, the buffer synchronizer to notify
+                            when the server reports drift
+        :param cache: If provided, the cache retrieved files are written to,
+                      without which retrieved files are dropped
         """
-        super(nvim, send)
+        super().__init__(nvim, send)
+        self.buffer_sync = buffer_sync
+        self.cache = cache
+
+        # Incoming retrieved files, written to disk as chunks arrive
+        self.reassembly = ReassemblyManager()
+
+        # Map of path -> (version, size) of files the server reports changed
+        self.remote_files = {}
+
+        self.initialize()
 
     def initialize(self):
         """Initializes the registry so it can respond to messages."""
         r = self.registry
+        r.register(PACKET_TYPE_ANSWER_COMMAND, self._answer)
+        r.register(PACKET_TYPE_ANSWER_FILE_CHUNKS, self._answer)
+        r.register(PACKET_TYPE_ANSWER_FILE_LIST, self._answer)
+        r.register(PACKET_TYPE_ANSWER_FILE_VERSION, self._answer)
+        r.register(PACKET_TYPE_ANSWER_TREE, self._answer)
+        r.register(PACKET_TYPE_TELL_BUFFER_DRIFT, self._buffer_drift)
+        r.register(PACKET_TYPE_TELL_FILE_CHANGED, self._file_changed)
+        r.register(PACKET_TYPE_RETRIEVE_FILE, self._retrieve_file,
+                   priority=PRIORITY_BULK, workers=1)
+
+    def _buffer_drift(self, packet):
+        """Executed when the server reports a buffer copy has drifted."""
+        if (self.buffer_sync is not None):
+            path = packet.get_metadata().get_value(MESSAGE_METADATA_FILE_PATH)
+            self.buffer_sync.resync(path)
+        return None
+
+    def _file_changed(self, packet):
+        """Executed when the server reports a batch of changed files."""
+        changes = packet.get_content().get_data()
+        if (not isinstance(changes, list)):
+            return None
+        for path, version, size in changes:
+            if (size == MESSAGE_DEFAULT_FILE_LENGTH):
+                self.remote_files.pop(path, None)
+            else:
+                self.remote_files[path] = (version, size)
+        return changes
+
+    def _retrieve_file(self, packet):
+        """Executed when receiving a chunk of a file retrieved from the
+        server; every chunk describes the whole file, so whichever arrives
+        first starts the transfer of its version."""
+        # The path is on the server, so without a cache there is nowhere
+        # local the file belongs
+        if (self.cache is None):
+            return None
+
+        m = packet.get_metadata()
+        session = packet.get_header().get_session()
+        path = m.get_value(MESSAGE_METADATA_FILE_PATH)
+        length = m.get_value(MESSAGE_METADATA_FILE_LENGTH)
+        chunk_size = m.get_value(MESSAGE_METADATA_CHUNK_SIZE)
+        if (length is None or chunk_size is None):
+            return None
+
+        version = m.get_value(MESSAGE_METADATA_FILE_VERSION)
+        if (version is None):
+            version = MESSAGE_DEFAULT_FILE_VERSION
+        total = m.get_value(MESSAGE_METADATA_TOTAL_CHUNKS)
+        if (total is None):
+            total = MESSAGE_DEFAULT_TOTAL_CHUNKS
+        index = m.get_value(MESSAGE_METADATA_CHUNK_INDEX)
+        if (index is None):
+            index = MESSAGE_DEFAULT_CHUNK_INDEX
+        data = packet.get_content().get_data()
+        if (not isinstance(data, bytes)):
+            data = MESSAGE_DEFAULT_CHUNK_DATA
+
+        # Retrieved files go straight into their cached copy
+        target = self.cache.blob_path(path, version)
+
+        r = self.reassembly
+        done = r.start(session, target, version, length, total, chunk_size)
+        if (done is None):
+            done = r.receive(session, target, version, index, data)
+        if (done is None):
+            return None
 
+        self.cache.add(path, version, length)
+        future = self.answers.pop(packet.get_parent_header().get_id(), None)
+        if (future is not None and not future.done()):
+            future.set_result(done)
+        return done
@@ -3,31 +3,637 @@
 # AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
 # License: Apache 2.0 License
 # =============================================================================
+import asyncio
+import os
 from .base import BaseHandler
+from ..archive import DEFAULT_ARCHIVE_DIR, ArchiveManager
+from ..buffer import LineMirror
+from ..builders import (
+    build_answer_command,
+    build_answer_file_chunks,
+    build_answer_file_list,
+    build_answer_file_version,
+    build_answer_tree,
+    build_retrieve_file,
+    build_tell_buffer_drift,
+)
+from ..chunks import CHUNK_SIZE, iter_file_chunks
+from ..commands import CommandRunner
+from ..dirindex import DirectoryIndex
 from ..constants import (
+    MESSAGE_DEFAULT_BUFFER_EDITS,
+    MESSAGE_DEFAULT_CHANGEDTICK,
+    MESSAGE_DEFAULT_CHUNK_DATA,
+    MESSAGE_DEFAULT_CHUNK_INDEX,
+    MESSAGE_DEFAULT_COMMAND_NAME,
+    MESSAGE_DEFAULT_FILE_LENGTH,
+    MESSAGE_DEFAULT_FILE_VERSION,
+    MESSAGE_DEFAULT_TOTAL_CHUNKS,
+    MESSAGE_METADATA_CHANGEDTICK,
+    MESSAGE_METADATA_CHECKSUM,
+    MESSAGE_METADATA_CHUNK_INDEX,
+    MESSAGE_METADATA_CHUNK_SIZE,
+    MESSAGE_METADATA_COMMAND_ARGS,
+    MESSAGE_METADATA_COMMAND_NAME,
+    MESSAGE_METADATA_FILE_LENGTH,
+    MESSAGE_METADATA_FILE_PATH,
+    MESSAGE_METADATA_FILE_VERSION,
+    MESSAGE_METADATA_SEQUENCE,
+    MESSAGE_METADATA_TOTAL_CHUNKS,
+    PACKET_TYPE_ASK_COMMAND,
+    PACKET_TYPE_ASK_FILE_CHUNKS,
+    PACKET_TYPE_ASK_FILE_LIST,
+    PACKET_TYPE_ASK_FILE_VERSION,
+    PACKET_TYPE_ASK_TREE,
+    PACKET_TYPE_RETRIEVE_FILE_ASK,
+    PACKET_TYPE_TELL_BUFFER_CHECKSUM,
+    PACKET_TYPE_TELL_BUFFER_EDIT,
+    PACKET_TYPE_TELL_COMMAND_ACK,
+    PACKET_TYPE_TELL_COMMAND_CANCEL,
     PACKET_TYPE_TELL_HEARTBEAT,
+    PACKET_TYPE_UPDATE_ARCHIVE_DATA,
+    PACKET_TYPE_UPDATE_ARCHIVE_START,
+    PACKET_TYPE_UPDATE_FILE_DATA,
+    PACKET_TYPE_UPDATE_FILE_START,
 )
+from ..index import FileIndex
+from ..indexer import ParallelIndexer
+from ..merkle import MerkleTree
+from ..reassembly import ReassemblyManager, TransferStore
+from ..registry import PRIORITY_BULK, PRIORITY_INTERACTIVE
+from ..scheduler import DEFAULT_BATCH, DEFAULT_MAX_CONCURRENT
+
+# Seconds before the drift of a buffer is reported again while it persists
+DEFAULT_DRIFT_INTERVAL = 1.0
 
 
 class ServerHandler(BaseHandler):
-    def __init__(self, nvim, send, broadcast):
+    def __init__(self, nvim, send, broadcast, loop=None, root=None,
+                 state_dir=None, index=None):
         """Initializes server actions with with neovim instance to use to
         perform vim-specific operations and a send function to relay responses.
 
         :param nvim: The neovim instance to use for various operations
-        :param send: The function that takes a series of bytes to send to
-                     the client(s); format of send(bytes, address)
-        :param broadcast: The function taht takes a series of bytes to send
+        :param send: The function that takes a packet to sign and send to
+                     the client(s); format of send(packet, address)
+        :param broadcast: The function taht takes a packet to sign and send
                           to all clients
+        :param loop: The event loop used to run long-lived answers,
+                     defaulting to the current event loop
+        :param root: The directory whose files are listed to clients,
+                     defaulting to the current directory
+        :param state_dir: If provided, the directory used to persist partial
+                          file updates so they can be resumed
+        :param index: The file index used to look up content hashes,
+                      defaulting to one kept in memory
         """
-        super(nvim, send)
+        super().__init__(nvim, send)
         self.broadcast = broadcast
+        self.loop = loop if (loop is not None) else asyncio.get_event_loop()
+
+        # Index of the files beneath the root, built on the first listing
+        self.dir_index = DirectoryIndex(
+            root if (root is not None) else os.getcwd())
+        self._dir_index_build = None
+
+        # Tree of directory hashes of the files beneath the root, built on
+        # the first ask and then kept current by file changes
+        self.index = index if (index is not None) else FileIndex(None)
+        self.tree = None
+        self._tree_build = None
+        self._tree_pending = {}
+
+        # Function taking the number of files indexed and the number to index
+        self.index_progress = None
+
+        # Commands run on behalf of clients, with output streamed back
+        self.commands = CommandRunner(self.loop, cwd=self.dir_index.root)
+
+        # Map of session -> address of the client, updated as packets arrive
+        self.sessions = {}
+
+        # Map of path -> mirror of buffers streamed by clients
+        self.mirrors = {}
+
+        # Map of path -> time its drift was last reported, until resent
+        self.drifted = {}
+        self.drift_interval = DEFAULT_DRIFT_INTERVAL
+
+        # Incoming file updates, written to disk as chunks arrive
+        store = TransferStore(state_dir) if (state_dir is not None) else None
+        self.reassembly = ReassemblyManager(store=store)
+
+        # Incoming archives of whole trees, unpacked as chunks arrive
+        archive_dir = DEFAULT_ARCHIVE_DIR
+        if (state_dir is not None):
+            archive_dir = os.path.join(state_dir, 'archives')
+        self.archives = ArchiveManager(self.loop, index=self.index,
+                                       archive_dir=archive_dir,
+                                       extracted=self._file_updated)
+
+        self.initialize()
 
     def initialize(self):
         """Initializes the registry so it can respond to messages."""
         r = self.registry
+        r.register(PACKET_TYPE_ASK_COMMAND, self._ask_command)
+        r.register(PACKET_TYPE_ASK_FILE_VERSION, self._ask_file_version)
+        r.register(PACKET_TYPE_TELL_BUFFER_CHECKSUM, self._buffer_checksum)
+        r.register(PACKET_TYPE_TELL_BUFFER_EDIT, self._buffer_edit)
+        r.register(PACKET_TYPE_TELL_COMMAND_ACK, self._command_ack)
+        r.register(PACKET_TYPE_TELL_COMMAND_CANCEL, self._command_cancel)
         r.register(PACKET_TYPE_TELL_HEARTBEAT, self._heartbeat)
+        r.register(PACKET_TYPE_UPDATE_ARCHIVE_START,
+                   self._update_archive_start)
+        r.register(PACKET_TYPE_UPDATE_FILE_START, self._update_file_start)
+
+        # Listings wait on the indexes, so only a few are streamed at once
+        r.register(PACKET_TYPE_ASK_FILE_LIST, self._ask_file_list,
+                   priority=PRIORITY_INTERACTIVE, workers=2)
+        r.register(PACKET_TYPE_ASK_TREE, self._ask_tree,
+                   priority=PRIORITY_INTERACTIVE, workers=2)
+
+        # Chunks are written behind control traffic and dropped when writes
+        # fall behind, for the client to resend once it asks which chunks
+        # arrived; the asks share their priority so they follow the chunks
+        # sent before them, pacing the client to the writes
+        r.register(PACKET_TYPE_UPDATE_ARCHIVE_DATA, self._update_archive_data,
+                   priority=PRIORITY_BULK, workers=1)
+        r.register(PACKET_TYPE_UPDATE_FILE_DATA, self._update_file_data,
+                   priority=PRIORITY_BULK, workers=1)
+        r.register(PACKET_TYPE_ASK_FILE_CHUNKS, self._ask_file_chunks,
+                   priority=PRIORITY_BULK, workers=1)
+        r.register(PACKET_TYPE_RETRIEVE_FILE_ASK, self._retrieve_file,
+                   priority=PRIORITY_BULK, workers=DEFAULT_MAX_CONCURRENT)
+
+    def reply(self, packet, response):
+        """Sends a response to the client that sent a packet.
+
+        :param packet: The packet being responded to
+        :param response: The packet to send back
+        """
+        addr = self.sessions.get(packet.get_header().get_session())
+        if (addr is not None):
+            self.send(response, addr)
 
     def _heartbeat(self, packet):
         """Executed when receiving a heartbeat from a client."""
         return None
+
+    def _update_file_start(self, packet):
+        """Executed when a client starts sending a new version of a file."""
+        m = packet.get_metadata()
+        path = self._resolve_update(m)
+        length = m.get_value(MESSAGE_METADATA_FILE_LENGTH)
+        chunk_size = m.get_value(MESSAGE_METADATA_CHUNK_SIZE)
+        if (path is None or length is None or chunk_size is None):
+            return None
+
+        total = m.get_value(MESSAGE_METADATA_TOTAL_CHUNKS)
+        if (total is None):
+            total = MESSAGE_DEFAULT_TOTAL_CHUNKS
+        version = m.get_value(MESSAGE_METADATA_FILE_VERSION)
+        if (version is None):
+            version = MESSAGE_DEFAULT_FILE_VERSION
+
+        return self._file_updated(self.reassembly.start(
+            session=packet.get_header().get_session(),
+            path=path,
+            version=version,
+            file_length=length,
+            total_chunks=total,
+            chunk_size=chunk_size,
+        ))
+
+    def _update_file_data(self, packet):
+        """Executed when receiving a chunk of a file from a client."""
+        m = packet.get_metadata()
+        path = self._resolve_update(m)
+        if (path is None):
+            return None
+        index = m.get_value(MESSAGE_METADATA_CHUNK_INDEX)
+        if (index is None):
+            index = MESSAGE_DEFAULT_CHUNK_INDEX
+        version = m.get_value(MESSAGE_METADATA_FILE_VERSION)
+        if (version is None):
+            version = MESSAGE_DEFAULT_FILE_VERSION
+        data = packet.get_content().get_data()
+        if (not isinstance(data, bytes)):
+            data = MESSAGE_DEFAULT_CHUNK_DATA
+
+        return self._file_updated(self.reassembly.receive(
+            session=packet.get_header().get_session(),
+            path=path,
+            version=version,
+            index=index,
+            data=data,
+        ))
+
+    def _update_archive_start(self, packet):
+        """Executed when a client starts sending a tree as an archive."""
+        m = packet.get_metadata()
+        root = self._resolve_update(m)
+        length = m.get_value(MESSAGE_METADATA_FILE_LENGTH)
+        chunk_size = m.get_value(MESSAGE_METADATA_CHUNK_SIZE)
+        if (root is None or length is None or chunk_size is None):
+            return None
+
+        total = m.get_value(MESSAGE_METADATA_TOTAL_CHUNKS)
+        if (total is None):
+            total = MESSAGE_DEFAULT_TOTAL_CHUNKS
+        version = m.get_value(MESSAGE_METADATA_FILE_VERSION)
+        if (version is None):
+            version = MESSAGE_DEFAULT_FILE_VERSION
+
+        return self.archives.start(
+            session=packet.get_header().get_session(),
+            root=root,
+            version=version,
+            file_length=length,
+            total_chunks=total,
+            chunk_size=chunk_size,
+        )
+
+    def _update_archive_data(self, packet):
+        """Executed when receiving a chunk of an archive from a client."""
+        m = packet.get_metadata()
+        root = self._resolve_update(m)
+        if (root is None):
+            return None
+        index = m.get_value(MESSAGE_METADATA_CHUNK_INDEX)
+        if (index is None):
+            index = MESSAGE_DEFAULT_CHUNK_INDEX
+        version = m.get_value(MESSAGE_METADATA_FILE_VERSION)
+        if (version is None):
+            version = MESSAGE_DEFAULT_FILE_VERSION
+        data = packet.get_content().get_data()
+        if (not isinstance(data, bytes)):
+            data = MESSAGE_DEFAULT_CHUNK_DATA
+
+        return self.archives.receive(
+            session=packet.get_header().get_session(),
+            root=root,
+            version=version,
+            index=index,
+            data=data,
+        )
+
+    def _resolve_update(self, metadata):
+        """Returns the full path of the file or tree a client is sending,
+        or None if the path is missing or not beneath the root."""
+        path = metadata.get_value(MESSAGE_METADATA_FILE_PATH)
+        if (not isinstance(path, str)):
+            return None
+        return self._resolve(path)
+
+    def _file_updated(self, path):
+        """Keeps the directory index current once a file has been written.
+
+        :param path: The path of the file written, or None if not written
+        :returns: The path
+        """
+        if (path is not None):
+            self.dir_index.update(path)
+        return path
+
+    def update_tree(self, path, digest):
+        """Keeps the tree current once a file has changed.
+
+        :param path: The path of the file
+        :param digest: The content hash of the file, or None if deleted
+        """
+        rel = os.path.relpath(os.path.abspath(path), self.dir_index.root)
+        if (rel == os.curdir or rel == os.pardir or
+                rel.startswith(os.pardir + os.sep)):
+            return
+        if (self.tree is not None):
+            self.tree.update(rel, digest)
+        elif (self._tree_build is not None):
+            self._tree_pending[rel] = digest
+
+    async def _ensure_dir_index(self):
+        if (not self.dir_index.is_built()):
+            if (self._dir_index_build is None):
+                self._dir_index_build = self.loop.run_in_executor(
+                    None, self.dir_index.build)
+            await self._dir_index_build
+
+    async def _ensure_tree(self):
+        if (self.tree is not None):
+            return self.tree
+        return await asyncio.shield(self.prepare())
+
+    def prepare(self):
+        """Starts indexing the files beneath the root in the background so
+        the first client to ask does not wait for it.
+
+        :returns: The task building the tree, or None if already built
+        """
+        if (self.tree is None and self._tree_build is None):
+            self._tree_build = self.loop.create_task(self._build_tree())
+        return self._tree_build
+
+    async def _build_tree(self):
+        await self._ensure_dir_index()
+        root = self.dir_index.root
+        entries = list(self.dir_index.iter_entries())
+        await ParallelIndexer(self.loop, self.index,
+                              progress=self.index_progress).index_files(
+            (os.path.join(root, p), size, mtime_ns)
+            for p, size, mtime_ns in entries)
+
+        # Every file is now indexed, so building the tree only stats them
+        paths = [e[0] for e in entries]
+        tree = await self.loop.run_in_executor(
+            None, MerkleTree.build, self.dir_index.root, paths, self.index)
+
+        # Changes made while hashing are applied over the result
+        for rel, digest in self._tree_pending.items():
+            tree.update(rel, digest)
+        self._tree_pending = {}
+        self.tree = tree
+        return tree
+
+    def _ask_file_list(self, packet):
+        """Executed when a client asks for the files beneath a directory,
+        answering with a stream of pages as they are produced."""
+        return self.loop.create_task(self._stream_file_list(packet))
+
+    async def _stream_file_list(self, packet):
+        await self._ensure_dir_index()
+        prefix = packet.get_metadata().get_value(MESSAGE_METADATA_FILE_PATH)
+        await self._stream_pages(packet, self.dir_index.pages(prefix or ''),
+                                 build_answer_file_list)
+
+    def _ask_tree(self, packet):
+        """Executed when a client asks for the hashes of the children of a
+        directory, answering with a stream of pages."""
+        return self.loop.create_task(self._stream_tree(packet))
+
+    async def _stream_tree(self, packet):
+        tree = await self._ensure_tree()
+        path = packet.get_metadata().get_value(MESSAGE_METADATA_FILE_PATH)
+        await self._stream_pages(packet, tree.pages(path or ''),
+                                 build_answer_tree)
+
+    async def _stream_pages(self, packet, pages, build):
+        """Answers an ask with a series of pages.
+
+        :param packet: The ask packet being answered
+        :param pages: The iterator of pages, yielding at least one page
+        :param build: The builder of a single page of the answer
+        """
+        # Hold back one page so the final page can be flagged as such
+        index = 0
+        held = None
+        for page in pages:
+            if (held is not None):
+                self._answer_page(packet, build, index, False, held)
+                index += 1
+                await asyncio.sleep(0)
+            held = page
+        self._answer_page(packet, build, index, True, held)
+
+    def _answer_page(self, packet, build, index, is_last, entries):
+        h = packet.get_header()
+        self.reply(packet, build(
+            username=h.get_username(),
+            session=h.get_session(),
+            parent_header=h,
+            page_index=index,
+            is_last=is_last,
+            entries=entries,
+        ))
+
+    def _resolve(self, path):
+        """Resolves a path asked for by a client against the root.
+
+        :param path: The path relative to the root
+        :returns: The absolute path, or None if outside of the root
+        """
+        root = self.dir_index.root
+        full = os.path.abspath(os.path.join(root, path or ''))
+        rel = os.path.relpath(full, root)
+        if (rel == os.pardir or rel.startswith(os.pardir + os.sep)):
+            return None
+        return full
+
+    async def _refresh(self, path):
+        """Looks up the current version of a file, hashing it off the loop
+        if it changed since it was last indexed.
+
+        :param path: The path relative to the root
+        :returns: The index entry, or None if the file does not exist
+        """
+        full = self._resolve(path)
+        if (full is None or not os.path.isfile(full)):
+            return None
+        return await self.loop.run_in_executor(None, self.index.refresh, full)
+
+    def _ask_file_version(self, packet):
+        """Executed when a client asks for the current version of a file,
+        such as to validate its cached copy."""
+        return self.loop.create_task(self._answer_file_version(packet))
+
+    async def _answer_file_version(self, packet):
+        path = packet.get_metadata().get_value(MESSAGE_METADATA_FILE_PATH)
+        entry = await self._refresh(path)
+
+        h = packet.get_header()
+        self.reply(packet, build_answer_file_version(
+            username=h.get_username(),
+            session=h.get_session(),
+            parent_header=h,
+            file_path=path,
+            file_version=(entry.version if (entry is not None)
+                          else MESSAGE_DEFAULT_FILE_VERSION),
+            file_length=(entry.size if (entry is not None)
+                         else MESSAGE_DEFAULT_FILE_LENGTH),
+        ))
+
+    def _retrieve_file(self, packet):
+        """Executed when a client asks for the contents of a file, sending
+        it back as a series of chunks."""
+        return self.loop.create_task(self._send_file(packet))
+
+    async def _send_file(self, packet):
+        path = packet.get_metadata().get_value(MESSAGE_METADATA_FILE_PATH)
+        entry = await self._refresh(path)
+        if (entry is None):
+            return
+
+        h = packet.get_header()
+        chunks = iter_file_chunks(entry.path)
+        try:
+            for index, total, data in chunks:
+                self.reply(packet, build_retrieve_file(
+                    username=h.get_username(),
+                    session=h.get_session(),
+                    parent_header=h,
+                    file_path=path,
+                    file_version=entry.version,
+                    file_length=entry.size,
+                    chunk_index=index,
+                    total_chunks=total,
+                    chunk_size=CHUNK_SIZE,
+                    data=data,
+                ))
+                del data
+                if ((index + 1) % DEFAULT_BATCH == 0):
+                    await asyncio.sleep(0)
+        finally:
+            chunks.close()
+
+    def _command_key(self, packet, header):
+        return (packet.get_header().get_session(), header.get_id())
+
+    def _ask_command(self, packet):
+        """Executed when a client asks for a command to be run, streaming
+        its output back while it runs."""
+        m = packet.get_metadata()
+        name = m.get_value(MESSAGE_METADATA_COMMAND_NAME)
+        if (not isinstance(name, str)):
+            name = MESSAGE_DEFAULT_COMMAND_NAME
+        args = m.get_value(MESSAGE_METADATA_COMMAND_ARGS)
+        if (not isinstance(args, list)):
+            args = []
+
+        h = packet.get_header()
+
+        def send(sequence, stream, data, exit_code):
+            self.reply(packet, build_answer_command(
+                username=h.get_username(),
+                session=h.get_session(),
+                parent_header=h,
+                sequence=sequence,
+                stream=stream,
+                data=data,
+                exit_code=exit_code,
+            ))
+
+        return self.commands.start(
+            session=h.get_session(),
+            key=self._command_key(packet, h),
+            name=name,
+            args=[str(a) for a in args],
+            send=send,
+        )
+
+    def _command_ack(self, packet):
+        """Executed when a client acknowledges the output of a command."""
+        sequence = packet.get_metadata().get_value(MESSAGE_METADATA_SEQUENCE)
+        if (sequence is not None):
+            self.commands.ack(
+                self._command_key(packet, packet.get_parent_header()),
+                sequence)
+        return None
+
+    def _command_cancel(self, packet):
+        """Executed when a client cancels a command."""
+        return self.commands.cancel(
+            self._command_key(packet, packet.get_parent_header()))
+
+    def _ask_file_chunks(self, packet):
+        """Executed when a client asks which chunks of a file it has sent
+        were received, so it only needs to send the missing ones."""
+        m = packet.get_metadata()
+        path = m.get_value(MESSAGE_METADATA_FILE_PATH)
+        full = self._resolve_update(m)
+        version = m.get_value(MESSAGE_METADATA_FILE_VERSION)
+        total = m.get_value(MESSAGE_METADATA_TOTAL_CHUNKS)
+        if (full is None or version is None or total is None):
+            return None
+
+        h = packet.get_header()
+        bitmap = self.archives.received(h.get_session(), full,
+                                        version, total)
+        if (bitmap is None):
+            bitmap = self.reassembly.received(h.get_session(), full,
+                                              version, total)
+        self.reply(packet, build_answer_file_chunks(
+            username=h.get_username(),
+            session=h.get_session(),
+            parent_header=h,
+            file_path=path,
+            file_version=version,
+            total_chunks=total,
+            bitmap=bitmap.to_bytes(),
+        ))
+        return None
+
+    def _buffer_edit(self, packet):
+        """Executed when receiving line edits of a buffer from a client."""
+        m = packet.get_metadata()
+        path = m.get_value(MESSAGE_METADATA_FILE_PATH)
+        changedtick = m.get_value(MESSAGE_METADATA_CHANGEDTICK)
+        if (changedtick is None):
+            changedtick = MESSAGE_DEFAULT_CHANGEDTICK
+        checksum = m.get_value(MESSAGE_METADATA_CHECKSUM)
+        edits = packet.get_content().get_data()
+        if (not isinstance(edits, list)):
+            edits = MESSAGE_DEFAULT_BUFFER_EDITS
+        if (self._resolve(path) is None):
+            return None
+
+        mirror = self.mirrors.get(path)
+
+        # Edits that arrive out of order cannot be applied safely, and the
+        # initial edit of a buffer is always the whole buffer
+        is_whole = bool(edits) and edits[0][0] == 0 and edits[0][1] < 0
+        if (mirror is None and not is_whole):
+            self._drift(packet, path)
+            return None
+        if (mirror is not None and changedtick < mirror.changedtick()):
+            self._drift(packet, path)
+            return None
+
+        if (mirror is None or is_whole):
+            mirror = self.mirrors[path] = LineMirror()
+            self.drifted.pop(path, None)
+        mirror.apply_all(edits).set_changedtick(changedtick)
+
+        if (checksum is not None and checksum != mirror.checksum()):
+            self._drift(packet, path)
+        return None
+
+    def _buffer_checksum(self, packet):
+        """Executed when receiving the checksum of a buffer from a client,
+        writing the remote copy to disk if it matches."""
+        m = packet.get_metadata()
+        path = m.get_value(MESSAGE_METADATA_FILE_PATH)
+        checksum = m.get_value(MESSAGE_METADATA_CHECKSUM)
+
+        # Buffers outside of the root are never written
+        full = self._resolve(path)
+        if (full is None):
+            return None
+
+        mirror = self.mirrors.get(path)
+        if (mirror is None or checksum != mirror.checksum()):
+            self._drift(packet, path)
+        elif (mirror.dirty()):
+            with open(full, 'w', encoding='utf-8') as f:
+                for line in mirror.lines():
+                    f.write(line)
+                    f.write('\n')
+            mirror.set_dirty(False)
+            self._file_updated(full)
+        return None
+
+    def _drift(self, packet, path):
+        """Drops the remote copy of a buffer and asks for it to be resent,
+        repeating the ask at most once per drift interval until it is."""
+        self.mirrors.pop(path, None)
+        now = self.loop.time()
+        last = self.drifted.get(path)
+        if (last is not None and now - last < self.drift_interval):
+            return
+        self.drifted[path] = now
+
+        h = packet.get_header()
+        self.reply(packet, build_tell_buffer_drift(
+            username=h.get_username(),
+            session=h.get_session(),
+            file_path=path,
+            parent_header=h,
+        ))
@@ -0,0 +1,229 @@
+# =============================================================================
+# FILE: index.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import msgpack
+import os
+import threading
+from collections import namedtuple
+from functools import wraps
+from hashlib import sha256
+from . import logger
+
+# Default location of the index on disk
+DEFAULT_INDEX_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'remote', 'index')
+
+# Default location of the index of files served to clients
+DEFAULT_SERVER_INDEX_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'remote', 'server-index')
+
+# Size of blocks read when hashing a file
+HASH_BLOCK_SIZE = 1 << 20
+
+# Rewrite the log once it holds this many times more records than entries
+_COMPACT_RATIO = 4
+_COMPACT_MIN_RECORDS = 1024
+
+IndexEntry = namedtuple('IndexEntry', [
+    'path', 'size', 'mtime_ns', 'digest', 'version',
+])
+
+
+def _locked(f):
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return f(self, *args, **kwargs)
+    return wrapper
+
+
+def hash_file(path, block_size=HASH_BLOCK_SIZE):
+    """Computes the content hash of a file, reading it in blocks.
+
+    :param path: The path of the file to hash
+    :param block_size: The number of bytes to read at a time
+    :returns: The digest of the file's contents as bytes
+    """
+    h = sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.digest()
+
+
+class FileIndex(logger.LoggingMixin):
+    def __init__(self, index_path=DEFAULT_INDEX_PATH):
+        """Creates a new index mapping file paths to their size, modification
+        time, content hash, and version. The index is persisted as an
+        append-only log that is not read until the index is first used.
+        The index may be used from worker threads as well as the loop.
+
+        :param index_path: The path of the log on disk, or None to keep the
+                           index in memory only
+        """
+        self._index_path = index_path
+        self._entries = None
+
+        # Map of path -> last version of a removed file, so a file created
+        # again continues from it and versions only ever increase
+        self._removed = {}
+        self._records = 0
+        self._log = None
+        self._lock = threading.RLock()
+        self.is_debug_enabled = True
+
+    @_locked
+    def lookup(self, path):
+        """Returns the entry recorded for a path without touching the file.
+
+        :param path: The path of the file
+        :returns: The entry if found, otherwise None
+        """
+        return self._load().get(path)
+
+    def is_unchanged(self, path):
+        """Checks if the file's stat information matches the index.
+
+        :param path: The path of the file
+        :returns: True if the file matches its entry, otherwise False
+        """
+        entry = self.lookup(path)
+        if (entry is None):
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return entry.size == st.st_size and entry.mtime_ns == st.st_mtime_ns
+
+    def refresh(self, path):
+        """Brings the entry of a file up to date, rehashing the file only if
+        its stat information changed and bumping the version only if its
+        content changed.
+
+        :param path: The path of the file
+        :returns: The up-to-date entry, or None if the file does not exist
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.remove(path)
+            return None
+
+        entry = self.lookup(path)
+        if (entry is not None and entry.size == st.st_size and
+                entry.mtime_ns == st.st_mtime_ns):
+            return entry
+
+        return self.update(path, st.st_size, st.st_mtime_ns, hash_file(path))
+
+    @_locked
+    def update(self, path, size, mtime_ns, digest):
+        """Records the stat information and content hash of a file, bumping
+        its version if the content hash differs from the indexed one.
+
+        :param path: The path of the file
+        :param size: The size of the file in bytes
+        :param mtime_ns: The modification time of the file in nanoseconds
+        :param digest: The content hash of the file
+        :returns: The new entry
+        """
+        entry = self.lookup(path)
+        version = self._removed.pop(path, 0) + 1
+        if (entry is not None):
+            version = entry.version
+            if (entry.digest != digest):
+                version += 1
+
+        entry = IndexEntry(path, size, mtime_ns, digest, version)
+        self._entries[path] = entry
+        self._append(list(entry))
+        return entry
+
+    @_locked
+    def remove(self, path):
+        """Removes the entry of a path from the index, remembering its
+        version.
+
+        :param path: The path of the file
+        """
+        entry = self._load().pop(path, None)
+        if (entry is not None):
+            self._removed[path] = entry.version
+            self._append([path, entry.version])
+
+    @_locked
+    def paths(self):
+        """Returns all paths within the index.
+
+        :returns: A list of paths
+        """
+        return list(self._load())
+
+    @_locked
+    def flush(self):
+        """Flushes any buffered records to disk."""
+        if (self._log is not None):
+            self._log.flush()
+
+    @_locked
+    def close(self):
+        """Closes the log on disk."""
+        if (self._log is not None):
+            self._log.close()
+            self._log = None
+
+    def _load(self):
+        if (self._entries is not None):
+            return self._entries
+
+        self._entries = {}
+        if (self._index_path is None or
+                not os.path.exists(self._index_path)):
+            return self._entries
+
+        with open(self._index_path, 'rb') as f:
+            unpacker = msgpack.Unpacker(f, raw=False)
+            try:
+                for record in unpacker:
+                    self._records += 1
+                    if (len(record) <= 2):
+                        # Removals before versions were remembered hold
+                        # only the path
+                        self._entries.pop(record[0], None)
+                        if (len(record) == 2):
+                            self._removed[record[0]] = record[1]
+                    else:
+                        self._removed.pop(record[0], None)
+                        self._entries[record[0]] = IndexEntry(*record)
+            except (ValueError, TypeError, msgpack.OutOfData) as ex:
+                # A torn final record from a crash is dropped
+                self.warning('Truncated index %s: %s', self._index_path, ex)
+
+        live = len(self._entries) + len(self._removed)
+        if (self._records >= _COMPACT_MIN_RECORDS and
+                self._records > _COMPACT_RATIO * live):
+            self._compact()
+        return self._entries
+
+    def _append(self, record):
+        if (self._index_path is None):
+            return
+        if (self._log is None):
+            os.makedirs(os.path.dirname(self._index_path), exist_ok=True)
+            self._log = open(self._index_path, 'ab')
+        self._log.write(msgpack.packb(record, use_bin_type=True))
+        self._records += 1
+
+    def _compact(self):
+        self.close()
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for entry in self._entries.values():
+                f.write(msgpack.packb(list(entry), use_bin_type=True))
+            for path, version in self._removed.items():
+                f.write(msgpack.packb([path, version], use_bin_type=True))
+        os.replace(tmp_path, self._index_path)
+        self._records = len(self._entries) + len(self._removed)
@@ -0,0 +1,173 @@
+# =============================================================================
+# FILE: indexer.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from . import logger
+from .dirindex import DirectoryIndex
+from .index import HASH_BLOCK_SIZE, hash_file
+
+# Number of files hashed by a worker per task
+DEFAULT_BATCH_SIZE = 256
+
+# Minimum number of seconds inbetween progress reports
+DEFAULT_PROGRESS_INTERVAL = 1.0
+
+# Failures of the process pool itself meaning it cannot be used here, such
+# as a worker dying because it cannot import this module
+_POOL_ERRORS = (BrokenProcessPool, pickle.PicklingError)
+
+
+def hash_batch(paths, block_size=HASH_BLOCK_SIZE):
+    """Hashes a batch of files, run within a worker.
+
+    :param paths: The paths of the files to hash
+    :param block_size: The number of bytes to read at a time
+    :returns: A list of (path, size, mtime_ns, digest) tuples for the files
+              that could be read
+    """
+    results = []
+    for path in paths:
+        try:
+            # Stat first so a file changed while hashing looks stale later
+            st = os.stat(path)
+            digest = hash_file(path, block_size)
+        except OSError:
+            continue
+        results.append((path, st.st_size, st.st_mtime_ns, digest))
+    return results
+
+
+class ParallelIndexer(logger.LoggingMixin):
+    def __init__(self, loop, index, workers=None,
+                 batch_size=DEFAULT_BATCH_SIZE, executor=None, progress=None,
+                 progress_interval=DEFAULT_PROGRESS_INTERVAL):
+        """Creates a new indexer hashing files across a pool of workers.
+        Results are written to the index as each batch finishes, so an
+        indexer that is cancelled can be resumed by indexing again.
+
+        :param loop: The event loop to run the indexer on
+        :param index: The file index to record content hashes within
+        :param workers: The number of worker processes, defaulting to the
+                        number of processors
+        :param batch_size: The number of files hashed per task
+        :param executor: If provided, the executor to hash files with
+                         instead of a process pool of its own
+        :param progress: If provided, the function taking the number of
+                         files hashed so far and the number to hash
+        :param progress_interval: The minimum number of seconds inbetween
+                                  progress reports
+        """
+        self._loop = loop
+        self._index = index
+        self._workers = workers
+        self._batch_size = batch_size
+        self._executor = executor
+        self._progress = progress
+        self._progress_interval = progress_interval
+        self._last_progress = None
+        self.done = 0
+        self.total = 0
+        self.is_debug_enabled = True
+
+    async def index_tree(self, root, ignore=None):
+        """Scans a directory off the event loop and hashes the files that
+        changed since they were last indexed.
+
+        :param root: The directory to index
+        :param ignore: The list of glob patterns of names to skip
+        :returns: The directory index of the scanned files
+        """
+        dir_index = DirectoryIndex(root, ignore)
+        await self._loop.run_in_executor(None, dir_index.build)
+        await self.index_files(
+            (os.path.join(dir_index.root, path), size, mtime_ns)
+            for path, size, mtime_ns in dir_index.iter_entries())
+        return dir_index
+
+    async def index_files(self, entries):
+        """Hashes the files whose stat information differs from the index.
+
+        :param entries: The (path, size, mtime_ns) tuples of the files
+        :returns: The number of files hashed
+        """
+        # Comparing every entry takes a while for a large tree, so keep it
+        # off the loop
+        stale = await self._loop.run_in_executor(
+            None, self._find_stale, entries)
+
+        self.done = 0
+        self.total = len(stale)
+        if (not stale):
+            return 0
+
+        batches = [stale[i:i + self._batch_size]
+                   for i in range(0, len(stale), self._batch_size)]
+        self.debug('Hashing %s files in %s batches', len(stale), len(batches))
+
+        executor = self._executor
+        owned = executor is None
+        if (owned):
+            executor = ProcessPoolExecutor(max_workers=self._workers)
+        try:
+            try:
+                await self._run(executor, batches)
+            except _POOL_ERRORS as ex:
+                if (not owned):
+                    raise
+                self.warning('Process pool unavailable, using threads: %s', ex)
+                executor.shutdown(wait=False)
+                executor = ThreadPoolExecutor(max_workers=self._workers)
+                await self._run(executor, batches)
+        finally:
+            if (owned):
+                executor.shutdown(wait=False)
+        self._report(force=True)
+        return self.done
+
+    def _find_stale(self, entries):
+        stale = []
+        for path, size, mtime_ns in entries:
+            entry = self._index.lookup(path)
+            if (entry is None or entry.size != size or
+                    entry.mtime_ns != mtime_ns):
+                stale.append(path)
+        return stale
+
+    async def _run(self, executor, batches):
+        # Batches are removed as they finish so a retry only redoes the rest
+        pending = {}
+        for batch in list(batches):
+            f = asyncio.wrap_future(executor.submit(hash_batch, batch),
+                                    loop=self._loop)
+            pending[f] = batch
+
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for f in done:
+                    batch = pending.pop(f)
+                    for path, size, mtime_ns, digest in f.result():
+                        self._index.update(path, size, mtime_ns, digest)
+                    self._index.flush()
+                    batches.remove(batch)
+                    self.done += len(batch)
+                self._report()
+        finally:
+            for f in pending:
+                f.cancel()
+
+    def _report(self, force=False):
+        if (self._progress is None):
+            return
+        now = self._loop.time()
+        if (force or self._last_progress is None or
+                now - self._last_progress >= self._progress_interval):
+            self._last_progress = now
+            self._progress(self.done, self.total)
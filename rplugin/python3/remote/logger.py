@@ -7,17 +7,59 @@
 # ORIGINAL AUTHOR: Tommy Allen <tommy at esdf.io>
 # ORIGINAL LICENSE: MIT license
 # ============================================================================
+import atexit
 import sys
 import logging
+import time
 from functools import wraps
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Full, Queue
 
 log_format = '%(asctime)s %(levelname)-8s [%(process)d] (%(name)s) %(message)s'
 log_message_cooldown = 0.5
 
+# Number of messages a call site logs within each cooldown before the rest
+# are suppressed
+log_message_burst = 10
+
+# Default size in bytes a log file grows to before it is rotated
+DEFAULT_LOG_MAX_BYTES = 10 * 1024 * 1024
+
+# Default number of rotated log files kept
+DEFAULT_LOG_BACKUP_COUNT = 3
+
+# Default number of records waiting to be written before new ones are dropped
+DEFAULT_LOG_MAX_QUEUED = 10000
+
 root = logging.getLogger('remote')
 root.propagate = False
 init = False
 
+# Thread writing queued records, and the handler queueing them
+listener = None
+queue_handler = None
+
+# Map of (filename, line) of a call site -> its limit of messages logged
+_limits: dict[tuple[str, int], '_Limit'] = {}
+
+# Function returning the current time in seconds, used to limit messages
+clock = time.monotonic
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Handler passing records to a bounded queue, counting the records
+    dropped when it is full rather than waiting for room."""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
 
 def getLogger(name):
     """Get a logger that is a child of the 'root' logger.
@@ -25,19 +67,33 @@ def getLogger(name):
     return root.getChild(name)
 
 
-def setup(nvim, level, output_file=None):
+def setup(nvim, level, output_file=None, max_bytes=DEFAULT_LOG_MAX_BYTES,
+          backup_count=DEFAULT_LOG_BACKUP_COUNT,
+          max_queued=DEFAULT_LOG_MAX_QUEUED):
     """Setup logging for Remote
+
+    Records are queued and written to the file by a background thread, so
+    logging never waits on the disk.
     """
-    global init
+    global init, listener, queue_handler
     if init:
         return
     init = True
 
     if output_file:
         formatter = logging.Formatter(log_format)
-        handler = logging.FileHandler(filename=output_file)
+        handler = RotatingFileHandler(filename=output_file,
+                                      maxBytes=max_bytes,
+                                      backupCount=backup_count,
+                                      delay=True)
         handler.setFormatter(formatter)
-        root.addHandler(handler)
+
+        queue = Queue(max_queued)
+        queue_handler = BoundedQueueHandler(queue)
+        root.addHandler(queue_handler)
+        listener = QueueListener(queue, handler)
+        listener.start()
+        atexit.register(shutdown)
 
         level = str(level).upper()
         if level not in ('DEBUG', 'INFO', 'WARN', 'WARNING', 'ERROR',
@@ -69,31 +125,98 @@ def setup(nvim, level, output_file=None):
         #               output_file))
 
 
-def logmethod(func):
+def shutdown():
+    """Writes the records still queued and stops the background thread."""
+    global listener
+    if listener is None:
+        return
+    try:
+        listener.stop()
+    except Full:
+        # The thread is a daemon, so it ends with the process regardless
+        pass
+    listener = None
+
+
+def dropped():
+    """Returns the number of records dropped because the queue was full."""
+    return queue_handler.dropped if queue_handler is not None else 0
+
+
+class _Limit(object):
+    __slots__ = ('start', 'count', 'suppressed')
+
+    def __init__(self, now):
+        self.start = now
+        self.count = 0
+        self.suppressed = 0
+
+
+def _allow(key, now):
+    """Returns whether a message from a call site may be logged, and the
+    number of its messages suppressed since it was last allowed.
+
+    Each call site logs up to `log_message_burst` messages in every window
+    of `log_message_cooldown` seconds, suppressing the rest.
+    """
+    limit = _limits.get(key)
+    if limit is None:
+        limit = _limits[key] = _Limit(now)
+    elif now - limit.start >= log_message_cooldown:
+        limit.start = now
+        limit.count = 0
+
+    if limit.count >= log_message_burst:
+        limit.suppressed += 1
+        return False, 0
+    limit.count += 1
+    suppressed = limit.suppressed
+    limit.suppressed = 0
+    return True, suppressed
+
+
+def logmethod(level):
     """Decorator for setting up the logger in LoggingMixin subclasses.
 
     This does not guarantee that log messages will be generated.  If
     `LoggingMixin.is_debug_enabled` is True, it will be propagated up to the
-    root 'remote' logger.
+    root 'remote' logger. Nothing is done with the arguments unless the
+    logger is enabled for the level, and messages from a call site logging
+    too often are suppressed.
+
+    :param level: The level the decorated method logs at
     """
-    @wraps(func)
-    def wrapper(self, *args, **kwargs):
-        if not init or not self.is_debug_enabled:
-            return
-        if self._logger is None:
-            name = getattr(self, 'name', 'unknown')
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not init or not self.is_debug_enabled:
+                return
+            if self._logger is None:
+                name = getattr(self, 'name', 'unknown')
+
+                # If no name specified, check if the default method is there
+                if (name == 'unknown'):
+                    f_name = getattr(self, '_log_class_name', None)
 
-            # If no name specified, check if the default method is there
-            if (name == 'unknown'):
-                f_name = getattr(self, '_log_class_name', None)
+                    # If default name method available, use it as name
+                    if (callable(f_name)):
+                        name = f_name()
 
-                # If default name method available, use it as name
-                if (callable(f_name)):
-                    name = f_name()
+                self._logger = getLogger(name)
+            if not self._logger.isEnabledFor(level):
+                return
 
-            self._logger = getLogger(name)
-        return func(self, *args, **kwargs)
-    return wrapper
+            caller = sys._getframe(1)
+            allowed, suppressed = _allow(
+                (caller.f_code.co_filename, caller.f_lineno), clock())
+            if not allowed:
+                return
+            if suppressed and args:
+                self._logger.log(level, 'Suppressed %s messages like: %s',
+                                 suppressed, args[0])
+            return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class LoggingMixin(object):
@@ -106,29 +229,29 @@ class LoggingMixin(object):
         """Represents the name of the class."""
         return self.__class__.__name__
 
-    @logmethod
+    @logmethod(logging.DEBUG)
     def debug(self, msg, *args, **kwargs):
         self._logger.debug(msg, *args, **kwargs)
 
-    @logmethod
+    @logmethod(logging.INFO)
     def info(self, msg, *args, **kwargs):
         self._logger.info(msg, *args, **kwargs)
 
-    @logmethod
+    @logmethod(logging.WARNING)
     def warning(self, msg, *args, **kwargs):
         self._logger.warning(msg, *args, **kwargs)
     warn = warning
 
-    @logmethod
+    @logmethod(logging.ERROR)
     def error(self, msg, *args, **kwargs):
         self._logger.error(msg, *args, **kwargs)
 
-    @logmethod
+    @logmethod(logging.ERROR)
     def exception(self, msg, *args, **kwargs):
         # This will not produce a log message if there is no exception to log.
         self._logger.exception(msg, *args, **kwargs)
 
-    @logmethod
+    @logmethod(logging.CRITICAL)
     def critical(self, msg, *args, **kwargs):
         self._logger.critical(msg, *args, **kwargs)
     fatal = critical
@@ -0,0 +1,207 @@
+# =============================================================================
+# FILE: merkle.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import os
+from hashlib import sha256
+from . import logger
+from .packet import MAX_CONTENT_SIZE
+
+# Estimated msgpack overhead of a single [name, is_dir, digest] entry
+_ENTRY_OVERHEAD = 24 + sha256().digest_size
+
+
+class MerkleTree(logger.LoggingMixin):
+    def __init__(self):
+        """Creates a new tree of directory hashes over the content hashes of
+        files, where the hash of a directory covers the names, kinds, and
+        hashes of everything beneath it. Two trees can be compared by
+        descending only into directories whose hashes differ.
+        """
+        # Map of directory relative to root -> {name: digest of the file, or
+        # None for a subdirectory}
+        self._dirs = {'': {}}
+
+        # Map of directory relative to root -> cached hash, dropped whenever
+        # anything beneath the directory changes
+        self._hashes = {}
+        self.is_debug_enabled = True
+
+    @classmethod
+    def build(cls, root, paths, index):
+        """Builds a tree from the content hashes of files, rehashing only
+        the files whose stat information changed since they were indexed.
+
+        :param root: The directory the paths are relative to
+        :param paths: The paths of the files relative to the root
+        :param index: The file index used to look up content hashes
+        :returns: The new tree
+        """
+        tree = cls()
+        for path in paths:
+            try:
+                entry = index.refresh(os.path.join(root, path))
+            except OSError:
+                continue
+            if (entry is not None):
+                tree.set(path, entry.digest)
+        index.flush()
+        return tree
+
+    def set(self, path, digest):
+        """Records the content hash of a file.
+
+        :param path: The path of the file relative to the root
+        :param digest: The content hash of the file
+        """
+        parent, name = os.path.split(path)
+        self._ensure_dir(parent)
+        if (self._dirs.get(path) is not None):
+            self._remove_dir(path)
+        self._dirs[parent][name] = digest
+        self._invalidate(parent)
+
+    def remove(self, path):
+        """Removes a file or directory, pruning directories left empty.
+
+        :param path: The path relative to the root
+        """
+        parent, name = os.path.split(path)
+        children = self._dirs.get(parent)
+        if (children is None or name not in children):
+            return
+        if (children.pop(name) is None):
+            self._remove_dir(path)
+        self._invalidate(parent)
+
+        while parent and not self._dirs[parent]:
+            del self._dirs[parent]
+            self._hashes.pop(parent, None)
+            parent, name = os.path.split(parent)
+            del self._dirs[parent][name]
+
+    def update(self, path, digest):
+        """Records the content hash of a file, or removes it if None.
+
+        :param path: The path of the file relative to the root
+        :param digest: The content hash of the file, or None if deleted
+        """
+        if (digest is None):
+            self.remove(path)
+        else:
+            self.set(path, digest)
+
+    def is_dir(self, path):
+        return path in self._dirs
+
+    def hash(self, path=''):
+        """Returns the hash of a file or directory.
+
+        :param path: The path relative to the root
+        :returns: The digest, or None if the path is not in the tree
+        """
+        if (path in self._dirs):
+            return self._dir_hash(path)
+        parent, name = os.path.split(path)
+        return self._dirs.get(parent, {}).get(name)
+
+    def children(self, path=''):
+        """Returns the immediate children of a directory with their hashes.
+
+        :param path: The directory relative to the root
+        :returns: A list of [name, is_dir, digest] entries sorted by name,
+                  empty if the directory is not in the tree
+        """
+        entries = []
+        for name, digest in sorted(self._dirs.get(path, {}).items()):
+            if (digest is None):
+                child = os.path.join(path, name) if (path) else name
+                entries.append([name, True, self._dir_hash(child)])
+            else:
+                entries.append([name, False, digest])
+        return entries
+
+    def files(self, path=''):
+        """Yields every file beneath a directory.
+
+        :param path: The directory relative to the root
+        :returns: A generator of paths relative to the root
+        """
+        for name, is_dir, _ in self.children(path):
+            child = os.path.join(path, name) if (path) else name
+            if (is_dir):
+                yield from self.files(child)
+            else:
+                yield child
+
+    def pages(self, path='', max_bytes=MAX_CONTENT_SIZE):
+        """Yields the children of a directory in pages sized to fit a single
+        packet.
+
+        :param path: The directory relative to the root
+        :param max_bytes: The maximum estimated encoded size of a page
+        :returns: A generator of lists of [name, is_dir, digest] entries
+        """
+        page = []
+        size = 0
+        for entry in self.children(path):
+            n = len(entry[0].encode('utf-8')) + _ENTRY_OVERHEAD
+            if (page and size + n > max_bytes):
+                yield page
+                page = []
+                size = 0
+            page.append(entry)
+            size += n
+        yield page
+
+    def _ensure_dir(self, rel):
+        if (rel in self._dirs):
+            return
+        parent, name = os.path.split(rel)
+        self._ensure_dir(parent)
+        self._dirs[parent][name] = None
+        self._dirs[rel] = {}
+        self._invalidate(parent)
+
+    def _remove_dir(self, rel):
+        for key in [k for k in self._dirs
+                    if k == rel or k.startswith(rel + os.sep)]:
+            del self._dirs[key]
+            self._hashes.pop(key, None)
+
+    def _invalidate(self, rel):
+        # A directory is only hashed after its subdirectories, so once one
+        # is found without a hash none of its ancestors have one either
+        while self._hashes.pop(rel, None) is not None and rel:
+            rel = os.path.dirname(rel)
+
+    def _dir_hash(self, rel):
+        digest = self._hashes.get(rel)
+        if (digest is None):
+            h = sha256()
+            for name, is_dir, child in self.children(rel):
+                h.update(name.encode('utf-8'))
+                h.update(b'\0d' if (is_dir) else b'\0f')
+                h.update(child)
+            digest = self._hashes[rel] = h.digest()
+        return digest
+
+
+def diff_children(local, remote):
+    """Compares the children of the same directory in two trees.
+
+    :param local: The list of [name, is_dir, digest] entries of one tree
+    :param remote: The list of [name, is_dir, digest] entries of the other
+    :returns: A list of (name, local entry, remote entry) tuples for the
+              children that differ, where a missing entry is None
+    """
+    local = {e[0]: e for e in local}
+    remote = {e[0]: e for e in remote}
+    changed = []
+    for name in sorted(set(local) | set(remote)):
+        a = local.get(name)
+        b = remote.get(name)
+        if (a is None or b is None or a[1] != b[1] or a[2] != b[2]):
+            changed.append((name, a, b))
+    return changed
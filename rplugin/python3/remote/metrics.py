@@ -0,0 +1,367 @@
+# =============================================================================
+# FILE: metrics.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+import json
+import os
+import time
+from bisect import bisect_left
+from .constants import packet_type_name
+
+# Upper bounds in seconds of the buckets of latency histograms, with a last
+# bucket holding everything slower
+DEFAULT_LATENCY_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0,
+)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        """Creates a new histogram counting observations in fixed buckets.
+
+        :param buckets: The ascending upper bounds of the buckets
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        """Records an observation.
+
+        :param value: The value observed
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if (value > self.max):
+            self.max = value
+
+    def reset(self):
+        """Forgets every observation."""
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def mean(self):
+        """Returns the mean of the observations, or 0 if there are none."""
+        return self.total / self.count if (self.count > 0) else 0
+
+    def quantile(self, q):
+        """Returns an upper bound of a quantile of the observations.
+
+        :param q: The quantile from 0 to 1
+        :returns: The upper bound of the bucket holding the quantile, the
+                  largest observation if it is in the last bucket, or 0 if
+                  there are no observations
+        """
+        if (self.count == 0):
+            return 0
+        rank = max(1, q * self.count)
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if (seen >= rank):
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        """Converts histogram into dictionary."""
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean(),
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+        }
+
+
+class Counter(object):
+    """Value that only grows, such as a number of packets."""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge(object):
+    """Value that goes up and down, either set or read from a function
+    whenever it is reported, such as the depth of a queue."""
+    __slots__ = ('value', 'fn')
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def read(self):
+        return self.fn() if (self.fn is not None) else self.value
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        """Creates a new registry of named counters, gauges and histograms.
+
+        Metrics are updated without locks, so each should only be updated
+        from the event loop; they are looked up once and kept by whatever
+        updates them, making an update a single addition.
+        """
+        # Map of name -> metric
+        self._metrics = {}
+
+    def counter(self, name):
+        """Returns the counter of a name, creating it if missing."""
+        return self._get(name, Counter)
+
+    def gauge(self, name, fn=None):
+        """Returns the gauge of a name, creating it if missing.
+
+        :param name: The name of the gauge
+        :param fn: If provided, the function read for the value of the
+                   gauge, replacing any function it had before
+        """
+        g = self._get(name, Gauge)
+        if (fn is not None):
+            g.fn = fn
+        return g
+
+    def histogram(self, name, buckets=DEFAULT_LATENCY_BUCKETS):
+        """Returns the histogram of a name, creating it with the buckets if
+        missing."""
+        return self._get(name, Histogram, buckets)
+
+    def remove(self, name, fn=None):
+        """Removes the metric of a name, such as one reading or describing
+        an object that is going away.
+
+        :param name: The name of the metric
+        :param fn: If provided, the function a gauge must still be reading
+                   to be removed, so a gauge taken over by another object is
+                   kept
+        """
+        metric = self._metrics.get(name)
+        if (metric is None):
+            return
+        if (fn is not None and getattr(metric, 'fn', None) is not fn):
+            return
+        del self._metrics[name]
+
+    def _get(self, name, cls, *args):
+        metric = self._metrics.get(name)
+        if (not isinstance(metric, cls)):
+            metric = self._metrics[name] = cls(*args)
+        return metric
+
+    def snapshot(self):
+        """Returns the current value of every metric.
+
+        :returns: A map of name -> value, where the value of a histogram is
+                  a dictionary of its summary and buckets
+        """
+        result = {}
+        for name, metric in self._metrics.items():
+            if (isinstance(metric, Histogram)):
+                result[name] = metric.to_dict()
+            elif (isinstance(metric, Gauge)):
+                result[name] = metric.read()
+            else:
+                result[name] = metric.value
+        return result
+
+    def format(self):
+        """Formats the current value of every metric, one per line in
+        order of name, with times in milliseconds.
+
+        :returns: The lines of the metrics
+        """
+        lines = []
+        for name, value in sorted(self.snapshot().items()):
+            if (isinstance(value, dict)):
+                value = ('count={} mean={:.3f}ms p99={:.3f}ms max={:.3f}ms'
+                         .format(value['count'], value['mean'] * 1000,
+                                 value['p99'] * 1000, value['max'] * 1000))
+            lines.append('{:<40} {}'.format(name, value))
+        return lines
+
+    def reset(self):
+        """Zeroes every counter and histogram, leaving gauges alone."""
+        for metric in self._metrics.values():
+            if (isinstance(metric, Histogram)):
+                metric.reset()
+            elif (isinstance(metric, Counter)):
+                metric.value = 0
+
+
+# Registry updated by the client, server, packet codec and handlers
+default_registry = MetricsRegistry()
+
+
+def counter(name):
+    """Returns a counter of the default registry."""
+    return default_registry.counter(name)
+
+
+def gauge(name, fn=None):
+    """Returns a gauge of the default registry."""
+    return default_registry.gauge(name, fn)
+
+
+def histogram(name, buckets=DEFAULT_LATENCY_BUCKETS):
+    """Returns a histogram of the default registry."""
+    return default_registry.histogram(name, buckets)
+
+
+def remove(name, fn=None):
+    """Removes a metric of the default registry."""
+    default_registry.remove(name, fn)
+
+
+def write_json(path, data):
+    """Writes data as JSON to a file, replacing it only once written so a
+    reader never sees part of it.
+
+    :param path: The path of the file
+    :param data: The data to write
+    """
+    directory = os.path.dirname(path)
+    if (directory):
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + '.part'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+class MeteredTransport(object):
+    def __init__(self, transport, packets, nbytes):
+        """Wraps a datagram transport, counting every datagram sent.
+
+        :param transport: The transport to wrap
+        :param packets: The counter of datagrams sent
+        :param nbytes: The counter of bytes sent
+        """
+        self._transport = transport
+        self._packets = packets
+        self._bytes = nbytes
+
+    def sendto(self, data, addr=None):
+        self._packets.inc()
+        self._bytes.inc(len(data))
+        self._transport.sendto(data, addr)
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+
+class _TypeStats(object):
+    def __init__(self, buckets):
+        self.count = 0
+        self.bytes = 0
+        self.errors = 0
+        self.latency = Histogram(buckets)
+
+
+class PacketStats(object):
+    def __init__(self, clock=time.monotonic, buckets=DEFAULT_LATENCY_BUCKETS):
+        """Creates a new middleware recording, per packet type, the number of
+        packets dispatched, their bytes, the number whose action failed and
+        a histogram of how long their actions took, where an action returning
+        a future is timed until it completes.
+
+        :param clock: The function returning the current time in seconds
+        :param buckets: The upper bounds of the buckets of latency histograms
+        """
+        self._clock = clock
+        self._buckets = buckets
+
+        # Map of packet type -> stats of the packets of that type
+        self._stats = {}
+
+    def __call__(self, dispatch, action, packet):
+        packet_type = packet.get_header().get_type()
+        stats = self._stats.get(packet_type)
+        if (stats is None):
+            stats = self._stats[packet_type] = _TypeStats(self._buckets)
+        stats.count += 1
+        stats.bytes += packet.get_size() or 0
+
+        start = self._clock()
+        try:
+            result = dispatch(action, packet)
+        except Exception:
+            stats.errors += 1
+            stats.latency.observe(self._clock() - start)
+            raise
+
+        if (asyncio.isfuture(result)):
+            result.add_done_callback(
+                lambda f: self._done(stats, start, f))
+        else:
+            stats.latency.observe(self._clock() - start)
+        return result
+
+    def _done(self, stats, start, future):
+        if (not future.cancelled() and future.exception() is not None):
+            stats.errors += 1
+        stats.latency.observe(self._clock() - start)
+
+    def lookup(self, packet_type):
+        """Returns the stats of a packet type.
+
+        :param packet_type: The type of packet
+        :returns: The stats with count, bytes, errors and latency, or None if
+                  no packet of the type has been dispatched
+        """
+        return self._stats.get(packet_type)
+
+    def reset(self):
+        """Forgets every recorded packet."""
+        self._stats = {}
+
+    def snapshot(self):
+        """Returns the stats of every packet type.
+
+        :returns: A map of the name of a packet type -> dictionary of its
+                  count, bytes, errors and latency
+        """
+        return {
+            str(packet_type_name(packet_type)): {
+                'count': stats.count,
+                'bytes': stats.bytes,
+                'errors': stats.errors,
+                'latency': stats.latency.to_dict(),
+            }
+            for packet_type, stats in self._stats.items()
+        }
+
+    def format(self):
+        """Formats the stats as a table, the packet types whose actions took
+        the most time in total first.
+
+        :returns: The lines of the table
+        """
+        lines = ['{:<24} {:>8} {:>10} {:>6} {:>9} {:>9} {:>10}'.format(
+            'TYPE', 'COUNT', 'BYTES', 'ERRORS', 'MEAN(ms)', 'P99(ms)',
+            'TOTAL(ms)')]
+        rows = sorted(self._stats.items(),
+                      key=lambda item: item[1].latency.total, reverse=True)
+        for packet_type, stats in rows:
+            latency = stats.latency
+            lines.append(
+                '{:<24} {:>8} {:>10} {:>6} {:>9.3f} {:>9.3f} {:>10.1f}'
+                .format(str(packet_type_name(packet_type)), stats.count,
+                        stats.bytes, stats.errors, latency.mean() * 1000,
+                        latency.quantile(0.99) * 1000, latency.total * 1000))
+        return lines
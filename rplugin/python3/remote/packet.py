@@ -4,10 +4,12 @@
 # License: Apache 2.0 License
 # =============================================================================
 import msgpack
+import time
 from hmac import HMAC
 from uuid import uuid4
 from datetime import datetime
-from . import security
+from . import metrics, security
+from .constants import packet_type_name
 
 # Maximum UDP datagram size for IPv4 is 65,507 bytes
 MAX_PACKET_SIZE = 65507
@@ -17,7 +19,12 @@ MAX_PACKET_SIZE = 65507
 MAX_CONTENT_SIZE = 61440  # 60 KiB (~3.97 KiB of bytes for header)
 
 # Represents the version of packets supported
-PACKET_VERSION = '0.1'
+PACKET_VERSION = '0.2'
+
+# Upper bounds in seconds of the buckets of the time taken to decode a packet
+DECODE_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01)
+
+_decode_time = metrics.histogram('packet.decode_seconds', DECODE_BUCKETS)
 
 
 class Packet(object):
@@ -26,6 +33,7 @@ class Packet(object):
     _parent_header = None
     _metadata = None
     _content = None
+    _size = None
 
     @staticmethod
     def empty():
@@ -49,7 +57,9 @@ class Packet(object):
         m = None
 
         if (isinstance(obj, bytes)):
+            start = time.perf_counter()
             m = Packet().from_bytes(obj)
+            _decode_time.observe(time.perf_counter() - start)
 
         return m
 
@@ -166,8 +176,14 @@ class Packet(object):
         self._parent_header = packet._parent_header
         self._metadata = packet._metadata
         self._content = packet._content
+        self._size = len(b)
         return self
 
+    def get_size(self):
+        """Returns the number of bytes the packet was read from, or None if
+        it was not read from bytes."""
+        return self._size
+
     def to_dict(self):
         """Converts packet into dictionary."""
         return {
@@ -283,7 +299,7 @@ class Header(object):
         return self._type
 
     def set_version_current(self):
-        return self.set_verison(PACKET_VERSION)
+        return self.set_version(PACKET_VERSION)
 
     def set_version(self, version):
         self._version = version
@@ -327,7 +343,7 @@ class Header(object):
             'username': self._username,
             'session': self._session,
             'date': self._date,
-            'type': self._type,
+            'type': packet_type_name(self._type),
             'version': self._version,
         }
 
@@ -0,0 +1,188 @@
+# =============================================================================
+# FILE: prefetch.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+import os
+import re
+from collections import OrderedDict, deque
+from . import logger
+
+# Default maximum number of bytes prefetched per session
+DEFAULT_PREFETCH_BUDGET = 64 * 1024 * 1024
+
+# Number of seconds to wait before checking again whether the link is idle
+DEFAULT_IDLE_POLL = 0.25
+
+# Maximum number of candidates of each kind suggested per opened file
+MAX_REFERENCES = 16
+MAX_SIBLINGS = 16
+MAX_RECENT = 8
+
+# Maximum number of paths remembered as already prefetched
+MAX_FETCHED = 1024
+
+# Number of bytes of an opened file scanned for references to other files
+REFERENCE_SCAN_BYTES = 64 * 1024
+
+# Tokens that look like a relative path to a file with an extension
+_REFERENCE_RE = re.compile(r'[\w.-]+(?:/[\w.-]+)*\.[A-Za-z]\w*')
+
+
+def find_references(text, path):
+    """Finds the paths of files that text from a file appears to reference.
+
+    :param text: The text of the file
+    :param path: The path of the file relative to the root
+    :returns: A list of paths relative to the root, in order of appearance
+    """
+    base = os.path.dirname(path)
+    found = []
+    seen = set()
+    for token in _REFERENCE_RE.findall(text):
+        for candidate in (os.path.join(base, token), token):
+            candidate = os.path.normpath(candidate)
+            if (candidate == path or candidate in seen or
+                    candidate.startswith(os.pardir)):
+                continue
+            seen.add(candidate)
+            found.append(candidate)
+    return found
+
+
+class Prefetcher(logger.LoggingMixin):
+    def __init__(self, loop, retrieve, list_tree, is_idle, cached=None,
+                 budget=DEFAULT_PREFETCH_BUDGET, idle_poll=DEFAULT_IDLE_POLL):
+        """Creates a new prefetcher warming the cache with the files most
+        likely to be opened next, one at a time and only while no other
+        transfers are underway.
+
+        :param loop: The event loop to run the prefetcher on
+        :param retrieve: The coroutine function taking a path and a maximum
+                         length and returning the local path of the copy,
+                         or None if not retrieved
+        :param list_tree: The function taking a directory and returning an
+                          async iterator of [name, is_dir, digest] entries
+                          of its children
+        :param is_idle: The function returning True when nothing else is
+                        being transferred
+        :param cached: If provided, the function taking a path and returning
+                       the local path of its cached copy, so copies that
+                       were already current do not count against the budget
+        :param budget: The maximum number of bytes to prefetch
+        :param idle_poll: The number of seconds inbetween checking if idle
+        """
+        self._loop = loop
+        self._retrieve = retrieve
+        self._list_tree = list_tree
+        self._is_idle = is_idle
+        self._cached = cached
+        self._budget = budget
+        self._idle_poll = idle_poll
+        self._used = 0
+        self._queue = deque()
+        self._listing = None
+        self._fetched = OrderedDict()
+        self._current = None
+        self._recent = deque(maxlen=MAX_RECENT)
+        self._task = None
+        self.is_debug_enabled = True
+
+    def used(self):
+        """Returns the number of bytes prefetched so far."""
+        return self._used
+
+    def pending(self):
+        """Returns the paths waiting to be prefetched."""
+        return list(self._queue)
+
+    def opened(self, path, local_path=None):
+        """Suggests the files likely to be opened after a file, replacing
+        the suggestions made for the previously opened file.
+
+        :param path: The path of the file opened relative to the root
+        :param local_path: If provided, the local copy of the file to scan
+                           for references to other files
+        """
+        self._current = path
+        if (path in self._recent):
+            self._recent.remove(path)
+
+        references = []
+        if (local_path is not None):
+            try:
+                with open(local_path, 'rb') as f:
+                    text = f.read(REFERENCE_SCAN_BYTES).decode(
+                        'utf-8', errors='ignore')
+                references = find_references(text, path)[:MAX_REFERENCES]
+            except OSError:
+                pass
+
+        self._queue = deque(references)
+        self._queue.extend(reversed(self._recent))
+        self._listing = os.path.dirname(path)
+        self._recent.append(path)
+
+        if (self._task is None and self._used < self._budget):
+            self._task = self._loop.create_task(self._run())
+
+    def cancel(self):
+        """Stops prefetching."""
+        self._queue.clear()
+        self._listing = None
+        if (self._task is not None):
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        try:
+            while self._queue or self._listing is not None:
+                if (not self._is_idle()):
+                    await asyncio.sleep(self._idle_poll)
+                    continue
+
+                # Siblings come after the files referenced directly, but are
+                # only listed once the link is idle
+                if (not self._queue and self._listing is not None):
+                    await self._queue_siblings(self._listing)
+                    continue
+
+                path = self._queue.popleft()
+                if (path in self._fetched or path == self._current):
+                    continue
+                remaining = self._budget - self._used
+                if (remaining <= 0):
+                    self.debug('Prefetch budget of %s bytes used',
+                               self._budget)
+                    break
+
+                self._remember(path)
+                before = self._cached(path) if (self._cached) else None
+                local_path = await self._retrieve(path, remaining)
+                if (local_path is not None and local_path != before):
+                    self._used += os.path.getsize(local_path)
+                    self.debug('Prefetched %s', path)
+        except Exception as ex:
+            self.error('Prefetch failed: %s', ex)
+        finally:
+            self._task = None
+
+    def _remember(self, path):
+        self._fetched[path] = None
+        if (len(self._fetched) > MAX_FETCHED):
+            self._fetched.popitem(last=False)
+
+    async def _queue_siblings(self, directory):
+        self._listing = None
+        siblings = []
+        async for name, is_dir, _ in self._list_tree(directory):
+            path = os.path.join(directory, name)
+            if (not is_dir and path not in self._fetched and
+                    path != self._current):
+                siblings.append(path)
+
+        # Files of the same kind as the one opened are likelier to be next
+        ext = os.path.splitext(self._current or '')[1]
+        siblings.sort(key=lambda p: os.path.splitext(p)[1] != ext)
+        self._queue.extend(siblings[:MAX_SIBLINGS])
@@ -0,0 +1,549 @@
+# =============================================================================
+# FILE: reassembly.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import msgpack
+import os
+import tempfile
+import time
+from hashlib import sha256
+from . import logger
+
+# Maximum bytes of chunks held in memory across all transfers while waiting
+# for the start of their transfer to arrive
+DEFAULT_MAX_BUFFERED = 16 * 1024 * 1024
+
+# Number of chunks received inbetween persisting the state of a transfer
+DEFAULT_SAVE_INTERVAL = 64
+
+# Number of seconds after which an untouched partial transfer is discarded
+DEFAULT_MAX_STATE_AGE = 7 * 24 * 60 * 60
+
+# Default directory of the state of partial transfers
+DEFAULT_TRANSFER_STATE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'remote', 'transfers')
+
+
+def _pwrite(fd, data, offset):
+    if (hasattr(os, 'pwrite')):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+class ChunkBitmap(object):
+    def __init__(self, total):
+        """Creates a new bitmap tracking which of a number of chunks have
+        been received, using a single bit per chunk.
+
+        :param total: The total number of chunks
+        """
+        self._total = total
+        self._bits = bytearray((total + 7) // 8)
+        self._count = 0
+
+    @staticmethod
+    def from_bytes(total, b):
+        """Creates a bitmap from bytes produced by to_bytes.
+
+        :param total: The total number of chunks
+        :param b: The bytes of the bitmap
+        :returns: A new bitmap instance
+        """
+        bitmap = ChunkBitmap(total)
+        bitmap._bits[:len(b)] = b
+        bitmap._count = sum(1 for i in range(total) if bitmap.has(i))
+        return bitmap
+
+    def set(self, index):
+        """Marks a chunk as received.
+
+        :param index: The index of the chunk
+        :returns: True if the chunk was not already marked, otherwise False
+        """
+        byte, bit = divmod(index, 8)
+        mask = 1 << bit
+        if (self._bits[byte] & mask):
+            return False
+        self._bits[byte] |= mask
+        self._count += 1
+        return True
+
+    def has(self, index):
+        """Checks if a chunk has been received.
+
+        :param index: The index of the chunk
+        :returns: True if received, otherwise False
+        """
+        byte, bit = divmod(index, 8)
+        return bool(self._bits[byte] & (1 << bit))
+
+    def missing(self):
+        """Returns the indexes of chunks not yet received.
+
+        :returns: A generator of chunk indexes
+        """
+        for byte, value in enumerate(self._bits):
+            if (value == 0xFF):
+                continue
+            for bit in range(8):
+                index = byte * 8 + bit
+                if (index < self._total and not value & (1 << bit)):
+                    yield index
+
+    def count(self):
+        return self._count
+
+    def total(self):
+        return self._total
+
+    def complete(self):
+        return self._count == self._total
+
+    def to_bytes(self):
+        return bytes(self._bits)
+
+
+class ChunkReassembler(object):
+    def __init__(self, path, file_length, total_chunks, chunk_size,
+                 temp_path=None, bitmap=None):
+        """Creates a new reassembler writing chunks received in any order
+        straight into a temporary file preallocated next to the target path.
+
+        :param path: The path of the file being received
+        :param file_length: The length of the file in bytes
+        :param total_chunks: The total number of chunks of the file
+        :param chunk_size: The number of bytes within each chunk but the last
+        :param temp_path: If provided, the existing temporary file of an
+                          interrupted transfer to resume
+        :param bitmap: If provided, the chunks already within the existing
+                       temporary file
+        """
+        self.path = path
+        self.file_length = file_length
+        self.chunk_size = chunk_size
+        self.bitmap = bitmap if (bitmap is not None) else (
+            ChunkBitmap(total_chunks))
+
+        if (temp_path is not None):
+            self.temp_path = temp_path
+            self._fd = os.open(temp_path, os.O_RDWR)
+        else:
+            directory, name = os.path.split(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            self._fd, self.temp_path = tempfile.mkstemp(
+                prefix='.{}.'.format(name), suffix='.part', dir=directory)
+            self._preallocate()
+
+    def write(self, index, data):
+        """Writes a chunk at its offset within the file.
+
+        :param index: The index of the chunk
+        :param data: The bytes of the chunk
+        :returns: True if written, False if out of range, already received
+                  or not the length of the chunk at the index
+        """
+        if (index < 0 or index >= self.bitmap.total() or
+                self.bitmap.has(index)):
+            return False
+
+        # A chunk of the wrong length would overwrite its neighbour or grow
+        # the file past its declared length
+        offset = index * self.chunk_size
+        if (len(data) != min(self.chunk_size, self.file_length - offset)):
+            return False
+        _pwrite(self._fd, data, offset)
+        self.bitmap.set(index)
+        return True
+
+    def complete(self):
+        """Returns whether or not every chunk has been received.
+
+        :returns: True if complete, otherwise False
+        """
+        return self.bitmap.complete()
+
+    def commit(self):
+        """Atomically moves the completed file into place.
+
+        :returns: The path of the file
+        """
+        assert self.complete(), 'Transfer is not complete!'
+        try:
+            mode = os.stat(self.path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.fchmod(self._fd, mode)
+        os.fsync(self._fd)
+        self._close()
+        os.replace(self.temp_path, self.path)
+        return self.path
+
+    def abort(self):
+        """Discards the partially-received file."""
+        self._close()
+        try:
+            os.unlink(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+    def sync(self):
+        """Flushes written chunks to disk so the bitmap can be persisted."""
+        if (self._fd is not None):
+            os.fsync(self._fd)
+
+    def suspend(self):
+        """Flushes and closes the partially-received file, keeping it on
+        disk so the transfer can be resumed."""
+        self.sync()
+        self._close()
+
+    def _preallocate(self):
+        if (self.file_length <= 0):
+            return
+        if (hasattr(os, 'posix_fallocate')):
+            try:
+                os.posix_fallocate(self._fd, 0, self.file_length)
+                return
+            except OSError:
+                # Not all filesystems support allocation
+                pass
+        os.ftruncate(self._fd, self.file_length)
+
+    def _close(self):
+        if (self._fd is not None):
+            os.close(self._fd)
+            self._fd = None
+
+
+class TransferStore(logger.LoggingMixin):
+    def __init__(self, state_dir):
+        """Creates a new store persisting the state of partial transfers so
+        they can be resumed after a disconnect or restart.
+
+        :param state_dir: The directory to keep the state files within
+        """
+        self.state_dir = state_dir
+        self.is_debug_enabled = True
+
+    def save(self, version, reassembler):
+        """Persists the state of a transfer. Chunks must be synced to disk
+        before their bits are saved.
+
+        :param version: The version of the file being received
+        :param reassembler: The reassembler of the transfer
+        """
+        r = reassembler
+        os.makedirs(self.state_dir, exist_ok=True)
+        state_path = self._state_path(r.path)
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(msgpack.packb({
+                'path': r.path,
+                'version': version,
+                'length': r.file_length,
+                'total': r.bitmap.total(),
+                'chunk_size': r.chunk_size,
+                'bitmap': r.bitmap.to_bytes(),
+                'temp_path': r.temp_path,
+                'updated': time.time(),
+            }, use_bin_type=True))
+        os.replace(tmp_path, state_path)
+
+    def load(self, path):
+        """Loads the persisted state of a transfer of a file.
+
+        :param path: The path of the file being received
+        :returns: The state as a dictionary, or None if not found
+        """
+        try:
+            with open(self._state_path(path), 'rb') as f:
+                state = msgpack.unpackb(f.read(), raw=False)
+        except (OSError, ValueError):
+            return None
+        if (not isinstance(state, dict) or state.get('path') != path):
+            return None
+        return state
+
+    def remove(self, path):
+        """Removes the persisted state of a transfer of a file.
+
+        :param path: The path of the file being received
+        """
+        try:
+            os.unlink(self._state_path(path))
+        except FileNotFoundError:
+            pass
+
+    def collect(self, max_age=DEFAULT_MAX_STATE_AGE, now=None):
+        """Discards partial transfers that have not been touched recently,
+        removing both their state and their temporary file.
+
+        :param max_age: The number of seconds after which a transfer is stale
+        :param now: The current time, defaulting to the time of the call
+        :returns: The number of transfers discarded
+        """
+        if (not os.path.isdir(self.state_dir)):
+            return 0
+
+        now = time.time() if (now is None) else now
+        count = 0
+        for name in os.listdir(self.state_dir):
+            if (not name.endswith('.state')):
+                continue
+            state_path = os.path.join(self.state_dir, name)
+            try:
+                with open(state_path, 'rb') as f:
+                    state = msgpack.unpackb(f.read(), raw=False)
+                updated = state.get('updated', 0)
+                temp_path = state.get('temp_path')
+            except (OSError, ValueError, AttributeError):
+                updated = 0
+                temp_path = None
+
+            if (now - updated < max_age):
+                continue
+            self.debug('Discarding stale transfer %s', state_path)
+            for p in (temp_path, state_path):
+                if (p is not None):
+                    try:
+                        os.unlink(p)
+                    except FileNotFoundError:
+                        pass
+            count += 1
+        return count
+
+    def _state_path(self, path):
+        name = sha256(path.encode('utf-8')).hexdigest() + '.state'
+        return os.path.join(self.state_dir, name)
+
+
+class ReassemblyManager(logger.LoggingMixin):
+    def __init__(self, max_buffered=DEFAULT_MAX_BUFFERED, store=None,
+                 save_interval=DEFAULT_SAVE_INTERVAL):
+        """Creates a new manager of incoming chunked transfers.
+
+        :param max_buffered: The maximum number of bytes of chunks held in
+                             memory across all transfers whose start has not
+                             arrived yet; chunks beyond the cap are dropped
+                             and must be resent
+        :param store: If provided, the store used to persist the state of
+                      transfers so they can be resumed
+        :param save_interval: The number of chunks received by a transfer
+                              inbetween persisting its state
+        """
+        self.max_buffered = max_buffered
+        self.store = store
+        self.save_interval = save_interval
+        self.is_debug_enabled = True
+
+        # Map of (session, path) -> chunks received since last persisted
+        self._unsaved = {}
+
+        # Map of (session, path) -> (version, reassembler)
+        self._transfers = {}
+
+        # Map of (session, path) -> (version, {index: data})
+        self._buffered = {}
+        self._buffered_bytes = 0
+
+        # Map of (session, path) -> last version completed, so retransmitted
+        # chunks of it are not buffered again
+        self._completed = {}
+
+    def start(self, session, path, version, file_length,
+              total_chunks, chunk_size):
+        """Starts receiving a version of a file, superseding any transfer of
+        an older version of the same file.
+
+        :param session: The session sending the file
+        :param path: The path of the file
+        :param version: The version of the file
+        :param file_length: The length of the file in bytes
+        :param total_chunks: The total number of chunks of the file
+        :param chunk_size: The number of bytes within each chunk but the last
+        :returns: The path of the file if already complete, otherwise None
+        """
+        key = (session, path)
+        if (self._completed.get(key, -1) >= version):
+            return None
+
+        current = self._transfers.get(key)
+        if (current is not None):
+            if (current[0] == version):
+                return None
+            self._discard(key)
+
+        r = self._resume(path, version, file_length, total_chunks, chunk_size)
+        if (r is None):
+            r = ChunkReassembler(path, file_length, total_chunks, chunk_size)
+        self._transfers[key] = (version, r)
+        self._unsaved[key] = 0
+
+        early = self._buffered.pop(key, None)
+        if (early is not None):
+            early_version, chunks = early
+            for index, data in chunks.items():
+                self._buffered_bytes -= len(data)
+                if (early_version == version):
+                    r.write(index, data)
+
+        return self._finish(key)
+
+    def receive(self, session, path, version, index, data):
+        """Receives a chunk of a file, writing it straight to disk if its
+        transfer has started and buffering it in memory otherwise.
+
+        :param session: The session sending the file
+        :param path: The path of the file
+        :param version: The version of the file the chunk belongs to
+        :param index: The index of the chunk
+        :param data: The bytes of the chunk
+        :returns: The path of the file if now complete, otherwise None
+        """
+        key = (session, path)
+        current = self._transfers.get(key)
+        if (current is not None and current[0] == version):
+            if (current[1].write(index, data)):
+                self._unsaved[key] += 1
+                if (self._unsaved[key] >= self.save_interval):
+                    self._save(key)
+            return self._finish(key)
+        if (current is not None and current[0] > version):
+            return None
+        if (self._completed.get(key, -1) >= version):
+            return None
+
+        self._buffer(key, version, index, data)
+        return None
+
+    def received(self, session, path, version, total_chunks):
+        """Returns the chunks of a version of a file already received.
+
+        :param session: The session sending the file
+        :param path: The path of the file
+        :param version: The version of the file
+        :param total_chunks: The total number of chunks of the file
+        :returns: The bitmap of received chunks
+        """
+        key = (session, path)
+        current = self._transfers.get(key)
+        if (current is not None and current[0] == version):
+            return current[1].bitmap
+
+        bitmap = ChunkBitmap(total_chunks)
+        if (self._completed.get(key, -1) >= version):
+            for index in range(total_chunks):
+                bitmap.set(index)
+        return bitmap
+
+    def has_transfer(self, session, path):
+        return (session, path) in self._transfers
+
+    def buffered_bytes(self):
+        return self._buffered_bytes
+
+    def abort_all(self):
+        """Discards every partially-received file and buffered chunk."""
+        for key in list(self._transfers):
+            self._discard(key)
+        self._buffered.clear()
+        self._buffered_bytes = 0
+        self._completed.clear()
+
+    def suspend_all(self):
+        """Persists and closes every partially-received file so that the
+        transfers can be resumed later, discarding buffered chunks."""
+        for key in list(self._transfers):
+            self._suspend(key)
+        self._buffered.clear()
+        self._buffered_bytes = 0
+
+    def _resume(self, path, version, file_length, total_chunks, chunk_size):
+        if (self.store is None):
+            return None
+
+        # Another session (such as from before a reconnect) may still hold
+        # the partial file open
+        for key in [k for k in self._transfers if k[1] == path]:
+            self._suspend(key)
+
+        state = self.store.load(path)
+        if (state is None):
+            return None
+
+        temp_path = state.get('temp_path')
+        if (state.get('version') == version and
+                state.get('length') == file_length and
+                state.get('total') == total_chunks and
+                state.get('chunk_size') == chunk_size and
+                temp_path is not None and os.path.exists(temp_path)):
+            self.info('Resuming transfer of %s', path)
+            return ChunkReassembler(
+                path, file_length, total_chunks, chunk_size,
+                temp_path=temp_path,
+                bitmap=ChunkBitmap.from_bytes(total_chunks, state['bitmap']),
+            )
+
+        # State is of a different version, so its partial file is useless
+        if (temp_path is not None):
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+        self.store.remove(path)
+        return None
+
+    def _save(self, key):
+        self._unsaved[key] = 0
+        if (self.store is not None):
+            version, r = self._transfers[key]
+            r.sync()
+            self.store.save(version, r)
+
+    def _suspend(self, key):
+        version, r = self._transfers.pop(key)
+        self._unsaved.pop(key, None)
+        if (self.store is not None):
+            r.suspend()
+            self.store.save(version, r)
+        else:
+            r.abort()
+
+    def _discard(self, key):
+        version, r = self._transfers.pop(key)
+        self._unsaved.pop(key, None)
+        r.abort()
+        if (self.store is not None):
+            self.store.remove(r.path)
+
+    def _buffer(self, key, version, index, data):
+        early = self._buffered.get(key)
+        if (early is not None and early[0] != version):
+            if (early[0] > version):
+                return
+            for old in early[1].values():
+                self._buffered_bytes -= len(old)
+            early = None
+        if (early is None):
+            early = self._buffered[key] = (version, {})
+
+        if (index in early[1]):
+            return
+        if (self._buffered_bytes + len(data) > self.max_buffered):
+            self.debug('Dropping chunk %s of %s, buffer is full', index, key)
+            return
+        early[1][index] = data
+        self._buffered_bytes += len(data)
+
+    def _finish(self, key):
+        version, r = self._transfers[key]
+        if (not r.complete()):
+            return None
+        del self._transfers[key]
+        del self._unsaved[key]
+        self._completed[key] = version
+        if (self.store is not None):
+            self.store.remove(r.path)
+        return r.commit()
@@ -3,39 +3,259 @@
 # AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.cop>
 # License: Apache 2.0 License
 # =============================================================================
+import asyncio
+from collections import deque
+from functools import partial
+from itertools import count
+from . import logger
+from .constants import PACKET_TYPE_LIMIT, PACKET_TYPE_MASK, packet_type_name
 
+# Priority classes of packet types, from most to least urgent
+PRIORITY_CONTROL = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+PRIORITIES = (PRIORITY_CONTROL, PRIORITY_INTERACTIVE, PRIORITY_BULK)
 
-class ActionRegistry(object):
-    def __init__(self):
-        self._registry = {}
+# Default maximum number of packets of a type waiting to be processed, past
+# which packets of the type are dropped for their sender to resend
+DEFAULT_MAX_QUEUED = 256
 
-    def register(self, packet_type, action):
+# Number of queued packets processed before yielding to the loop, bounding
+# how long a packet processed as it arrives waits behind queued ones
+DEFAULT_BATCH = 8
+
+# Entry of the dispatch table for a packet type without an action
+_UNREGISTERED = (None, None)
+
+
+class _Queue(object):
+    def __init__(self, action, priority, workers, max_queued):
+        self.action = action
+        self.priority = priority
+        self.workers = workers
+        self.max_queued = max_queued
+
+        # Queue of (sequence, packet) waiting for a worker
+        self.packets = deque()
+        self.active = 0
+        self.dropped = 0
+
+    def ready(self):
+        return bool(self.packets) and self.active < self.workers
+
+    def full(self):
+        return len(self.packets) >= self.max_queued
+
+
+class ActionRegistry(logger.LoggingMixin):
+    def __init__(self, loop=None, batch=DEFAULT_BATCH):
+        """Creates a new registry of actions by packet type.
+
+        Packets of a type registered without workers are processed as they
+        arrive. Packets of any other type wait in a bounded queue of their
+        own until one of its workers is free, with queues of a more urgent
+        priority served first and queues of the same priority served in the
+        order their packets arrived. A packet arriving at a full queue is
+        dropped, leaving the socket free for packets of other types.
+
+        :param loop: The event loop queued packets are processed on,
+                     defaulting to the current event loop
+        :param batch: The number of queued packets processed before yielding
+                      to the loop
+        """
+        # Table of (action, queue) indexed by packet type code
+        self._table = [_UNREGISTERED] * PACKET_TYPE_LIMIT
+        self._loop = loop
+        self._batch = batch
+        self.is_debug_enabled = True
+
+        # Map of packet type -> queue of packets waiting to be processed
+        self._queues = {}
+
+        # Order of arrival of queued packets, shared by every queue
+        self._sequence = count()
+
+        # Functions wrapped around every action, outermost first
+        self._middleware = []
+        self._invoke = self._call
+
+        self._handle = None
+        self._idle = None
+
+    def use(self, middleware):
+        """Adds a middleware wrapped around every action, within those
+        added before it.
+
+        A middleware is a function taking the next function in the chain, the
+        action and the packet, returning the result of calling the next
+        function with the action and packet.
+
+        :param middleware: The middleware to add
+        """
+        self._middleware.append(middleware)
+        invoke = self._call
+        for m in reversed(self._middleware):
+            invoke = partial(m, invoke)
+        self._invoke = invoke
+
+    def register(self, packet_type, action, priority=PRIORITY_CONTROL,
+                 workers=0, max_queued=DEFAULT_MAX_QUEUED):
         """Registers an action to be performed when a packet of the following
         type is received.
 
-        :param packet_type: The type of packet to be funneled to the specified
-                            action
+        :param packet_type: The code of the type of packet to be funneled to
+                            the specified action
         :param action: The function to invoke, taking the instance of the
-                       packet as an argument
+                       packet as an argument; a coroutine function is run
+                       as a task
+        :param priority: The priority class of the packet type when queued
+        :param workers: The number of packets of the type processed at the
+                        same time, where an action returning a future or
+                        coroutine occupies its worker until it completes;
+                        if 0, packets are processed as they arrive
+        :param max_queued: The maximum number of packets of the type waiting
+                           for a worker
         """
-        self._registry[packet_type] = action
+        queue = None
+        if (workers > 0):
+            queue = _Queue(action, priority, workers, max_queued)
+            self._queues[packet_type] = queue
+        else:
+            self._queues.pop(packet_type, None)
+        self._table[packet_type] = (action, queue)
 
     def lookup(self, packet_type):
         """Looks up an action by the type of packet.
 
-        :param packet_type: The type of packet to be whose associated action
-                            to retrieve
+        :param packet_type: The code of the type of packet to be whose
+                            associated action to retrieve
         :returns: The action if found, otherwise None
         """
-        key = packet_type
-        return self._registry[key] if (key in self._registry) else None
+        return self._table[packet_type & PACKET_TYPE_MASK][0]
 
     def process(self, packet):
-        """Processes a packet instance using the associated action.
+        """Processes a packet instance using the associated action, or queues
+        it if its type has workers.
 
         :param packet: The packet to process
-        :returns: The result of the action, or None if no action found
+        :returns: The result of the action, the task running it if a
+                  coroutine, or None if no action found or the packet queued
         """
         packet_type = packet.get_header().get_type()
-        action = self.lookup(packet_type)
-        return action(packet) if (action is not None) else None
+        action, queue = self._table[packet_type & PACKET_TYPE_MASK]
+        if (queue is not None):
+            self._enqueue(queue, packet)
+            return None
+        if (action is None):
+            return None
+
+        result = self._invoke(action, packet)
+        if (asyncio.isfuture(result)):
+            result.add_done_callback(
+                lambda f: self._check_failure(packet_type, f))
+        return result
+
+    def queue_types(self):
+        """Returns the packet types whose packets are queued for workers."""
+        return list(self._queues)
+
+    def queued(self, packet_type):
+        """Returns the number of packets of a type waiting for a worker."""
+        queue = self._queues.get(packet_type)
+        return len(queue.packets) if (queue is not None) else 0
+
+    def active(self, packet_type):
+        """Returns the number of packets of a type being processed."""
+        queue = self._queues.get(packet_type)
+        return queue.active if (queue is not None) else 0
+
+    def dropped(self, packet_type):
+        """Returns the number of packets of a type dropped by a full queue."""
+        queue = self._queues.get(packet_type)
+        return queue.dropped if (queue is not None) else 0
+
+    async def join(self):
+        """Waits until every queued packet has been processed."""
+        if (not self._is_idle()):
+            if (self._idle is None):
+                self._idle = self._get_loop().create_future()
+            await asyncio.shield(self._idle)
+
+    def _get_loop(self):
+        if (self._loop is None):
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def _call(self, action, packet):
+        result = action(packet)
+        if (asyncio.iscoroutine(result)):
+            return self._get_loop().create_task(result)
+        return result
+
+    def _enqueue(self, queue, packet):
+        if (queue.full()):
+            queue.dropped += 1
+            return
+        queue.packets.append((next(self._sequence), packet))
+        self._schedule()
+
+    def _schedule(self):
+        if (self._handle is None and
+                any(q.ready() for q in self._queues.values())):
+            self._handle = self._get_loop().call_soon(self._drain)
+
+    def _next(self):
+        best = None
+        for packet_type, queue in self._queues.items():
+            if (queue.ready()):
+                key = (queue.priority, queue.packets[0][0])
+                if (best is None or key < best[0]):
+                    best = (key, packet_type, queue)
+        return best[1:] if (best is not None) else (None, None)
+
+    def _drain(self):
+        self._handle = None
+        for _ in range(self._batch):
+            packet_type, queue = self._next()
+            if (queue is None):
+                break
+            self._dispatch(packet_type, queue)
+        self._schedule()
+        self._check_idle()
+
+    def _dispatch(self, packet_type, queue):
+        _, packet = queue.packets.popleft()
+        queue.active += 1
+        try:
+            result = self._invoke(queue.action, packet)
+        except Exception:
+            self.exception('Failed to process %s packet',
+                           packet_type_name(packet_type))
+            result = None
+
+        if (asyncio.isfuture(result)):
+            result.add_done_callback(
+                lambda f: self._finished(packet_type, queue, f))
+        else:
+            queue.active -= 1
+
+    def _finished(self, packet_type, queue, future):
+        queue.active -= 1
+        self._check_failure(packet_type, future)
+        self._schedule()
+        self._check_idle()
+
+    def _check_failure(self, packet_type, future):
+        if (not future.cancelled() and future.exception() is not None):
+            self.error('Failed to process %s packet: %s',
+                       packet_type_name(packet_type), future.exception())
+
+    def _is_idle(self):
+        return all(not q.packets and q.active == 0
+                   for q in self._queues.values())
+
+    def _check_idle(self):
+        if (self._idle is not None and self._is_idle()):
+            if (not self._idle.done()):
+                self._idle.set_result(None)
+            self._idle = None
@@ -0,0 +1,196 @@
+# =============================================================================
+# FILE: scheduler.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+from collections import deque
+from . import logger
+
+# Priority classes of transfers, from most to least urgent
+PRIORITY_CURRENT = 0
+PRIORITY_VISIBLE = 1
+PRIORITY_BACKGROUND = 2
+PRIORITIES = (PRIORITY_CURRENT, PRIORITY_VISIBLE, PRIORITY_BACKGROUND)
+
+# Default maximum number of transfers sending at the same time
+DEFAULT_MAX_CONCURRENT = 4
+
+# Number of sends made without a rate limit before yielding to the loop
+DEFAULT_BATCH = 8
+
+# Smallest pause worth sleeping for when enforcing a rate limit
+_MIN_SLEEP = 0.005
+
+
+class _Transfer(object):
+    def __init__(self, key, priority, sends, future):
+        self.key = key
+        self.priority = priority
+        self.sends = sends
+        self.future = future
+        self.sent = 0
+
+
+class TransferScheduler(logger.LoggingMixin):
+    def __init__(self, loop, max_concurrent=DEFAULT_MAX_CONCURRENT,
+                 max_rate=None, batch=DEFAULT_BATCH):
+        """Creates a new scheduler interleaving the sends of many transfers.
+
+        Transfers are admitted by priority class up to a maximum number at a
+        time, with an admitted transfer of a lower class paused whenever a
+        transfer of a higher class is waiting. Each send goes to the highest
+        class with admitted transfers, taking turns within the class so its
+        transfers share the bandwidth.
+
+        :param loop: The event loop to run the scheduler on
+        :param max_concurrent: The maximum number of admitted transfers
+        :param max_rate: If provided, the maximum number of bytes per second
+                         sent across all transfers
+        :param batch: The number of sends made inbetween yielding to the
+                      loop when no rate limit is set
+        """
+        self._loop = loop
+        self._max_concurrent = max_concurrent
+        self._max_rate = max_rate
+        self._batch = batch
+        self._transfers = {}
+        self._waiting = [deque() for _ in PRIORITIES]
+        self._active = [deque() for _ in PRIORITIES]
+        self._pump_task = None
+        self.is_debug_enabled = True
+
+    def submit(self, key, sends, priority=PRIORITY_BACKGROUND):
+        """Submits a transfer, superseding any transfer with the same key.
+
+        :param key: The key identifying the transfer, such as its path
+        :param sends: An iterator that performs one send per step, yielding
+                      the number of bytes sent
+        :param priority: The priority class of the transfer
+        :returns: A future resolved once every send has been made
+        """
+        self.cancel(key)
+
+        t = _Transfer(key, priority, sends, self._loop.create_future())
+        self._transfers[key] = t
+        self._waiting[priority].append(t)
+        self._admit()
+
+        if (self._pump_task is None):
+            self._pump_task = self._loop.create_task(self._pump())
+        return t.future
+
+    def cancel(self, key):
+        """Cancels a transfer.
+
+        :param key: The key identifying the transfer
+        :returns: True if a transfer was cancelled, otherwise False
+        """
+        t = self._transfers.get(key)
+        if (t is None):
+            return False
+        t.future.cancel()
+        self._finish(t)
+        return True
+
+    def clear(self):
+        """Cancels every transfer."""
+        for key in list(self._transfers):
+            self.cancel(key)
+
+    def pending(self):
+        """Returns the keys of the transfers not yet finished.
+
+        :returns: A list of keys
+        """
+        return list(self._transfers)
+
+    def active(self):
+        """Returns the keys of the transfers currently admitted.
+
+        :returns: A list of keys, most urgent class first
+        """
+        return [t.key for q in self._active for t in q]
+
+    def _admit(self):
+        while True:
+            w = next((p for p in PRIORITIES if self._waiting[p]), None)
+            if (w is None):
+                return
+
+            count = sum(len(q) for q in self._active)
+            if (count < self._max_concurrent):
+                self._active[w].append(self._waiting[w].popleft())
+                continue
+
+            # Preempt the least urgent admitted transfer if less urgent
+            low = next((p for p in reversed(PRIORITIES)
+                        if self._active[p]), None)
+            if (low is None or low <= w):
+                return
+            t = self._active[low].pop()
+            self.debug('Pausing %s for more urgent transfer', t.key)
+            self._waiting[low].appendleft(t)
+            self._active[w].append(self._waiting[w].popleft())
+
+    def _next(self):
+        for q in self._active:
+            if (q):
+                t = q[0]
+                q.rotate(-1)
+                return t
+        return None
+
+    def _finish(self, t, ex=None):
+        if (self._transfers.get(t.key) is t):
+            del self._transfers[t.key]
+        for q in self._active[t.priority], self._waiting[t.priority]:
+            if (t in q):
+                q.remove(t)
+
+        close = getattr(t.sends, 'close', None)
+        if (callable(close)):
+            close()
+
+        if (not t.future.done()):
+            if (ex is not None):
+                t.future.set_exception(ex)
+            else:
+                t.future.set_result(t.sent)
+        self._admit()
+
+    async def _pump(self):
+        try:
+            sends = 0
+            next_time = self._loop.time()
+            while True:
+                t = self._next()
+                if (t is None):
+                    break
+
+                # Whoever awaited the transfer has given up on it
+                if (t.future.done()):
+                    self._finish(t)
+                    continue
+
+                try:
+                    n = next(t.sends)
+                except StopIteration:
+                    self._finish(t)
+                    continue
+                except Exception as ex:
+                    self.error('Transfer of %s failed: %s', t.key, ex)
+                    self._finish(t, ex)
+                    continue
+                t.sent += n
+                sends += 1
+
+                if (self._max_rate):
+                    now = self._loop.time()
+                    next_time = max(now, next_time) + n / self._max_rate
+                    if (next_time - now >= _MIN_SLEEP):
+                        await asyncio.sleep(next_time - now)
+                elif (sends % self._batch == 0):
+                    await asyncio.sleep(0)
+        finally:
+            self._pump_task = None
@@ -3,17 +3,43 @@
 # AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
 # License: Apache 2.0 License
 # =============================================================================
+import os
 from asyncio import DatagramProtocol
-from . import logger
+from functools import partial
+from . import logger, metrics
+from .builders import build_tell_file_changed
+from .capture import DIRECTION_IN, CaptureTransport, CaptureWriter
+from .constants import (
+    MESSAGE_DEFAULT_SESSION,
+    MESSAGE_DEFAULT_USERNAME,
+    packet_type_name,
+)
+from .index import FileIndex
 from .packet import Packet
+from .reassembly import DEFAULT_MAX_STATE_AGE, TransferStore
 from .security import new_hmac_from_key
 from .handlers.server import ServerHandler
+from .timer import Timer
+from .watcher import FileWatcher, describe_changes, split_changes
+
+# Number of seconds inbetween discarding stale partial transfers
+STATE_COLLECT_INTERVAL = 60 * 60
 
 
 class RemoteServer(logger.LoggingMixin):
-    def __init__(self, nvim, loop, addr, port, key):
+    def __init__(self, nvim, loop, addr, port, key, root=None,
+                 state_dir=None, index=None, watch=True, prepare=False,
+                 progress=None, capture=None):
         self.nvim = nvim
         self.loop = loop
+        self.root = os.path.abspath(root if (root is not None) else '.')
+        self.state_dir = state_dir
+        self.index = index if (index is not None) else FileIndex(None)
+        self.watch = watch
+        self.prepare = prepare
+        self.progress = progress
+        self.capture_path = capture
+        self.capture = None
         self.is_debug_enabled = True
 
         self.info = {}
@@ -24,6 +50,10 @@ class RemoteServer(logger.LoggingMixin):
         self.hmac = new_hmac_from_key(key)
         self.transport = None
         self.protocol = None
+        self.collect_timer = None
+
+        # Changes to files beneath the root, batched before being broadcast
+        self.watcher = FileWatcher(loop, self.root, self._files_changed)
 
     def is_running(self):
         return self.transport is not None
@@ -38,8 +68,37 @@ class RemoteServer(logger.LoggingMixin):
         self.transport.sendto(data, addr)
 
     def broadcast_file_change(self, filename):
-        # TODO: Implement
-        return None
+        """Tells every client that a file has changed once the current
+        batch of changes is emitted.
+
+        :param filename: The path of the file changed
+        """
+        self.watcher.batcher.add(os.path.abspath(filename))
+
+    async def _files_changed(self, changes):
+        """Broadcasts a batch of changed files with their new versions.
+
+        :param changes: The list of (path, deleted) tuples
+        """
+        if (self.protocol is not None):
+            for path, _ in changes:
+                self.protocol.handler.dir_index.update(path)
+
+        # Hashing changed files can take a while, so keep it off the loop
+        entries = await self.loop.run_in_executor(
+            None, describe_changes, self.index, self.root, changes)
+        if (self.protocol is None):
+            return
+        for path, _ in changes:
+            entry = self.index.lookup(path)
+            self.protocol.handler.update_tree(
+                path, entry.digest if (entry is not None) else None)
+        for group in split_changes(entries):
+            self.protocol.broadcast(build_tell_file_changed(
+                username=MESSAGE_DEFAULT_USERNAME,
+                session=MESSAGE_DEFAULT_SESSION,
+                changes=group,
+            ))
 
     def run(self, cb):
         """Starts the remote server, adding it to the event loop and running
@@ -49,45 +108,131 @@ class RemoteServer(logger.LoggingMixin):
 
         :param cb: The callback to invoke when the server is ready
         """
+        if (self.capture_path is not None):
+            self.capture = CaptureWriter(self.capture_path)
         listen = self.loop.create_datagram_endpoint(
-            lambda: RemoteServerProtocol(self.nvim, self.hmac),
+            lambda: RemoteServerProtocol(self.nvim, self.hmac, self.loop,
+                                         self.root, self.state_dir,
+                                         self.index, self.capture),
             local_addr=(self.info['addr'], self.info['port'])
         )
 
+        # Partial transfers abandoned by clients are eventually discarded,
+        # sweeping the disk off the loop
+        if (self.state_dir is not None):
+            store = TransferStore(self.state_dir)
+            self.collect_timer = Timer(
+                self.loop, STATE_COLLECT_INTERVAL
+            ).set_handler(self.loop.run_in_executor, None, store.collect,
+                          DEFAULT_MAX_STATE_AGE).start()
+
+        if (self.watch):
+            self.watcher.start()
+
         def ready(future):
             transport, protocol = future.result()
-            self.transport = transport
             self.protocol = protocol
 
+            # Sends go through the transport of the protocol so they can be
+            # captured
+            self.transport = transport
+            if (protocol is not None and protocol.transport is not None):
+                self.transport = protocol.transport
+
             err = None
             if (transport is None or protocol is None):
                 err = Exception('Failed to bind to {}:{}'
                                 .format(self.info['addr'], self.info['port']))
+            else:
+                # Index up front so the first client does not wait for it
+                protocol.handler.index_progress = self.progress
+                if (self.prepare):
+                    protocol.handler.prepare()
             cb(err)
 
         self.loop.create_task(listen).add_done_callback(ready)
 
     def stop(self):
         """Stops the remote server, removing it from the event loop."""
+        if (self.collect_timer is not None):
+            self.collect_timer.stop()
+            self.collect_timer = None
+        self.watcher.stop()
+        self.index.close()
+        if (self.protocol is not None):
+            self.protocol.handler.commands.cancel_all()
+            self.protocol.handler.reassembly.suspend_all()
+            self.protocol.handler.archives.abort_all()
+            self.protocol.remove_gauges()
         if (self.transport is not None):
             self.transport.close()
             self.transport = None
         self.protocol = None
+        if (self.capture is not None):
+            self.capture.close()
+            self.capture = None
 
 
 class RemoteServerProtocol(DatagramProtocol, logger.LoggingMixin):
-    def __init__(self, nvim, hmac):
+    def __init__(self, nvim, hmac, loop=None, root=None, state_dir=None,
+                 index=None, capture=None):
         self.nvim = nvim
         self.hmac = hmac
+
+        # If provided, the capture writer recording every datagram
+        self.capture = capture
         self.handler = ServerHandler(
             nvim=nvim,
-            send=lambda data, addr: self.transport.sendto(data, addr),
-            broadcast=None,
+            send=lambda packet, addr: self.transport.sendto(
+                packet.gen_signature(self.hmac).to_bytes(), addr),
+            broadcast=self.broadcast,
+            loop=loop,
+            root=root,
+            state_dir=state_dir,
+            index=index,
         )
         self.transport = None
         self.is_debug_enabled = True
 
+        # Traffic of every server
+        self._packets_in = metrics.counter('server.packets_in')
+        self._bytes_in = metrics.counter('server.bytes_in')
+        self._packets_out = metrics.counter('server.packets_out')
+        self._bytes_out = metrics.counter('server.bytes_out')
+        self._invalid = metrics.counter('server.invalid_dropped')
+        self._malformed = metrics.counter('server.malformed_dropped')
+
+        # Map of name -> function of the gauges reading the depth of each
+        # queue of packets
+        self.gauges = {}
+        registry = self.handler.registry
+        for packet_type in registry.queue_types():
+            name = 'server.queued.{}'.format(packet_type_name(packet_type))
+            fn = self.gauges[name] = partial(registry.queued, packet_type)
+            metrics.gauge(name, fn)
+
+    def remove_gauges(self):
+        """Removes the gauges reading the queues, unless taken over by
+        another protocol, so the registry does not keep this one."""
+        for name, fn in self.gauges.items():
+            metrics.remove(name, fn)
+
+    def broadcast(self, packet):
+        """Signs a packet once and sends it to every known client.
+
+        :param packet: The packet to send
+        """
+        if (self.transport is None):
+            return
+        data = packet.gen_signature(self.hmac).to_bytes()
+        for addr in set(self.handler.sessions.values()):
+            self.transport.sendto(data, addr)
+
     def connection_made(self, transport):
+        transport = metrics.MeteredTransport(
+            transport, self._packets_out, self._bytes_out)
+        if (self.capture is not None):
+            transport = CaptureTransport(transport, self.capture)
         self.transport = transport
         self.nvim.async_call(lambda nvim, transport: nvim.out_write(
             'Established connection to %s\n' % transport
@@ -100,16 +245,24 @@ class RemoteServerProtocol(DatagramProtocol, logger.LoggingMixin):
         # If no transport, drop the packet
         if (self.transport is not None):
             packet = None
+            self._packets_in.inc()
+            self._bytes_in.inc(len(data))
+            if (self.capture is not None):
+                self.capture.write(DIRECTION_IN, addr, data)
 
             try:
                 packet = Packet.read(data)
                 is_valid = packet.is_signature_valid(self.hmac)
 
                 if (is_valid):
+                    session = packet.get_header().get_session()
+                    self.handler.sessions[session] = addr
                     self.handler.process(packet)
                 elif (not is_valid):
-                    self.error('Dropping invalid packet: %s\n'.format(packet))
+                    self._invalid.inc()
+                    self.error('Dropping invalid packet: %s', packet)
                 else:
-                    self.error('Dropping unknown packet: %s\n'.format(packet))
+                    self.error('Dropping unknown packet: %s', packet)
             except Exception as ex:
-                self.error('Unexpected failure: %s\n'.format(ex))
+                self._malformed.inc()
+                self.error('Unexpected failure: %s', ex)
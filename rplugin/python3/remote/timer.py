@@ -4,11 +4,258 @@
 # License: Apache 2.0 License
 # =============================================================================
 import asyncio
+import math
+from collections import namedtuple
+from functools import partial
+from . import logger
+
+# Default number of seconds covered by each slot of a timing wheel
+DEFAULT_TICK = 0.01
+
+# Default number of slots within each level of a timing wheel
+DEFAULT_SLOTS = 256
+
+# Default number of levels of a timing wheel, each covering all slots of the
+# level below within one of its own slots
+DEFAULT_LEVELS = 4
+
+# Allowance for the loop running a callback a hair before its deadline
+_EPSILON = 1e-6
+
+# Runs an interval after each run started, so lateness carries forward
+POLICY_FIXED_DELAY = 'fixed-delay'
+
+# Runs on a fixed schedule, skipping runs whose time passed while late
+POLICY_FIXED_RATE_SKIP = 'fixed-rate-skip'
+
+# Runs on a fixed schedule, making up runs missed while late back to back
+POLICY_FIXED_RATE_BURST = 'fixed-rate-burst'
+
+POLICIES = (POLICY_FIXED_DELAY, POLICY_FIXED_RATE_SKIP,
+            POLICY_FIXED_RATE_BURST)
+
+# Skips a run that is due while the most runs allowed are still going
+OVERLAP_SKIP = 'skip'
+
+# Holds a run that is due while the most runs allowed are still going,
+# starting it once one of them finishes; at most as many runs are held as
+# are allowed to go at once, with any more skipped
+OVERLAP_QUEUE = 'queue'
+
+OVERLAPS = (OVERLAP_SKIP, OVERLAP_QUEUE)
+
+# Seconds by which runs of a timer started after they were due
+Lateness = namedtuple('Lateness', ['last', 'mean', 'max'])
+
+# Seconds taken by runs of a timer's handler
+Durations = namedtuple('Durations', ['last', 'mean', 'max'])
+
+
+class WheelHandle(object):
+    __slots__ = ('_wheel', '_expiry', '_callback', '_args', '_slot',
+                 '_cancelled')
+
+    def __init__(self, wheel, expiry, callback, args):
+        """Creates a new handle of a callback scheduled on a timing wheel.
+
+        :param wheel: The wheel the callback is scheduled on
+        :param expiry: The tick at which the callback is due
+        :param callback: The function to call
+        :param args: The arguments to the function
+        """
+        self._wheel = wheel
+        self._expiry = expiry
+        self._callback = callback
+        self._args = args
+        self._slot = None
+        self._cancelled = False
+
+    def cancel(self):
+        """Cancels the callback if it has not run yet."""
+        self._cancelled = True
+        if (self._slot is not None):
+            self._slot.discard(self)
+            self._slot = None
+            self._wheel._count -= 1
+
+    def cancelled(self):
+        return self._cancelled
+
+
+class TimingWheel(logger.LoggingMixin):
+    def __init__(self, loop, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS,
+                 levels=DEFAULT_LEVELS):
+        """Creates a new hierarchical timing wheel running any number of
+        callbacks from a single callback on the event loop. Scheduling and
+        cancelling are constant time, and callbacks run within one tick
+        after they are due, never before.
+
+        :param loop: The event loop to drive the wheel from
+        :param tick: The number of seconds covered by each slot of the
+                     lowest level, which is the resolution of the wheel
+        :param slots: The number of slots within each level
+        :param levels: The number of levels, with callbacks due beyond the
+                       top level held aside until it comes around
+        """
+        self._loop = loop
+        self._tick = tick
+        self._slots = slots
+        self._spans = [slots ** level for level in range(levels + 1)]
+        self._wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self._overflow = set()
+        self._start = loop.time()
+        self._current = 0
+        self._count = 0
+        self._handle = None
+        self._wake = None
+        self.is_debug_enabled = True
+
+    def call_later(self, delay, callback, *args):
+        """Schedules a callback to run after a delay.
+
+        :param delay: The number of seconds to wait
+        :param callback: The function to call
+        :param args: The arguments to the function
+        :returns: The handle of the callback, which can be cancelled
+        """
+        return self.call_at(self._loop.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        """Schedules a callback to run at a time of the event loop's clock.
+
+        :param when: The time at which to run the callback
+        :param callback: The function to call
+        :param args: The arguments to the function
+        :returns: The handle of the callback, which can be cancelled
+        """
+        # An idle wheel is not turned, so catch up before placing anything
+        if (self._count == 0):
+            self._current = max(self._current, self._now_tick())
+
+        expiry = max(self._current + 1,
+                     math.ceil((when - self._start) / self._tick - _EPSILON))
+        handle = WheelHandle(self, expiry, callback, args)
+        self._place(handle)
+        self._count += 1
+        if (self._handle is None):
+            self._drive()
+        else:
+            self._wake_at(expiry)
+        return handle
+
+    def count(self):
+        """Returns the number of callbacks waiting to run.
+
+        :returns: The number of callbacks
+        """
+        return self._count
+
+    def tick(self):
+        """Returns the resolution of the wheel.
+
+        :returns: The number of seconds covered by each slot
+        """
+        return self._tick
+
+    def close(self):
+        """Cancels every callback and stops driving the wheel."""
+        for level in self._wheels:
+            for slot in level:
+                for handle in list(slot):
+                    handle.cancel()
+        for handle in list(self._overflow):
+            handle.cancel()
+        if (self._handle is not None):
+            self._handle.cancel()
+            self._handle = None
+
+    def _now_tick(self):
+        return int((self._loop.time() - self._start) / self._tick + _EPSILON)
+
+    def _place(self, handle):
+        e = handle._expiry
+        slot = self._overflow
+        for level, wheel in enumerate(self._wheels):
+            # The lowest level sharing a rotation with the current tick
+            span = self._spans[level + 1]
+            if (e // span == self._current // span):
+                slot = wheel[(e // self._spans[level]) % self._slots]
+                break
+        slot.add(handle)
+        handle._slot = slot
+
+    def _cascade(self, t):
+        for level in range(len(self._wheels), 0, -1):
+            if (t % self._spans[level] != 0):
+                continue
+            if (level == len(self._wheels)):
+                slot = self._overflow
+            else:
+                slot = self._wheels[level][
+                    (t // self._spans[level]) % self._slots]
+            handles = list(slot)
+            slot.clear()
+            for handle in handles:
+                self._place(handle)
+
+    def _advance(self):
+        self._handle = None
+        target = max(self._now_tick(), self._wake)
+        while self._current < target and self._count > 0:
+            self._current += 1
+            t = self._current
+            self._cascade(t)
+
+            slot = self._wheels[0][t % self._slots]
+            if (not slot):
+                continue
+            due = list(slot)
+            slot.clear()
+            for handle in due:
+                handle._slot = None
+            self._count -= len(due)
+
+            for handle in due:
+                if (handle._cancelled):
+                    continue
+                try:
+                    handle._callback(*handle._args)
+                except Exception as ex:
+                    self.exception('Timer callback failed: %s', ex)
+        self._drive()
+
+    def _drive(self):
+        if (self._count == 0):
+            if (self._handle is not None):
+                self._handle.cancel()
+                self._handle = None
+            return
+
+        # Wake for the next occupied slot of this rotation, or at the end of
+        # the rotation when the next level cascades
+        cur = self._current
+        end = (cur // self._slots + 1) * self._slots
+        wheel = self._wheels[0]
+        self._wake_at(next(
+            (t for t in range(cur + 1, end) if wheel[t % self._slots]), end))
+
+    def _wake_at(self, t):
+        if (self._handle is not None):
+            if (self._wake <= t):
+                return
+            self._handle.cancel()
+        self._wake = t
+        self._handle = self._loop.call_at(self._start + t * self._tick,
+                                          self._advance)
 
 
 class Timer(object):
-    def __init__(self, loop, interval, stop_on_exception=False):
-        """Creates a new timer instance.
+    def __init__(self, loop, interval, stop_on_exception=False, wheel=None,
+                 policy=POLICY_FIXED_DELAY, max_overlap=1,
+                 overlap=OVERLAP_SKIP):
+        """Creates a new timer instance. The handler may be a coroutine
+        function, or return an awaitable, in which case each run is a task
+        that can outlive the interval.
 
         :param loop: The event loop to use when setting up the timer
         :param interval: The number of seconds to wait inbetween handler calls,
@@ -16,15 +263,36 @@ class Timer(object):
         :param stop_on_exception: If True, will stop the timer if an exception
                                   occurs, otherwise will log exception
                                   internally
+        :param wheel: If provided, the timing wheel to schedule the handler
+                      on instead of the event loop
+        :param policy: When the handler runs again, such as
+                       POLICY_FIXED_RATE_SKIP to keep to a fixed schedule
+        :param max_overlap: The maximum number of runs of an asynchronous
+                            handler going at the same time
+        :param overlap: What happens to a run due while the maximum number
+                        of runs are going, such as OVERLAP_QUEUE
         """
+        assert policy in POLICIES, 'Unknown policy {}'.format(policy)
+        assert overlap in OVERLAPS, 'Unknown overlap {}'.format(overlap)
+        assert max_overlap >= 1, 'At least one run must be allowed!'
         self._loop = loop
         self._running = False
         self._interval = interval
         self._exceptions = []
         self._stop_on_exception = stop_on_exception
+        self._timers = wheel if (wheel is not None) else loop
+        self._policy = policy
+        self._max_overlap = max_overlap
+        self._overlap = overlap
+        self._deadline = None
+        self._pending = None
         self._handler = None
+        self._tasks = set()
+        self._queued = 0
         self._limit = -1
         self._count = 0
+        self._skipped = 0
+        self._reset_stats()
 
     def set_handler(self, handler, *args, **kwargs):
         """Sets the handler to be invoked by the timer.
@@ -35,29 +303,7 @@ class Timer(object):
         :returns: The updated timer instance
         """
         assert self._handler is None, 'Handler has already been set!'
-
-        async def handler_wrapper():
-            while self._running:
-                start_time = self._loop.time()
-                try:
-                    handler(*args, **kwargs)
-                except Exception as ex:
-                    if self._stop_on_exception:
-                        self.stop()
-                        break
-                    else:
-                        self._exceptions.append(ex)
-                finally:
-                    self._count += 1
-                    if (self._limit >= 0 and self._count >= self._limit):
-                        self.stop()
-                        break
-
-                    end_time = self._loop.time()
-                    delay = max(0.0, self._interval - (end_time - start_time))
-                    await asyncio.sleep(delay, loop=self._loop)
-
-        self._handler = handler_wrapper
+        self._handler = partial(handler, *args, **kwargs)
         return self
 
     def start(self):
@@ -66,19 +312,130 @@ class Timer(object):
         :returns: The updated timer instance
         """
         assert self._handler is not None, 'Handler has not been set!'
+        self._cancel_pending()
         self._running = True
         self._count = 0
-        self._loop.create_task(self._handler())
+        self._skipped = 0
+        self._queued = 0
+        self._reset_stats()
+        self._deadline = self._loop.time()
+        self._pending = self._timers.call_at(self._deadline, self._tick)
         return self
 
     def stop(self):
-        """Stops the timer.
+        """Stops the timer, cancelling any runs still going.
 
         :returns: The updated timer instance
         """
-        self._running = False
+        self._halt()
+        for task in list(self._tasks):
+            task.cancel()
         return self
 
+    def _halt(self):
+        self._running = False
+        self._queued = 0
+        self._cancel_pending()
+
+    def _cancel_pending(self):
+        if (self._pending is not None):
+            self._pending.cancel()
+            self._pending = None
+
+    def _reset_stats(self):
+        self._late_runs = 0
+        self._late_last = self._late_total = self._late_max = 0.0
+        self._duration_runs = 0
+        self._duration_last = 0.0
+        self._duration_total = self._duration_max = 0.0
+
+    def _invoke(self):
+        """Invokes the handler once, stopping the timer on an exception if
+        asked to or once the limit is reached. Runs already going when the
+        limit is reached are left to finish."""
+        start_time = self._loop.time()
+        try:
+            result = self._handler()
+            if (asyncio.iscoroutine(result) or asyncio.isfuture(result)):
+                task = asyncio.ensure_future(result, loop=self._loop)
+                self._tasks.add(task)
+                task.add_done_callback(
+                    lambda t: self._finished(t, start_time))
+            else:
+                self._record_duration(start_time)
+        except Exception as ex:
+            self._record_duration(start_time)
+            self._failed(ex)
+        finally:
+            self._count += 1
+            if (self._limit >= 0 and self._count >= self._limit):
+                self._halt()
+
+    def _finished(self, task, start_time):
+        self._tasks.discard(task)
+        if (task.cancelled()):
+            return
+        self._record_duration(start_time)
+        ex = task.exception()
+        if (ex is not None):
+            self._failed(ex)
+
+        if (self._running and self._queued > 0):
+            self._queued -= 1
+            self._invoke()
+
+    def _failed(self, ex):
+        if self._stop_on_exception:
+            self.stop()
+        else:
+            self._exceptions.append(ex)
+
+    def _record_duration(self, start_time):
+        duration = self._loop.time() - start_time
+        self._duration_runs += 1
+        self._duration_last = duration
+        self._duration_total += duration
+        self._duration_max = max(self._duration_max, duration)
+
+    def _tick(self):
+        self._pending = None
+        if (not self._running):
+            return
+
+        start_time = self._loop.time()
+        late = max(0.0, start_time - self._deadline)
+        self._late_runs += 1
+        self._late_last = late
+        self._late_total += late
+        self._late_max = max(self._late_max, late)
+
+        if (len(self._tasks) < self._max_overlap):
+            self._invoke()
+        elif (self._overlap == OVERLAP_QUEUE and
+                self._queued < self._max_overlap):
+            self._queued += 1
+        else:
+            self._skipped += 1
+
+        if (self._running):
+            self._deadline = self._next_deadline(start_time)
+            self._pending = self._timers.call_at(self._deadline, self._tick)
+
+    def _next_deadline(self, start_time):
+        if (self._policy == POLICY_FIXED_DELAY):
+            return start_time + self._interval
+
+        # Deadlines are kept to multiples of the interval from the first run
+        # so lateness never accumulates
+        deadline = self._deadline + self._interval
+        now = self._loop.time()
+        if (self._policy == POLICY_FIXED_RATE_SKIP and deadline <= now and
+                self._interval > 0):
+            missed = int((now - deadline) // self._interval) + 1
+            self._skipped += missed
+            deadline += missed * self._interval
+        return deadline
+
     def running(self):
         """Returns whether or not the timer is running.
 
@@ -131,3 +488,52 @@ class Timer(object):
         :returns: The total number of times the timer has invoked the handler
         """
         return self._count
+
+    def policy(self):
+        """Returns the policy deciding when the timer runs again.
+
+        :returns: The policy, such as POLICY_FIXED_DELAY
+        """
+        return self._policy
+
+    def skipped(self):
+        """Returns the number of runs skipped to keep to a fixed schedule or
+        because too many runs were still going or queued.
+
+        :returns: The total number of skipped runs
+        """
+        return self._skipped
+
+    def active(self):
+        """Returns the number of runs of an asynchronous handler going.
+
+        :returns: The number of runs not yet finished
+        """
+        return len(self._tasks)
+
+    def queued(self):
+        """Returns the number of runs waiting for another run to finish.
+
+        :returns: The number of queued runs
+        """
+        return self._queued
+
+    def lateness(self):
+        """Returns how late runs of the handler started after they were due.
+
+        :returns: The lateness in seconds of the last run, the mean across
+                  runs, and the most of any run
+        """
+        mean = self._late_total / self._late_runs if (self._late_runs) else 0.0
+        return Lateness(self._late_last, mean, self._late_max)
+
+    def durations(self):
+        """Returns how long runs of the handler took, which for an
+        asynchronous handler is until its run finished.
+
+        :returns: The duration in seconds of the last run, the mean across
+                  runs, and the most of any run
+        """
+        mean = (self._duration_total / self._duration_runs
+                if (self._duration_runs) else 0.0)
+        return Durations(self._duration_last, mean, self._duration_max)
@@ -0,0 +1,232 @@
+# =============================================================================
+# FILE: watcher.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+import fnmatch
+import os
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+from . import logger
+from .constants import (
+    MESSAGE_DEFAULT_FILE_LENGTH,
+    MESSAGE_DEFAULT_FILE_VERSION,
+)
+from .dirindex import DEFAULT_IGNORE
+from .packet import MAX_CONTENT_SIZE
+
+# Number of seconds changes to a path are collected before being emitted
+DEFAULT_WINDOW = 0.2
+
+# Estimated msgpack overhead of a single [path, version, size] entry
+_ENTRY_OVERHEAD = 24
+
+
+def describe_changes(index, root, changes):
+    """Looks up the new version and size of changed files, hashing only
+    those whose stat information changed. This can run off the event loop.
+
+    :param index: The file index used to track versions
+    :param root: The directory paths are reported relative to
+    :param changes: The list of (path, deleted) tuples
+    :returns: A list of [path, version, size] entries, where deleted files
+              have the default version and length
+    """
+    entries = []
+    for path, deleted in changes:
+        entry = None
+        if (not deleted and os.path.isfile(path)):
+            try:
+                entry = index.refresh(path)
+            except OSError:
+                entry = None
+        else:
+            index.remove(path)
+
+        rel = os.path.relpath(path, root)
+        if (entry is None):
+            entries.append([rel, MESSAGE_DEFAULT_FILE_VERSION,
+                            MESSAGE_DEFAULT_FILE_LENGTH])
+        else:
+            entries.append([rel, entry.version, entry.size])
+    index.flush()
+    return entries
+
+
+def split_changes(entries, max_bytes=MAX_CONTENT_SIZE):
+    """Splits change entries into groups sized to fit a single packet.
+
+    :param entries: The list of [path, version, size] entries
+    :param max_bytes: The maximum estimated encoded size of a group
+    :returns: A generator of lists of entries
+    """
+    group = []
+    size = 0
+    for entry in entries:
+        n = len(entry[0].encode('utf-8')) + _ENTRY_OVERHEAD
+        if (group and size + n > max_bytes):
+            yield group
+            group = []
+            size = 0
+        group.append(entry)
+        size += n
+    if (group):
+        yield group
+
+
+class ChangeBatcher(logger.LoggingMixin):
+    def __init__(self, loop, emit, window=DEFAULT_WINDOW, is_ignored=None):
+        """Creates a new batcher collecting changed paths and emitting each
+        path at most once per window.
+
+        :param loop: The event loop used to schedule emits
+        :param emit: The function taking a list of (path, deleted) tuples;
+                     if it returns an awaitable, no further batch is emitted
+                     until it completes
+        :param window: The number of seconds to collect changes for
+        :param is_ignored: If provided, the function that returns True for
+                           paths that should be dropped
+        """
+        self._loop = loop
+        self._emit = emit
+        self._window = window
+        self._is_ignored = is_ignored
+        self._changes = {}
+        self._handle = None
+        self._busy = False
+        self.is_debug_enabled = True
+
+    def add(self, path, deleted=False):
+        """Records a change to a path, replacing earlier changes to it.
+
+        :param path: The path that changed
+        :param deleted: Whether or not the path was deleted
+        """
+        if (self._is_ignored is not None and self._is_ignored(path)):
+            return
+        self._changes[path] = deleted
+        if (self._handle is None and not self._busy):
+            self._handle = self._loop.call_later(self._window, self.flush)
+
+    def pending(self):
+        """Returns the paths waiting to be emitted.
+
+        :returns: A list of paths
+        """
+        return list(self._changes)
+
+    def flush(self):
+        """Emits all collected changes now."""
+        if (self._handle is not None):
+            self._handle.cancel()
+            self._handle = None
+        if (not self._changes or self._busy):
+            return
+
+        changes = list(self._changes.items())
+        self._changes = {}
+        result = self._emit(changes)
+        if (result is not None and (asyncio.iscoroutine(result) or
+                                    asyncio.isfuture(result))):
+            self._busy = True
+            asyncio.ensure_future(result, loop=self._loop).add_done_callback(
+                self._done)
+
+    def cancel(self):
+        """Drops all collected changes."""
+        if (self._handle is not None):
+            self._handle.cancel()
+            self._handle = None
+        self._changes = {}
+
+    def _done(self, future):
+        self._busy = False
+        if (not future.cancelled() and future.exception() is not None):
+            self.error('Failed to emit changes: %s', future.exception())
+        if (self._changes and self._handle is None):
+            self._handle = self._loop.call_later(self._window, self.flush)
+
+
+class _EventForwarder(FileSystemEventHandler):
+    def __init__(self, loop, batcher):
+        self._loop = loop
+        self._batcher = batcher
+
+    def on_any_event(self, event):
+        # Changes to a directory's entries are reported by its files
+        if (event.is_directory and event.event_type == 'modified'):
+            return
+
+        # Events arrive on the observer's thread
+        add = self._batcher.add
+        if (event.event_type == 'moved'):
+            self._loop.call_soon_threadsafe(add, event.src_path, True)
+            self._loop.call_soon_threadsafe(add, event.dest_path, False)
+        else:
+            deleted = event.event_type == 'deleted'
+            self._loop.call_soon_threadsafe(add, event.src_path, deleted)
+
+
+class FileWatcher(logger.LoggingMixin):
+    def __init__(self, loop, root, emit, window=DEFAULT_WINDOW, ignore=None):
+        """Creates a new watcher of the files beneath a directory.
+
+        :param loop: The event loop the changes are emitted on
+        :param root: The directory to watch recursively
+        :param emit: The function taking each batch of (path, deleted)
+                     tuples, as described by ChangeBatcher
+        :param window: The number of seconds to collect changes for
+        :param ignore: The list of glob patterns of names to drop,
+                       defaulting to DEFAULT_IGNORE
+        """
+        self.root = os.path.abspath(root)
+        self.ignore = list(DEFAULT_IGNORE if (ignore is None) else ignore)
+        self.batcher = ChangeBatcher(loop, emit, window, self.is_ignored)
+        self._loop = loop
+        self._observer = None
+        self.is_debug_enabled = True
+
+    def is_ignored(self, path):
+        """Checks if any component of a path beneath the root is ignored.
+
+        :param path: The path to check
+        :returns: True if ignored, otherwise False
+        """
+        rel = os.path.relpath(path, self.root)
+        for name in rel.split(os.sep):
+            for pattern in self.ignore:
+                if (fnmatch.fnmatch(name, pattern)):
+                    return True
+        return False
+
+    def is_running(self):
+        return self._observer is not None
+
+    def start(self):
+        """Starts watching on a background thread.
+
+        :returns: The updated watcher
+        """
+        if (self._observer is None):
+            self._observer = Observer()
+            self._observer.schedule(
+                _EventForwarder(self._loop, self.batcher),
+                self.root,
+                recursive=True,
+            )
+            self._observer.daemon = True
+            self._observer.start()
+        return self
+
+    def stop(self):
+        """Stops watching, dropping any changes not yet emitted.
+
+        :returns: The updated watcher
+        """
+        if (self._observer is not None):
+            self._observer.stop()
+            self._observer.join(timeout=1.0)
+            self._observer = None
+        self.batcher.cancel()
+        return self
@@ -0,0 +1,238 @@
+# =============================================================================
+# FILE: test_archive.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+import io
+import os
+import pytest
+import tarfile
+from unittest.mock import Mock
+from remote.archive import ArchiveManager, ArchiveReceiver, write_archive
+from remote.builders import build_update_archive_start
+from remote.chunks import CHUNK_SIZE
+from remote.client import RemoteClient
+from remote.constants import (
+    MESSAGE_METADATA_CHUNK_INDEX,
+    PACKET_TYPE_UPDATE_ARCHIVE_DATA,
+)
+from remote.handlers.client import ClientHandler
+from remote.handlers.server import ServerHandler
+from remote.index import FileIndex, hash_file
+from remote.packet import Packet
+
+TEST_CHUNK_SIZE = 64
+TEST_FILES = {
+    'a.txt': 'alpha',
+    os.path.join('sub', 'b.txt'): 'beta' * 100,
+    os.path.join('sub', 'deep', 'c.txt'): '',
+}
+
+
+@pytest.fixture()
+def src(tmpdir):
+    root = tmpdir.mkdir('src')
+    for path, text in TEST_FILES.items():
+        root.join(path).write(text, ensure=True)
+    return root
+
+
+def archive_bytes(src):
+    f = io.BytesIO()
+    files = write_archive(str(src), sorted(TEST_FILES), f)
+    return f.getvalue(), files
+
+
+def chunks_of(data):
+    return [data[i:i + TEST_CHUNK_SIZE]
+            for i in range(0, len(data), TEST_CHUNK_SIZE)]
+
+
+async def wait_for(condition):
+    for _ in range(200):
+        if (condition()):
+            return
+        await asyncio.sleep(0.01)
+
+
+def test_write_archive_hashes_files(src):
+    data, files = archive_bytes(src)
+    assert [f[0] for f in files] == sorted(TEST_FILES)
+    for path, size, mtime_ns, digest in files:
+        assert digest == hash_file(str(src.join(path)))
+        assert size == len(TEST_FILES[path])
+
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+        assert sorted(tar.getnames()) == sorted(
+            p.replace(os.sep, '/') for p in TEST_FILES)
+
+
+class TestArchiveReceiver(object):
+    @pytest.mark.asyncio
+    async def test_extracts_chunks_received_out_of_order(
+            self, event_loop, tmpdir, src):
+        data, _ = archive_bytes(src)
+        chunks = chunks_of(data)
+        dest = tmpdir.join('dest')
+        index = FileIndex(None)
+        extracted = []
+        done = []
+
+        r = ArchiveReceiver(event_loop, str(dest),
+                            str(tmpdir.join('archives', 'archive')),
+                            len(data), len(chunks), TEST_CHUNK_SIZE,
+                            index=index, extracted=extracted.append,
+                            done=done.append)
+        for i in reversed(range(len(chunks))):
+            r.write(i, chunks[i])
+        await wait_for(lambda: done)
+
+        assert not r.failed
+        assert r.count == len(TEST_FILES)
+        for path, text in TEST_FILES.items():
+            assert dest.join(path).read() == text
+            entry = index.lookup(str(dest.join(path)))
+            assert entry.digest == hash_file(str(dest.join(path)))
+        assert sorted(extracted) == sorted(
+            str(dest.join(p)) for p in TEST_FILES)
+        assert os.listdir(str(tmpdir.join('archives'))) == []
+
+    @pytest.mark.asyncio
+    async def test_paths_outside_root_skipped(self, event_loop, tmpdir):
+        f = io.BytesIO()
+        with tarfile.open(fileobj=f, mode='w:gz') as tar:
+            for name in ['../escape.txt', 'ok.txt']:
+                info = tarfile.TarInfo(name)
+                info.size = 2
+                tar.addfile(info, io.BytesIO(b'hi'))
+        data = f.getvalue()
+        chunks = chunks_of(data)
+        dest = tmpdir.join('dest')
+        done = []
+
+        r = ArchiveReceiver(event_loop, str(dest), str(tmpdir.join('archive')),
+                            len(data), len(chunks), TEST_CHUNK_SIZE,
+                            done=done.append)
+        for i, chunk in enumerate(chunks):
+            r.write(i, chunk)
+        await wait_for(lambda: done)
+
+        assert dest.join('ok.txt').read() == 'hi'
+        assert not tmpdir.join('escape.txt').exists()
+
+    @pytest.mark.asyncio
+    async def test_abort_stops_extraction(self, event_loop, tmpdir, src):
+        data, _ = archive_bytes(src)
+        chunks = chunks_of(data)
+        done = []
+
+        r = ArchiveReceiver(event_loop, str(tmpdir.join('dest')),
+                            str(tmpdir.join('archive')), len(data),
+                            len(chunks), TEST_CHUNK_SIZE, done=done.append)
+        r.write(0, chunks[0])
+        r.abort()
+        await wait_for(lambda: done)
+        assert r.failed
+
+
+class TestArchiveManager(object):
+    @pytest.mark.asyncio
+    async def test_received_after_complete(self, event_loop, tmpdir, src):
+        data, _ = archive_bytes(src)
+        chunks = chunks_of(data)
+        dest = str(tmpdir.join('dest'))
+        m = ArchiveManager(event_loop, archive_dir=str(tmpdir.join('a')))
+
+        assert m.received('s', dest, 1, len(chunks)) is None
+        r = m.start('s', dest, 1, len(data), len(chunks), TEST_CHUNK_SIZE)
+        assert m.start('s', dest, 1, len(data), len(chunks),
+                       TEST_CHUNK_SIZE) is r
+        assert not m.receive('s', dest, 2, 0, chunks[0])
+        for i, chunk in enumerate(chunks):
+            assert m.receive('s', dest, 1, i, chunk)
+        assert m.received('s', dest, 1, len(chunks)).complete()
+
+        await wait_for(lambda: not m._archives)
+        assert m.received('s', dest, 1, len(chunks)).complete()
+        assert m.start('s', dest, 1, len(data), len(chunks),
+                       TEST_CHUNK_SIZE) is None
+
+
+@pytest.mark.asyncio
+async def test_sync_tree_resends_lost_chunks(event_loop, tmpdir, src):
+    client = RemoteClient(Mock(), event_loop, '127.0.0.1', 0, 'key',
+                          index=FileIndex(None), root=str(src))
+    handler = ClientHandler(nvim=None, send=None)
+    client.protocol = Mock(handler=handler)
+    server = ServerHandler(
+        nvim=None,
+        send=lambda packet, addr: handler.process(
+            Packet.read(packet.gen_signature(client.hmac).to_bytes())),
+        broadcast=None,
+        loop=event_loop,
+        root=str(src),
+        state_dir=str(tmpdir.join('state')),
+    )
+    server.sessions[client.info['session']] = ('127.0.0.1', 0)
+
+    # Large enough to need several chunks, the first of which is lost the
+    # first time it is sent
+    src.join('big.bin').write_binary(os.urandom(4 * CHUNK_SIZE))
+    lost = []
+
+    def send_packet(packet):
+        if (packet.get_header().get_type() ==
+                PACKET_TYPE_UPDATE_ARCHIVE_DATA):
+            # Server and client share a disk, so the files are removed once
+            # archived to see them recreated by the server
+            if (not lost):
+                for path in TEST_FILES:
+                    src.join(path).remove()
+            index = packet.get_metadata().get_value(
+                MESSAGE_METADATA_CHUNK_INDEX)
+            if (index == 0 and not lost):
+                lost.append(packet)
+                return
+        server.process(Packet.read(packet.gen_signature(
+            client.hmac).to_bytes()))
+    client.send_packet = send_packet
+
+    count = await client.sync_tree(str(src))
+    await wait_for(lambda: not server.archives._archives)
+
+    assert lost
+    assert count == len(TEST_FILES) + 1
+    for path, text in TEST_FILES.items():
+        assert src.join(path).read() == text
+        assert server.index.lookup(str(src.join(path))) is not None
+    assert not await client.send_start_file_update(str(src.join('a.txt')))
+
+
+@pytest.mark.asyncio
+async def test_sync_tree_outside_root_sends_nothing(event_loop, tmpdir, src):
+    client = RemoteClient(Mock(), event_loop, '127.0.0.1', 0, 'key',
+                          index=FileIndex(None),
+                          root=str(tmpdir.mkdir('other')))
+    client.send_packet = Mock()
+
+    assert await client.sync_tree(str(src)) is None
+    assert not client.send_packet.called
+
+
+@pytest.mark.asyncio
+async def test_server_rejects_archive_outside_root(event_loop, tmpdir, src):
+    server = ServerHandler(nvim=None, send=Mock(), broadcast=None,
+                           loop=event_loop, root=str(src),
+                           state_dir=str(tmpdir.join('state')))
+
+    for root in (os.pardir, str(tmpdir)):
+        server.process(build_update_archive_start(
+            'user', 'session', root, 1, 10, 1, CHUNK_SIZE))
+    assert not server.archives._archives
+
+    server.process(build_update_archive_start(
+        'user', 'session', 'sub', 1, 10, 1, CHUNK_SIZE))
+    assert list(server.archives._archives) == [
+        ('session', str(src.join('sub')))]
+    server.archives._archives['session', str(src.join('sub'))][1].abort()
@@ -0,0 +1,204 @@
+# =============================================================================
+# FILE: test_buffer.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import pytest
+from unittest.mock import Mock
+from remote.buffer import (
+    BufferSync,
+    LineMirror,
+    coalesce_edits,
+    split_edits,
+)
+from remote.builders import (
+    build_tell_buffer_checksum,
+    build_tell_buffer_edit,
+)
+from remote.constants import (
+    MESSAGE_METADATA_CHECKSUM,
+    MESSAGE_METADATA_FILE_PATH,
+    PACKET_TYPE_TELL_BUFFER_CHECKSUM,
+    PACKET_TYPE_TELL_BUFFER_DRIFT,
+    PACKET_TYPE_TELL_BUFFER_EDIT,
+)
+from remote.handlers.server import ServerHandler
+
+TEST_LINES = ['a', 'b', 'c', 'd']
+
+
+def apply(lines, edits):
+    return LineMirror(lines).apply_all(edits).lines()
+
+
+def test_coalesce_edits_typing_on_same_line():
+    edits = [[1, 2, ['bx']], [1, 2, ['bxy']], [1, 2, ['bxyz']]]
+    actual = coalesce_edits(edits)
+    assert actual == [[1, 2, ['bxyz']]]
+    assert apply(TEST_LINES, actual) == apply(TEST_LINES, edits)
+
+
+def test_coalesce_edits_new_line_after_edit():
+    edits = [[1, 2, ['bx']], [2, 2, ['new']]]
+    actual = coalesce_edits(edits)
+    assert len(actual) == 1
+    assert apply(TEST_LINES, actual) == apply(TEST_LINES, edits)
+
+
+def test_coalesce_edits_covering_edit():
+    edits = [[1, 2, ['bx', 'by']], [0, 4, ['z']]]
+    actual = coalesce_edits(edits)
+    assert len(actual) == 1
+    assert apply(TEST_LINES, actual) == apply(TEST_LINES, edits)
+
+
+def test_coalesce_edits_disjoint_edits_kept():
+    edits = [[0, 1, ['x']], [3, 4, ['y']]]
+    assert coalesce_edits(edits) == edits
+
+
+def test_coalesce_edits_whole_buffer():
+    edits = [[0, -1, ['x', 'y']], [1, 2, ['z']]]
+    actual = coalesce_edits(edits)
+    assert actual == [[0, -1, ['x', 'z']]]
+    assert apply(TEST_LINES, actual) == apply(TEST_LINES, edits)
+
+
+def test_split_edits_fits_limit():
+    edits = [[0, 1, ['x']], [3, 4, ['y']]]
+    assert list(split_edits(edits)) == [edits]
+
+
+def test_split_edits_large_edit_produces_same_buffer():
+    lines = ['line {}'.format(i) for i in range(100)]
+    edits = [[1, 3, lines]]
+    groups = list(split_edits(edits, limit=200))
+    assert len(groups) > 1
+
+    actual = TEST_LINES
+    for group in groups:
+        actual = apply(actual, group)
+    assert actual == apply(TEST_LINES, edits)
+
+
+def test_line_mirror_checksum_changes():
+    m = LineMirror(TEST_LINES)
+    before = m.checksum()
+    m.apply(0, 1, ['changed'])
+    assert m.checksum() != before
+    assert m.dirty()
+
+
+def test_buffer_sync_flush_coalesces_into_one_packet():
+    nvim = Mock()
+    nvim.request.return_value = True
+    loop = Mock()
+    send = Mock()
+
+    bs = BufferSync(nvim, loop, send, 'user', 'session')
+    assert bs.attach(1, 'file.txt')
+    bs.on_lines(1, 1, 0, -1, list(TEST_LINES))
+    bs.on_lines(1, 2, 1, 2, ['bx'])
+    bs.on_lines(1, 3, 1, 2, ['bxy'])
+    assert loop.call_later.call_count == 1
+
+    bs.flush(1)
+    assert send.call_count == 1
+
+    p = send.call_args[0][0]
+    m = p.get_metadata()
+    assert p.get_header().get_type() == PACKET_TYPE_TELL_BUFFER_EDIT
+    assert m.get_value(MESSAGE_METADATA_FILE_PATH) == 'file.txt'
+    assert m.get_value(MESSAGE_METADATA_CHECKSUM) == (
+        LineMirror(['a', 'bxy', 'c', 'd']).checksum())
+    assert p.get_content().get_data() == [[0, -1, ['a', 'bxy', 'c', 'd']]]
+
+
+def test_buffer_sync_send_checksum():
+    nvim = Mock()
+    nvim.request.return_value = True
+    send = Mock()
+
+    bs = BufferSync(nvim, Mock(), send, 'user', 'session')
+    bs.attach(1, 'file.txt')
+    bs.send_path_checksum('file.txt')
+
+    p = send.call_args[0][0]
+    assert p.get_header().get_type() == PACKET_TYPE_TELL_BUFFER_CHECKSUM
+    assert bs.is_attached('file.txt')
+
+
+def test_buffer_sync_resync_replaces_pending_edits():
+    nvim = Mock()
+    nvim.request.return_value = True
+    send = Mock()
+
+    bs = BufferSync(nvim, Mock(), send, 'user', 'session')
+    bs.attach(1, 'file.txt')
+    bs.on_lines(1, 1, 0, -1, list(TEST_LINES))
+    bs.flush(1)
+    bs.on_lines(1, 2, 1, 2, ['bx'])
+    bs.resync('file.txt')
+
+    p = send.call_args[0][0]
+    assert p.get_content().get_data() == [[0, -1, ['a', 'bx', 'c', 'd']]]
+
+
+def buffer_server(loop, root):
+    send = Mock()
+    server = ServerHandler(nvim=None, send=send, broadcast=None, loop=loop,
+                           root=str(root))
+    server.sessions['session'] = 'addr'
+    return server, send
+
+
+def seed_edit(path, lines):
+    return build_tell_buffer_edit(
+        'user', 'session', path, [[0, -1, lines]], changedtick=1,
+        checksum=LineMirror(lines).checksum())
+
+
+@pytest.mark.asyncio
+async def test_server_writes_buffer_beneath_root(event_loop, tmpdir):
+    server, send = buffer_server(event_loop, tmpdir)
+    server.process(seed_edit('f.txt', ['a', 'b']))
+    server.process(build_tell_buffer_checksum(
+        'user', 'session', 'f.txt', changedtick=1,
+        checksum=LineMirror(['a', 'b']).checksum()))
+
+    assert tmpdir.join('f.txt').read() == 'a\nb\n'
+    assert not send.called
+
+
+@pytest.mark.asyncio
+async def test_server_refuses_buffer_outside_root(event_loop, tmpdir):
+    root = tmpdir.mkdir('root')
+    server, send = buffer_server(event_loop, root)
+    server.process(seed_edit('../f.txt', ['a']))
+    server.process(build_tell_buffer_checksum(
+        'user', 'session', '../f.txt', changedtick=1,
+        checksum=LineMirror(['a']).checksum()))
+
+    assert not tmpdir.join('f.txt').check()
+    assert not server.mirrors
+
+
+@pytest.mark.asyncio
+async def test_server_repeats_drift_until_resent(event_loop, tmpdir):
+    server, send = buffer_server(event_loop, tmpdir)
+    checksum = build_tell_buffer_checksum(
+        'user', 'session', 'f.txt', changedtick=1, checksum='bad')
+
+    server.process(checksum)
+    server.process(checksum)
+    assert send.call_count == 1
+    p = send.call_args[0][0]
+    assert p.get_header().get_type() == PACKET_TYPE_TELL_BUFFER_DRIFT
+
+    # The report is lost, so it is repeated once the interval passes
+    server.drift_interval = 0
+    server.process(checksum)
+    assert send.call_count == 2
+
+    server.process(seed_edit('f.txt', ['a']))
+    assert 'f.txt' not in server.drifted
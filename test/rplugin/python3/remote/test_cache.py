@@ -0,0 +1,157 @@
+# =============================================================================
+# FILE: test_cache.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+import os
+import pytest
+from unittest.mock import Mock
+from remote.builders import build_retrieve_file_ask
+from remote.cache import FileCache
+from remote.client import RemoteClient
+from remote.constants import PACKET_TYPE_RETRIEVE_FILE_ASK
+from remote.handlers.client import ClientHandler
+from remote.handlers.server import ServerHandler
+from remote.packet import Packet
+from remote.security import new_hmac_from_key
+
+
+@pytest.fixture()
+def cache(tmpdir):
+    return FileCache(str(tmpdir.join('cache')), max_size=10)
+
+
+def write_blob(cache, path, version, data):
+    blob_path = cache.blob_path(path, version)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    with open(blob_path, 'wb') as f:
+        f.write(data)
+    return cache.add(path, version, len(data))
+
+
+class TestFileCache(object):
+    def test_lookup(self, cache):
+        assert cache.lookup('a') is None
+        blob_path = write_blob(cache, 'a', 1, b'1234')
+        assert cache.lookup('a') == (1, blob_path)
+
+    def test_new_version_replaces_old(self, cache):
+        old = write_blob(cache, 'a', 1, b'1234')
+        new = write_blob(cache, 'a', 2, b'12')
+        assert not os.path.exists(old)
+        assert cache.lookup('a') == (2, new)
+        assert cache.size() == 2
+
+    def test_least_recently_used_evicted(self, cache):
+        a = write_blob(cache, 'a', 1, b'1234')
+        write_blob(cache, 'b', 1, b'1234')
+        cache.lookup('a')
+        write_blob(cache, 'c', 1, b'1234')
+
+        assert cache.paths() == ['a', 'c']
+        assert cache.lookup('b') is None
+        assert os.path.exists(a)
+        assert cache.size() == 8
+
+    def test_manifest_persists(self, cache):
+        blob_path = write_blob(cache, 'a', 3, b'1234')
+        actual = FileCache(cache.cache_dir, cache.max_size)
+        assert actual.lookup('a') == (3, blob_path)
+
+    def test_missing_blob_dropped(self, cache):
+        blob_path = write_blob(cache, 'a', 1, b'1234')
+        os.unlink(blob_path)
+        assert cache.lookup('a') is None
+        assert cache.size() == 0
+
+
+@pytest.mark.asyncio
+async def test_retrieve_into_cache(event_loop, tmpdir, cache):
+    root = tmpdir.mkdir('root')
+    root.join('f.txt').write('hello')
+
+    hmac = new_hmac_from_key('key')
+    client = ClientHandler(nvim=None, send=None, cache=cache)
+    server = ServerHandler(
+        nvim=None,
+        send=lambda packet, addr: client.process(
+            Packet.read(packet.gen_signature(hmac).to_bytes())),
+        broadcast=None,
+        loop=event_loop,
+        root=str(root),
+    )
+    server.sessions['session'] = 'addr'
+
+    ask = build_retrieve_file_ask('user', 'session', 'f.txt', 1)
+    future = client.expect_answer(ask, event_loop)
+    server.process(ask)
+    local_path = await asyncio.wait_for(future, 1)
+
+    with open(local_path) as f:
+        assert f.read() == 'hello'
+    assert cache.lookup('f.txt') == (1, local_path)
+
+
+@pytest.mark.asyncio
+async def test_retrieve_without_cache_writes_nothing(event_loop, tmpdir):
+    root = tmpdir.mkdir('root')
+    root.join('f.txt').write('hello')
+    cwd = tmpdir.mkdir('cwd')
+
+    hmac = new_hmac_from_key('key')
+    client = ClientHandler(nvim=None, send=None)
+    server = ServerHandler(
+        nvim=None,
+        send=lambda packet, addr: client.process(
+            Packet.read(packet.gen_signature(hmac).to_bytes())),
+        broadcast=None,
+        loop=event_loop,
+        root=str(root),
+    )
+    server.sessions['session'] = 'addr'
+
+    with cwd.as_cwd():
+        ask = build_retrieve_file_ask('user', 'session', 'f.txt', 1)
+        future = client.expect_answer(ask, event_loop)
+        server.process(ask)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(future, 0.2)
+
+    assert cwd.listdir() == []
+
+
+@pytest.mark.asyncio
+async def test_client_opens_file_through_cache(event_loop, tmpdir, cache):
+    root = tmpdir.mkdir('root')
+    root.join('f.txt').write('hello')
+
+    client = RemoteClient(Mock(), event_loop, '127.0.0.1', 0, 'key',
+                          cache=cache)
+    handler = ClientHandler(nvim=None, send=None, cache=cache)
+    client.protocol = Mock(handler=handler)
+    server = ServerHandler(
+        nvim=None,
+        send=lambda packet, addr: handler.process(
+            Packet.read(packet.gen_signature(client.hmac).to_bytes())),
+        broadcast=None,
+        loop=event_loop,
+        root=str(root),
+    )
+    server.sessions[client.info['session']] = 'addr'
+    sent = []
+
+    def send_packet(packet):
+        sent.append(packet.get_header().get_type())
+        server.process(Packet.read(packet.gen_signature(
+            client.hmac).to_bytes()))
+    client.send_packet = send_packet
+
+    local_path = await client.retrieve_file('f.txt')
+    with open(local_path) as f:
+        assert f.read() == 'hello'
+    assert sent.count(PACKET_TYPE_RETRIEVE_FILE_ASK) == 1
+
+    # The cached copy is still current, so only its version is asked for
+    assert await client.retrieve_file('f.txt') == local_path
+    assert sent.count(PACKET_TYPE_RETRIEVE_FILE_ASK) == 1
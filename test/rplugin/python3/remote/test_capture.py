@@ -0,0 +1,113 @@
+# =============================================================================
+# FILE: test_capture.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import pytest
+from unittest.mock import Mock
+from remote.builders import build_tell_heartbeat
+from remote.capture import (
+    DIRECTION_IN,
+    DIRECTION_OUT,
+    CaptureTransport,
+    CaptureWriter,
+    NullTransport,
+    read_capture,
+    replay,
+)
+from remote.constants import PACKET_TYPE_TELL_HEARTBEAT
+from remote.security import new_hmac_from_key
+from remote.server import RemoteServerProtocol
+
+TEST_ADDR = ('10.0.0.1', 4000)
+
+
+def heartbeat(hmac, session='session'):
+    return build_tell_heartbeat('user', session).gen_signature(
+        hmac).to_bytes()
+
+
+def test_capture_round_trip(tmpdir):
+    path = str(tmpdir.join('captures', 'traffic'))
+    now = [100.0]
+    writer = CaptureWriter(path, clock=lambda: now[0])
+    writer.write(DIRECTION_IN, TEST_ADDR, b'ask')
+    now[0] += 1.5
+    writer.write(DIRECTION_OUT, None, b'')
+    writer.close()
+
+    # Appending keeps the earlier records
+    writer = CaptureWriter(path, clock=lambda: now[0])
+    writer.write(DIRECTION_OUT, TEST_ADDR, b'answer')
+    writer.close()
+
+    records = list(read_capture(path))
+    assert [(r.time, r.direction, r.addr, r.data) for r in records] == [
+        (100.0, DIRECTION_IN, TEST_ADDR, b'ask'),
+        (101.5, DIRECTION_OUT, ('', 0), b''),
+        (101.5, DIRECTION_OUT, TEST_ADDR, b'answer'),
+    ]
+
+
+def test_truncated_record_ignored(tmpdir):
+    path = str(tmpdir.join('traffic'))
+    writer = CaptureWriter(path)
+    writer.write(DIRECTION_IN, TEST_ADDR, b'first')
+    writer.write(DIRECTION_IN, TEST_ADDR, b'second')
+    writer.close()
+    with open(path, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 3)
+
+    assert [r.data for r in read_capture(path)] == [b'first']
+
+
+def test_not_a_capture(tmpdir):
+    path = tmpdir.join('traffic')
+    path.write_binary(b'garbage')
+    with pytest.raises(ValueError):
+        list(read_capture(str(path)))
+
+
+def test_capture_transport_records_sends(tmpdir):
+    path = str(tmpdir.join('traffic'))
+    writer = CaptureWriter(path)
+    transport = Mock()
+    transport.get_extra_info.return_value = TEST_ADDR
+    t = CaptureTransport(transport, writer)
+
+    t.sendto(b'data')
+    t.close()
+    writer.close()
+
+    transport.sendto.assert_called_once_with(b'data', None)
+    transport.close.assert_called_once_with()
+    assert [(r.direction, r.addr, r.data) for r in read_capture(path)] == [
+        (DIRECTION_OUT, TEST_ADDR, b'data')]
+
+
+@pytest.mark.asyncio
+async def test_replay_into_server(event_loop, tmpdir):
+    hmac = new_hmac_from_key('key')
+    path = str(tmpdir.join('traffic'))
+
+    # Capture what a server receives and sends
+    writer = CaptureWriter(path)
+    protocol = RemoteServerProtocol(Mock(), hmac, loop=event_loop,
+                                    root=str(tmpdir), capture=writer)
+    protocol.connection_made(NullTransport())
+    for session in ['a', 'b', 'c']:
+        protocol.datagram_received(heartbeat(hmac, session), TEST_ADDR)
+    protocol.transport.sendto(b'reply', TEST_ADDR)
+    writer.close()
+
+    protocol = RemoteServerProtocol(Mock(), hmac, loop=event_loop,
+                                    root=str(tmpdir))
+    protocol.transport = NullTransport()
+    start = event_loop.time()
+    count = await replay(path, protocol, event_loop, speed=None)
+
+    assert count == 3
+    assert event_loop.time() - start < 1
+    stats = protocol.handler.stats.lookup(PACKET_TYPE_TELL_HEARTBEAT)
+    assert stats.count == 3
+    assert sorted(protocol.handler.sessions) == ['a', 'b', 'c']
@@ -0,0 +1,58 @@
+# =============================================================================
+# FILE: test_chunks.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import pytest
+from remote.chunks import (
+    count_chunks,
+    iter_file_chunks,
+)
+
+TEST_CHUNK_SIZE = 4
+
+
+@pytest.fixture()
+def file_path(tmpdir):
+    p = tmpdir.join('file.bin')
+    p.write_binary(b'0123456789')
+    return str(p)
+
+
+def test_count_chunks():
+    assert count_chunks(0, TEST_CHUNK_SIZE) == 1
+    assert count_chunks(4, TEST_CHUNK_SIZE) == 1
+    assert count_chunks(5, TEST_CHUNK_SIZE) == 2
+    assert count_chunks(10, TEST_CHUNK_SIZE) == 3
+
+
+def test_iter_file_chunks_yields_memoryviews(file_path):
+    actual = []
+    for index, total, data in iter_file_chunks(file_path, TEST_CHUNK_SIZE):
+        assert isinstance(data, memoryview)
+        actual.append((index, total, bytes(data)))
+
+    assert actual == [
+        (0, 3, b'0123'),
+        (1, 3, b'4567'),
+        (2, 3, b'89'),
+    ]
+
+
+def test_iter_file_chunks_empty_file(tmpdir):
+    p = tmpdir.join('empty')
+    p.write_binary(b'')
+
+    actual = [(i, t, bytes(d)) for i, t, d in iter_file_chunks(str(p))]
+    assert actual == [(0, 1, b'')]
+
+
+def test_iter_file_chunks_close_early(file_path):
+    chunks = iter_file_chunks(file_path, TEST_CHUNK_SIZE)
+    index, total, data = next(chunks)
+    assert bytes(data) == b'0123'
+    chunks.close()
+
+    # View is no longer valid once the generator has moved on
+    with pytest.raises(ValueError):
+        bytes(data)
@@ -0,0 +1,175 @@
+# =============================================================================
+# FILE: test_client.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import pytest
+import asyncio
+import os
+from unittest.mock import Mock
+from remote.builders import (
+    build_answer_file_list,
+    build_ask_file_list,
+    build_update_file_data,
+    build_update_file_start,
+)
+from remote.chunks import CHUNK_SIZE
+from remote.client import FileListStream, RemoteClient
+from remote.constants import (
+    MESSAGE_METADATA_CHUNK_INDEX,
+    PACKET_TYPE_UPDATE_FILE_DATA,
+)
+from remote.handlers.base import BaseHandler
+from remote.handlers.client import ClientHandler
+from remote.handlers.server import ServerHandler
+from remote.index import FileIndex
+from remote.packet import Packet
+
+
+@pytest.fixture()
+def client():
+    c = Mock()
+    c.protocol.handler = BaseHandler(nvim=None, send=None)
+    return c
+
+
+def answer(ask, index, is_last, entries):
+    return build_answer_file_list('user', 'session', ask.get_header(),
+                                  index, is_last, entries)
+
+
+class TestFileListStream(object):
+    @pytest.mark.asyncio
+    async def test_pages_reordered(self, client):
+        ask = build_ask_file_list('user', 'session', '')
+        stream = FileListStream(client, ask, timeout=1)
+
+        async def receive_pages():
+            await asyncio.sleep(0)
+            handler = client.protocol.handler
+            handler._answer(answer(ask, 1, True, [['c', 3, 0]]))
+            handler._answer(answer(ask, 0, False, [['a', 1, 0], ['b', 2, 0]]))
+
+        asyncio.ensure_future(receive_pages())
+        actual = []
+        async for entry in stream:
+            actual.append(entry[0])
+
+        assert actual == ['a', 'b', 'c']
+        client.send_packet.assert_called_once_with(ask)
+        assert client.protocol.handler.streams == {}
+
+    @pytest.mark.asyncio
+    async def test_missing_page_times_out(self, client):
+        ask = build_ask_file_list('user', 'session', '')
+        stream = FileListStream(client, ask, timeout=0.01)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await stream.__anext__()
+
+
+@pytest.mark.asyncio
+async def test_file_update_resends_dropped_chunks(event_loop, tmpdir):
+    client = RemoteClient(Mock(), event_loop, '127.0.0.1', 0, 'key',
+                          index=FileIndex(None), root=str(tmpdir))
+    handler = ClientHandler(nvim=None, send=None)
+    client.protocol = Mock(handler=handler)
+    server = ServerHandler(
+        nvim=None,
+        send=lambda packet, addr: handler.process(
+            Packet.read(packet.gen_signature(client.hmac).to_bytes())),
+        broadcast=None,
+        loop=event_loop,
+        root=str(tmpdir),
+    )
+    server.sessions[client.info['session']] = ('127.0.0.1', 0)
+
+    path = tmpdir.join('big.bin')
+    data = os.urandom(3 * CHUNK_SIZE)
+    path.write_binary(data)
+    dropped = []
+
+    def send_packet(packet):
+        if (packet.get_header().get_type() == PACKET_TYPE_UPDATE_FILE_DATA):
+            index = packet.get_metadata().get_value(
+                MESSAGE_METADATA_CHUNK_INDEX)
+            if (index == 1 and not dropped):
+                dropped.append(packet)
+                return
+        server.process(Packet.read(packet.gen_signature(
+            client.hmac).to_bytes()))
+    client.send_packet = send_packet
+
+    assert await client.send_start_file_update(str(path))
+
+    assert dropped
+    assert server.reassembly.received(
+        client.info['session'], str(path), 1, 3).complete()
+    assert path.read_binary() == data
+
+
+@pytest.mark.asyncio
+async def test_file_update_unconfirmed_is_resent(event_loop, tmpdir):
+    client = RemoteClient(Mock(), event_loop, '127.0.0.1', 0, 'key',
+                          index=FileIndex(None), root=str(tmpdir))
+    handler = ClientHandler(nvim=None, send=None)
+    client.protocol = Mock(handler=handler)
+    server = ServerHandler(
+        nvim=None,
+        send=lambda packet, addr: handler.process(
+            Packet.read(packet.gen_signature(client.hmac).to_bytes())),
+        broadcast=None,
+        loop=event_loop,
+        root=str(tmpdir),
+    )
+    server.sessions[client.info['session']] = ('127.0.0.1', 0)
+
+    path = tmpdir.join('f.bin')
+    path.write_binary(os.urandom(2 * CHUNK_SIZE))
+    dropping = [True]
+
+    def send_packet(packet):
+        if (dropping[0] and packet.get_header().get_type() ==
+                PACKET_TYPE_UPDATE_FILE_DATA):
+            return
+        server.process(Packet.read(packet.gen_signature(
+            client.hmac).to_bytes()))
+    client.send_packet = send_packet
+
+    assert not await client.send_start_file_update(str(path))
+    assert str(path) not in client._sent_versions
+
+    dropping[0] = False
+    assert await client.send_start_file_update(str(path))
+    assert not await client.send_start_file_update(str(path))
+
+
+def test_remote_path_relative_to_root(tmpdir):
+    client = RemoteClient(Mock(), None, '127.0.0.1', 0, 'key',
+                          root=str(tmpdir.join('root')))
+    assert client.remote_path(str(tmpdir.join('root', 'a', 'b.txt'))) == (
+        os.path.join('a', 'b.txt'))
+    assert client.remote_path(str(tmpdir.join('other.txt'))) is None
+    assert client.remote_path(str(tmpdir)) is None
+
+
+@pytest.mark.asyncio
+async def test_server_rejects_update_outside_root(event_loop, tmpdir):
+    root = tmpdir.mkdir('root')
+    server = ServerHandler(nvim=None, send=Mock(), broadcast=None,
+                           loop=event_loop, root=str(root))
+
+    for path in ('../escaped.txt', str(tmpdir.join('escaped.txt'))):
+        server.process(build_update_file_start(
+            'user', 'session', path, 1, 2, 1, CHUNK_SIZE))
+        server.process(build_update_file_data(
+            'user', 'session', path, 1, 0, 1, b'hi'))
+    await asyncio.sleep(0.01)
+    assert not tmpdir.join('escaped.txt').check()
+
+    server.process(build_update_file_start(
+        'user', 'session', 'kept.txt', 1, 2, 1, CHUNK_SIZE))
+    server.process(build_update_file_data(
+        'user', 'session', 'kept.txt', 1, 0, 1, b'hi'))
+    await asyncio.sleep(0.01)
+    assert root.join('kept.txt').read_binary() == b'hi'
@@ -0,0 +1,183 @@
+# =============================================================================
+# FILE: test_commands.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+import pytest
+import sys
+from unittest.mock import Mock
+from remote.builders import build_answer_command, build_ask_command
+from remote.client import CommandStream
+from remote.commands import EXIT_CODE_NOT_STARTED, CommandRunner
+from remote.constants import (
+    COMMAND_STREAM_EXIT,
+    COMMAND_STREAM_STDERR,
+    COMMAND_STREAM_STDOUT,
+    MESSAGE_METADATA_SEQUENCE,
+)
+from remote.handlers.base import BaseHandler
+
+TEST_SESSION = 'session'
+
+
+class Output(object):
+    def __init__(self):
+        self.packets = []
+
+    def send(self, sequence, stream, data, exit_code):
+        self.packets.append((sequence, stream, data, exit_code))
+
+    def stream(self, stream):
+        return b''.join(p[2] for p in self.packets if p[1] == stream)
+
+    def exit_code(self):
+        return [p[3] for p in self.packets if p[1] == COMMAND_STREAM_EXIT][-1]
+
+
+def python(code):
+    return sys.executable, ['-c', code]
+
+
+async def cancel_all(runner, *tasks):
+    runner.cancel_all()
+    await asyncio.wait(tasks, timeout=5)
+
+
+class TestCommandRunner(object):
+    @pytest.mark.asyncio
+    async def test_streams_output_and_exit_code(self, event_loop):
+        out = Output()
+        runner = CommandRunner(event_loop, ack_timeout=0.05)
+        name, args = python(
+            'import sys; print("out"); print("err", file=sys.stderr); '
+            'sys.exit(3)')
+        task = runner.start(TEST_SESSION, 1, name, args, out.send)
+
+        while not out.packets or out.packets[-1][1] != COMMAND_STREAM_EXIT:
+            await asyncio.sleep(0.01)
+        runner.ack(1, out.packets[-1][0])
+        await task
+
+        assert out.stream(COMMAND_STREAM_STDOUT) == b'out\n'
+        assert out.stream(COMMAND_STREAM_STDERR) == b'err\n'
+        assert out.exit_code() == 3
+        assert runner.running() == []
+
+    @pytest.mark.asyncio
+    async def test_window_limits_unacknowledged_output(self, event_loop):
+        out = Output()
+        runner = CommandRunner(event_loop, window=2, read_size=1,
+                               ack_timeout=10)
+        name, args = python('print("x" * 100)')
+        task = runner.start(TEST_SESSION, 1, name, args, out.send)
+
+        await asyncio.sleep(0.5)
+        assert len(out.packets) == 2
+
+        runner.ack(1, 0)
+        await asyncio.sleep(0.05)
+        assert len(out.packets) == 3
+        await cancel_all(runner, task)
+
+    @pytest.mark.asyncio
+    async def test_unacknowledged_output_resent(self, event_loop):
+        out = Output()
+        runner = CommandRunner(event_loop, window=1, ack_timeout=0.01)
+        name, args = python('print("x")')
+        task = runner.start(TEST_SESSION, 1, name, args, out.send)
+
+        await asyncio.sleep(0.3)
+        assert len([p for p in out.packets if p[0] == 0]) > 1
+        await cancel_all(runner, task)
+
+    @pytest.mark.asyncio
+    async def test_cancel_stops_process(self, event_loop):
+        out = Output()
+        runner = CommandRunner(event_loop)
+        name, args = python('import time; time.sleep(10)')
+        task = runner.start(TEST_SESSION, 1, name, args, out.send)
+        await asyncio.sleep(0.2)
+
+        assert runner.cancel(1)
+        while not out.packets or out.packets[-1][1] != COMMAND_STREAM_EXIT:
+            await asyncio.sleep(0.01)
+        runner.ack(1, out.packets[-1][0])
+        await asyncio.wait_for(task, 5)
+        assert out.exit_code() != 0
+
+    @pytest.mark.asyncio
+    async def test_cancel_resends_output_and_exit(self, event_loop):
+        out = Output()
+        runner = CommandRunner(event_loop, ack_timeout=0.05,
+                               max_retries=100)
+        name, args = python(
+            'import sys, time; print("x"); sys.stdout.flush(); '
+            'time.sleep(10)')
+        task = runner.start(TEST_SESSION, 1, name, args, out.send)
+        while not out.packets:
+            await asyncio.sleep(0.01)
+
+        runner.cancel(1)
+        await asyncio.sleep(0.5)
+        assert len([p for p in out.packets if p[0] == 0]) > 1
+        assert len([p for p in out.packets
+                    if p[1] == COMMAND_STREAM_EXIT]) > 1
+        assert runner.running() == [1]
+
+        runner.ack(1, max(p[0] for p in out.packets))
+        await asyncio.wait_for(task, 5)
+        assert runner.running() == []
+
+    @pytest.mark.asyncio
+    async def test_session_concurrency_cap(self, event_loop):
+        out = Output()
+        runner = CommandRunner(event_loop, max_per_session=1)
+        name, args = python('import time; time.sleep(10)')
+        first = runner.start(TEST_SESSION, 1, name, args, out.send)
+        second = runner.start(TEST_SESSION, 2, *python('print("x")'),
+                              out.send)
+        await asyncio.sleep(0.3)
+
+        assert out.packets == []
+        runner.cancel(1)
+        await asyncio.sleep(0.5)
+        assert out.stream(COMMAND_STREAM_STDOUT) == b'x\n'
+        await cancel_all(runner, first, second)
+
+    @pytest.mark.asyncio
+    async def test_missing_program(self, event_loop):
+        out = Output()
+        runner = CommandRunner(event_loop, ack_timeout=0.01, max_retries=0)
+        await runner.start(TEST_SESSION, 1, '/no/such/program', [], out.send)
+        assert out.stream(COMMAND_STREAM_STDERR)
+        assert out.exit_code() == EXIT_CODE_NOT_STARTED
+
+
+class TestCommandStream(object):
+    @pytest.mark.asyncio
+    async def test_output_reordered_and_acknowledged(self):
+        client = Mock()
+        client.protocol.handler = BaseHandler(nvim=None, send=None)
+        ask = build_ask_command('user', 'session', 'make', [])
+        stream = CommandStream(client, ask, timeout=1, ack_every=2)
+
+        def answer(seq, stream, data, exit_code=None):
+            return build_answer_command('user', 'session', ask.get_header(),
+                                        seq, stream, data, exit_code)
+
+        async def receive():
+            await asyncio.sleep(0)
+            handler = client.protocol.handler
+            handler._answer(answer(1, COMMAND_STREAM_STDOUT, b'b'))
+            handler._answer(answer(0, COMMAND_STREAM_STDOUT, b'a'))
+            handler._answer(answer(2, COMMAND_STREAM_EXIT, b'', 0))
+
+        asyncio.ensure_future(receive())
+        actual = [data async for _, data in stream]
+
+        assert actual == [b'a', b'b']
+        assert stream.exit_code == 0
+        acks = [c[0][0] for c in client.send_packet.call_args_list[1:]]
+        assert [a.get_metadata().get_value(MESSAGE_METADATA_SEQUENCE)
+                for a in acks] == [1, 2]
@@ -0,0 +1,38 @@
+# =============================================================================
+# FILE: test_constants.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+from remote import constants as c
+
+
+def test_packet_types_are_unique_codes():
+    codes = [v for k, v in vars(c).items()
+             if (k.startswith('PACKET_TYPE_') and
+                 k not in ('PACKET_TYPE_LIMIT', 'PACKET_TYPE_MASK',
+                           'PACKET_TYPE_NAMES'))]
+    assert len(set(codes)) == len(codes)
+    assert all(0 <= code < c.PACKET_TYPE_LIMIT for code in codes)
+    assert sorted(codes) == sorted(c.PACKET_TYPE_NAMES)
+
+
+def test_kind_encoded_in_code():
+    assert c.is_tell(c.PACKET_TYPE_TELL_HEARTBEAT)
+    assert c.is_tell(c.PACKET_TYPE_UPDATE_FILE_DATA)
+    assert c.is_ask(c.PACKET_TYPE_ASK_TREE)
+    assert c.is_ask(c.PACKET_TYPE_RETRIEVE_FILE_ASK)
+    assert c.is_answer(c.PACKET_TYPE_ANSWER_TREE)
+    assert c.is_answer(c.PACKET_TYPE_RETRIEVE_FILE)
+    assert not c.is_ask(c.PACKET_TYPE_ANSWER_TREE)
+
+    # An ask and its answer differ only by kind
+    assert (c.PACKET_TYPE_ASK_TREE >> c.PACKET_KIND_BITS ==
+            c.PACKET_TYPE_ANSWER_TREE >> c.PACKET_KIND_BITS)
+
+
+def test_packet_type_name():
+    heartbeat = c.PACKET_TYPE_TELL_HEARTBEAT
+    assert c.packet_type_name(heartbeat) == 'HEARTBEAT_TELL'
+    assert c.packet_type_name(c.PACKET_TYPE_RETRIEVE_FILE) == 'RETRIEVE_FILE'
+    assert c.packet_type_name(0) == 0
+    assert c.packet_type_name('some_type') == 'some_type'
@@ -0,0 +1,82 @@
+# =============================================================================
+# FILE: test_debounce.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import pytest
+import asyncio
+from unittest.mock import Mock
+from remote.debounce import CoalescingQueue
+from remote.timer import TimingWheel
+
+TEST_WINDOW = 0.01
+TEST_PATH = 'file.txt'
+
+
+class TestCoalescingQueue(object):
+    @pytest.mark.asyncio
+    async def test_repeated_events_collapse(self, event_loop):
+        f = Mock(return_value=None)
+        q = CoalescingQueue(event_loop, f, TEST_WINDOW)
+
+        q.push(TEST_PATH).push(TEST_PATH).push(TEST_PATH)
+        assert q.pending() == [TEST_PATH]
+
+        await asyncio.sleep(TEST_WINDOW * 3)
+        f.assert_called_once_with(TEST_PATH)
+        assert q.pending() == []
+
+    @pytest.mark.asyncio
+    async def test_windows_on_wheel(self, event_loop):
+        f = Mock(return_value=None)
+        wheel = TimingWheel(event_loop, tick=TEST_WINDOW / 10)
+        q = CoalescingQueue(event_loop, f, TEST_WINDOW, wheel=wheel)
+
+        q.push('a').push('b').push('a')
+        assert wheel.count() == 2
+
+        await asyncio.sleep(TEST_WINDOW * 3)
+        assert f.call_count == 2
+        assert wheel.count() == 0
+
+    @pytest.mark.asyncio
+    async def test_separate_keys_not_collapsed(self, event_loop):
+        f = Mock(return_value=None)
+        q = CoalescingQueue(event_loop, f, TEST_WINDOW)
+
+        q.push('a').push('b').push('a')
+
+        await asyncio.sleep(TEST_WINDOW * 3)
+        assert f.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_superseded_work_cancelled(self, event_loop):
+        started = []
+
+        async def transfer(key):
+            started.append(key)
+            await asyncio.sleep(1)
+
+        q = CoalescingQueue(event_loop, lambda k: transfer(k), TEST_WINDOW)
+
+        q.push(TEST_PATH)
+        await asyncio.sleep(TEST_WINDOW * 3)
+        first = q._in_flight[TEST_PATH]
+
+        q.push(TEST_PATH)
+        await asyncio.sleep(TEST_WINDOW * 3)
+
+        assert first.cancelled()
+        assert len(started) == 2
+        assert q.in_flight() == [TEST_PATH]
+        q.clear()
+
+    @pytest.mark.asyncio
+    async def test_cancel_removes_pending(self, event_loop):
+        f = Mock(return_value=None)
+        q = CoalescingQueue(event_loop, f, TEST_WINDOW)
+
+        q.push(TEST_PATH).cancel(TEST_PATH)
+
+        await asyncio.sleep(TEST_WINDOW * 3)
+        assert not f.called
@@ -0,0 +1,97 @@
+# =============================================================================
+# FILE: test_dirindex.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import os
+import pytest
+from remote.dirindex import DirectoryIndex
+
+
+@pytest.fixture()
+def root(tmpdir):
+    tmpdir.join('a.txt').write('a')
+    tmpdir.join('sub', 'b.txt').write('bb', ensure=True)
+    tmpdir.join('.git', 'HEAD').write('ref', ensure=True)
+    return tmpdir
+
+
+def paths(index, prefix=''):
+    return [e[0] for e in index.iter_entries(prefix)]
+
+
+def test_build(root):
+    index = DirectoryIndex(str(root))
+    assert not index.is_built()
+    assert index.build() == 2
+    assert paths(index) == ['a.txt', os.path.join('sub', 'b.txt')]
+
+
+def test_entries_contain_size(root):
+    index = DirectoryIndex(str(root))
+    index.build()
+    sizes = {e[0]: e[1] for e in index.iter_entries()}
+    assert sizes['a.txt'] == 1
+
+
+def test_iter_entries_prefix(root):
+    index = DirectoryIndex(str(root))
+    index.build()
+    assert paths(index, 'sub') == [os.path.join('sub', 'b.txt')]
+
+
+def test_update_new_file(root):
+    index = DirectoryIndex(str(root))
+    index.build()
+    root.join('sub', 'deep', 'c.txt').write('c', ensure=True)
+    index.update(str(root.join('sub', 'deep', 'c.txt')))
+    assert os.path.join('sub', 'deep', 'c.txt') in paths(index)
+
+
+def test_update_new_directory(root):
+    index = DirectoryIndex(str(root))
+    index.build()
+    root.join('new', 'd.txt').write('d', ensure=True)
+    index.update(str(root.join('new')))
+    assert os.path.join('new', 'd.txt') in paths(index)
+
+
+def test_update_deleted_file(root):
+    index = DirectoryIndex(str(root))
+    index.build()
+    root.join('a.txt').remove()
+    index.update(str(root.join('a.txt')))
+    assert 'a.txt' not in paths(index)
+
+
+def test_remove_directory(root):
+    index = DirectoryIndex(str(root))
+    index.build()
+    index.remove(str(root.join('sub')))
+    assert paths(index) == ['a.txt']
+
+
+def test_update_outside_root_ignored(root, tmpdir_factory):
+    other = tmpdir_factory.mktemp('other').join('x.txt')
+    other.write('x')
+    index = DirectoryIndex(str(root))
+    index.build()
+    index.update(str(other))
+    assert len(paths(index)) == 2
+
+
+def test_pages_fit_limit(root):
+    for i in range(50):
+        root.join('many', 'file{}.txt'.format(i)).write('', ensure=True)
+    index = DirectoryIndex(str(root))
+    index.build()
+
+    pages = list(index.pages(max_bytes=200))
+    assert len(pages) > 1
+    assert sum(len(p) for p in pages) == 52
+
+
+def test_pages_empty_index(tmpdir):
+    index = DirectoryIndex(str(tmpdir))
+    index.build()
+    assert list(index.pages()) == [[]]
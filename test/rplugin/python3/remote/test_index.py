@@ -0,0 +1,114 @@
+# =============================================================================
+# FILE: test_index.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import os
+import pytest
+from hashlib import sha256
+from unittest.mock import patch
+from remote.index import (
+    FileIndex,
+    hash_file,
+)
+
+
+@pytest.fixture()
+def file_path(tmpdir):
+    p = tmpdir.join('file.txt')
+    p.write('hello')
+    return str(p)
+
+
+@pytest.fixture()
+def index_path(tmpdir):
+    return str(tmpdir.join('index', 'log'))
+
+
+def touch(path, content, mtime_ns):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_hash_file(file_path):
+    assert hash_file(file_path, block_size=2) == sha256(b'hello').digest()
+
+
+def test_refresh_new_file(file_path, index_path):
+    entry = FileIndex(index_path).refresh(file_path)
+    assert entry.version == 1
+    assert entry.size == 5
+    assert entry.digest == sha256(b'hello').digest()
+
+
+def test_refresh_missing_file(tmpdir, index_path):
+    assert FileIndex(index_path).refresh(str(tmpdir.join('missing'))) is None
+
+
+def test_refresh_unchanged_stat_skips_hashing(file_path, index_path):
+    index = FileIndex(index_path)
+    index.refresh(file_path)
+
+    with patch('remote.index.hash_file') as h:
+        entry = index.refresh(file_path)
+        assert not h.called
+    assert entry.version == 1
+    assert index.is_unchanged(file_path)
+
+
+def test_refresh_same_content_keeps_version(file_path, index_path):
+    index = FileIndex(index_path)
+    touch(file_path, 'hello', 1000)
+    index.refresh(file_path)
+    touch(file_path, 'hello', 2000)
+    assert index.refresh(file_path).version == 1
+
+
+def test_refresh_changed_content_bumps_version(file_path, index_path):
+    index = FileIndex(index_path)
+    touch(file_path, 'hello', 1000)
+    index.refresh(file_path)
+    touch(file_path, 'world!', 2000)
+    assert not index.is_unchanged(file_path)
+    assert index.refresh(file_path).version == 2
+
+
+def test_index_persisted_and_loaded_lazily(file_path, index_path):
+    index = FileIndex(index_path)
+    expected = index.refresh(file_path)
+    index.close()
+
+    index = FileIndex(index_path)
+    assert index._entries is None
+    assert index.lookup(file_path) == expected
+
+
+def test_remove_persisted(file_path, index_path):
+    index = FileIndex(index_path)
+    index.refresh(file_path)
+    index.remove(file_path)
+    index.close()
+
+    assert FileIndex(index_path).lookup(file_path) is None
+
+
+def test_recreated_file_continues_version(file_path, index_path):
+    index = FileIndex(index_path)
+    touch(file_path, 'hello', 1000)
+    index.refresh(file_path)
+    touch(file_path, 'world!', 2000)
+    index.refresh(file_path)
+    os.remove(file_path)
+    assert index.refresh(file_path) is None
+    index.close()
+
+    index = FileIndex(index_path)
+    touch(file_path, 'hello', 3000)
+    assert index.refresh(file_path).version == 3
+
+
+def test_in_memory_index(file_path):
+    index = FileIndex(None)
+    assert index.refresh(file_path).version == 1
+    assert index.paths() == [file_path]
@@ -0,0 +1,73 @@
+# =============================================================================
+# FILE: test_indexer.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import os
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from remote.index import FileIndex, hash_file
+from remote.indexer import ParallelIndexer, hash_batch
+
+TEST_FILE_COUNT = 10
+
+
+@pytest.fixture()
+def root(tmpdir):
+    for i in range(TEST_FILE_COUNT):
+        tmpdir.join('dir{}'.format(i % 3), 'file{}'.format(i)).write(
+            str(i), ensure=True)
+    return tmpdir
+
+
+def test_hash_batch_skips_missing(root):
+    path = str(root.join('dir0', 'file0'))
+    actual = hash_batch([path, str(root.join('missing'))])
+    assert len(actual) == 1
+    assert actual[0][0] == path
+    assert actual[0][3] == hash_file(path)
+
+
+class TestParallelIndexer(object):
+    @pytest.mark.asyncio
+    async def test_index_tree_in_process_pool(self, event_loop, root):
+        index = FileIndex(None)
+        reports = []
+        indexer = ParallelIndexer(event_loop, index, workers=2, batch_size=3,
+                                  progress=lambda d, t: reports.append(
+                                      (d, t)))
+        dir_index = await indexer.index_tree(str(root))
+
+        assert len(list(dir_index.iter_entries())) == TEST_FILE_COUNT
+        assert len(index.paths()) == TEST_FILE_COUNT
+        path = str(root.join('dir1', 'file1'))
+        assert index.lookup(path).digest == hash_file(path)
+        assert reports[-1] == (TEST_FILE_COUNT, TEST_FILE_COUNT)
+
+    @pytest.mark.asyncio
+    async def test_only_stale_files_hashed(self, event_loop, root):
+        index = FileIndex(None)
+        executor = ThreadPoolExecutor(max_workers=2)
+        await ParallelIndexer(event_loop, index,
+                              executor=executor).index_tree(str(root))
+
+        path = root.join('dir2', 'file2')
+        path.write('changed')
+        os.utime(str(path), ns=(1, 1))
+        indexer = ParallelIndexer(event_loop, index, executor=executor)
+        await indexer.index_tree(str(root))
+
+        assert indexer.total == 1
+        assert index.lookup(str(path)).version == 2
+        executor.shutdown()
+
+    @pytest.mark.asyncio
+    async def test_index_failure_not_retried_on_threads(self, event_loop,
+                                                        root):
+        class BrokenIndex(FileIndex):
+            def update(self, *args):
+                raise AttributeError('broken')
+
+        indexer = ParallelIndexer(event_loop, BrokenIndex(None), workers=2)
+        with pytest.raises(AttributeError):
+            await indexer.index_tree(str(root))
@@ -0,0 +1,87 @@
+# =============================================================================
+# FILE: test_logger.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import logging
+import pytest
+from queue import Queue
+from remote import logger
+from remote.logger import BoundedQueueHandler, LoggingMixin
+
+
+def record(msg):
+    return logging.LogRecord('remote', logging.INFO, __file__, 1, msg,
+                             None, None)
+
+
+def test_bounded_queue_handler_drops_when_full():
+    queue = Queue(2)
+    handler = BoundedQueueHandler(queue)
+    for i in range(5):
+        handler.handle(record('message %s' % i))
+
+    assert handler.dropped == 3
+    assert [queue.get_nowait().getMessage() for _ in range(2)] == [
+        'message 0', 'message 1']
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class Noisy(LoggingMixin):
+    is_debug_enabled = True
+
+    def bad_packets(self, numbers):
+        for i in numbers:
+            self.error('Bad packet %s', i)
+
+
+@pytest.fixture()
+def records(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(logger, 'init', True)
+    monkeypatch.setattr(logger, 'clock', lambda: now[0])
+    monkeypatch.setattr(logger, 'log_message_burst', 2)
+    monkeypatch.setattr(logger, '_limits', {})
+    monkeypatch.setattr(logger.root, 'level', logging.INFO)
+
+    handler = Records()
+    handler.now = now
+    logger.root.addHandler(handler)
+    yield handler
+    logger.root.removeHandler(handler)
+
+
+class TestLoggingMixin(object):
+    def test_call_site_rate_limited(self, records):
+        noisy = Noisy()
+        noisy.bad_packets(range(5))
+        noisy.error('Other call site')
+        assert [r.getMessage() for r in records.records] == [
+            'Bad packet 0', 'Bad packet 1', 'Other call site']
+
+        records.now[0] += logger.log_message_cooldown
+        noisy.bad_packets(range(5, 7))
+        assert [r.getMessage() for r in records.records[3:]] == [
+            'Suppressed 3 messages like: Bad packet %s', 'Bad packet 5',
+            'Bad packet 6']
+
+    def test_disabled_level_skips_arguments(self, records):
+        class Expensive(object):
+            def __str__(self):
+                raise AssertionError('formatted a disabled message')
+
+        noisy = Noisy()
+        for _ in range(5):
+            noisy.debug('Packet %s', Expensive())
+        noisy.info('Shown')
+
+        assert [r.getMessage() for r in records.records] == ['Shown']
+        assert len(logger._limits) == 1
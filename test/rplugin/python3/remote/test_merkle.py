@@ -0,0 +1,111 @@
+# =============================================================================
+# FILE: test_merkle.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import os
+import pytest
+from unittest.mock import Mock
+from remote.client import RemoteClient
+from remote.index import FileIndex
+from remote.merkle import MerkleTree, diff_children
+
+
+def digest(text):
+    return text.encode('utf-8').ljust(32, b'\0')
+
+
+def tree_of(files):
+    t = MerkleTree()
+    for path, text in files.items():
+        t.set(path, digest(text))
+    return t
+
+
+TEST_FILES = {
+    os.path.join('a', 'x', '1'): 'one',
+    os.path.join('a', 'x', '2'): 'two',
+    os.path.join('a', 'y', '3'): 'three',
+    os.path.join('b', '4'): 'four',
+    '5': 'five',
+}
+
+
+class TestMerkleTree(object):
+    def test_same_files_same_hash(self):
+        a = tree_of(TEST_FILES)
+        b = tree_of(dict(reversed(list(TEST_FILES.items()))))
+        assert a.hash() == b.hash()
+
+    def test_change_updates_ancestors_only(self):
+        t = tree_of(TEST_FILES)
+        before = {p: t.hash(p) for p in ['', 'a', os.path.join('a', 'x'),
+                                         os.path.join('a', 'y'), 'b']}
+        t.set(os.path.join('a', 'x', '1'), digest('changed'))
+
+        assert t.hash() != before['']
+        assert t.hash('a') != before['a']
+        assert t.hash(os.path.join('a', 'x')) != before[os.path.join('a', 'x')]
+        assert t.hash(os.path.join('a', 'y')) == before[os.path.join('a', 'y')]
+        assert t.hash('b') == before['b']
+
+    def test_remove_prunes_empty_directories(self):
+        t = tree_of(TEST_FILES)
+        t.remove(os.path.join('b', '4'))
+        assert not t.is_dir('b')
+
+        expected = dict(TEST_FILES)
+        del expected[os.path.join('b', '4')]
+        assert t.hash() == tree_of(expected).hash()
+
+    def test_pages_split_children(self):
+        t = tree_of({str(i): 'x' for i in range(50)})
+        pages = list(t.pages('', max_bytes=200))
+        assert len(pages) > 1
+        assert [e for p in pages for e in p] == t.children('')
+
+    def test_diff_children(self):
+        local = [['a', False, b'1'], ['b', True, b'2'], ['c', False, b'3']]
+        remote = [['a', False, b'1'], ['b', True, b'9'], ['d', False, b'4']]
+        actual = [name for name, _, _ in diff_children(local, remote)]
+        assert actual == ['b', 'c', 'd']
+
+
+class TestReconcile(object):
+    @pytest.mark.asyncio
+    async def test_descends_only_into_changed_directories(self, event_loop):
+        local = tree_of(TEST_FILES)
+        files = dict(TEST_FILES)
+        files[os.path.join('a', 'x', '2')] = 'changed'
+        files[os.path.join('c', '6')] = 'six'
+        del files['5']
+        remote = tree_of(files)
+
+        client = RemoteClient(Mock(), event_loop, '127.0.0.1', 0, 'key',
+                              index=FileIndex(None))
+        asked = []
+
+        async def list_tree_all(path, timeout):
+            asked.append(path)
+            return remote.children(path)
+        client._list_tree_all = list_tree_all
+
+        changed = await client.reconcile(local)
+        assert [c[0] for c in changed] == [
+            '5',
+            os.path.join('a', 'x', '2'),
+            os.path.join('c', '6'),
+        ]
+        assert changed[0][2] is None
+        assert changed[2][1] is None
+        assert sorted(asked) == ['', 'a', os.path.join('a', 'x'), 'c']
+
+    @pytest.mark.asyncio
+    async def test_build_tree_matches_files(self, event_loop, tmpdir):
+        tmpdir.join('a.txt').write('hello')
+        tmpdir.mkdir('sub').join('b.txt').write('world')
+
+        client = RemoteClient(Mock(), event_loop, '127.0.0.1', 0, 'key',
+                              index=FileIndex(None))
+        tree = await client.build_tree(str(tmpdir))
+        assert sorted(tree.files()) == ['a.txt', os.path.join('sub', 'b.txt')]
@@ -0,0 +1,274 @@
+# =============================================================================
+# FILE: test_metrics.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+import json
+import pytest
+from unittest.mock import Mock
+from remote import metrics
+from remote.builders import build_tell_heartbeat
+from remote.constants import PACKET_TYPE_TELL_HEARTBEAT
+from remote.handlers.base import BaseHandler
+from remote.capture import NullTransport
+from remote.client import RemoteClient, RemoteClientProtocol
+from remote.index import FileIndex
+from remote.metrics import (
+    Histogram,
+    MeteredTransport,
+    MetricsRegistry,
+    PacketStats,
+    write_json,
+)
+from remote.packet import Packet
+from remote.security import new_hmac_from_key
+from remote.server import RemoteServerProtocol
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def heartbeat():
+    packet = build_tell_heartbeat('user', 'session')
+    data = packet.gen_signature(new_hmac_from_key('key')).to_bytes()
+    return Packet.read(data), len(data)
+
+
+class TestHistogram(object):
+    def test_observe(self):
+        h = Histogram(buckets=(1, 10))
+        for value in [0.5, 2, 3, 20]:
+            h.observe(value)
+
+        assert h.counts == [1, 2, 1]
+        assert h.count == 4
+        assert h.mean() == 25.5 / 4
+        assert h.max == 20
+
+    def test_quantile(self):
+        h = Histogram(buckets=(1, 10))
+        assert h.quantile(0.5) == 0
+        for value in [0.5, 2, 3, 20]:
+            h.observe(value)
+
+        assert h.quantile(0.25) == 1
+        assert h.quantile(0.5) == 10
+        assert h.quantile(0.99) == 20
+
+
+class TestPacketStats(object):
+    def test_records_sync_actions(self):
+        clock = FakeClock()
+        stats = PacketStats(clock=clock, buckets=(1, 10))
+        packet, size = heartbeat()
+
+        def action(p):
+            clock.now += 2
+            return 'done'
+
+        assert stats(lambda a, p: a(p), action, packet) == 'done'
+
+        s = stats.lookup(PACKET_TYPE_TELL_HEARTBEAT)
+        assert s.count == 1
+        assert s.bytes == size
+        assert s.errors == 0
+        assert s.latency.counts == [0, 1, 0]
+
+    def test_records_errors(self):
+        stats = PacketStats()
+        packet, _ = heartbeat()
+
+        def action(p):
+            raise ValueError('bad packet')
+
+        with pytest.raises(ValueError):
+            stats(lambda a, p: a(p), action, packet)
+        assert stats.lookup(PACKET_TYPE_TELL_HEARTBEAT).errors == 1
+
+    @pytest.mark.asyncio
+    async def test_times_futures_until_done(self, event_loop):
+        clock = FakeClock()
+        stats = PacketStats(clock=clock, buckets=(1, 10))
+        packet, _ = heartbeat()
+        future = event_loop.create_future()
+
+        stats(lambda a, p: a(p), lambda p: future, packet)
+        s = stats.lookup(PACKET_TYPE_TELL_HEARTBEAT)
+        assert s.latency.count == 0
+
+        clock.now += 20
+        future.set_exception(ValueError('bad packet'))
+        await asyncio.sleep(0)
+        assert s.latency.counts == [0, 0, 1]
+        assert s.errors == 1
+
+    def test_handler_records_processed_packets(self):
+        handler = BaseHandler(nvim=None, send=None)
+        handler.registry.register(PACKET_TYPE_TELL_HEARTBEAT, lambda p: None)
+        packet, size = heartbeat()
+        handler.process(packet)
+
+        assert handler.stats.lookup(PACKET_TYPE_TELL_HEARTBEAT).bytes == size
+        lines = handler.stats.format()
+        assert len(lines) == 2
+        assert lines[1].startswith('HEARTBEAT_TELL')
+
+
+class TestMetricsRegistry(object):
+    def test_metrics_created_once(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('packets')
+        counter.inc()
+        counter.inc(2)
+
+        assert registry.counter('packets') is counter
+        assert registry.histogram('rtt') is registry.histogram('rtt')
+        assert registry.snapshot() == {'packets': 3, 'rtt': registry
+                                       .histogram('rtt').to_dict()}
+
+    def test_gauge_reads_function(self):
+        registry = MetricsRegistry()
+        registry.gauge('set').set(5)
+        depth = []
+        registry.gauge('depth', lambda: len(depth))
+        depth.extend([1, 2])
+
+        assert registry.snapshot() == {'set': 5, 'depth': 2}
+
+        # Registering again replaces the function read
+        registry.gauge('depth', lambda: 7)
+        assert registry.snapshot()['depth'] == 7
+
+    def test_remove(self):
+        registry = MetricsRegistry()
+        registry.counter('packets')
+        first, second = (lambda: 1), (lambda: 2)
+        registry.gauge('depth', first)
+        registry.gauge('depth', second)
+
+        # A gauge taken over by another function is kept
+        registry.remove('depth', first)
+        registry.remove('packets')
+        assert registry.snapshot() == {'depth': 2}
+        registry.remove('depth', second)
+        registry.remove('missing')
+        assert registry.snapshot() == {}
+
+    def test_reset_leaves_gauges(self):
+        registry = MetricsRegistry()
+        registry.counter('packets').inc(4)
+        registry.gauge('depth').set(3)
+        registry.histogram('rtt').observe(0.2)
+        registry.reset()
+
+        snapshot = registry.snapshot()
+        assert snapshot['packets'] == 0
+        assert snapshot['depth'] == 3
+        assert snapshot['rtt']['count'] == 0
+
+    def test_format(self):
+        registry = MetricsRegistry()
+        registry.counter('b.packets').inc()
+        registry.histogram('a.rtt').observe(0.002)
+
+        lines = registry.format()
+        assert lines[0].split() == [
+            'a.rtt', 'count=1', 'mean=2.000ms', 'p99=2.000ms',
+            'max=2.000ms']
+        assert lines[1].split() == ['b.packets', '1']
+
+    def test_write_json(self, tmpdir):
+        path = str(tmpdir.join('stats', 'metrics.json'))
+        write_json(path, {'packets': 3})
+
+        with open(path) as f:
+            assert json.load(f) == {'packets': 3}
+        assert tmpdir.join('stats').listdir() == [tmpdir.join(
+            'stats', 'metrics.json')]
+
+
+def test_metered_transport():
+    packets = metrics.Counter()
+    nbytes = metrics.Counter()
+    transport = MeteredTransport(NullTransport(), packets, nbytes)
+    transport.sendto(b'abc')
+    transport.sendto(b'de')
+
+    assert (packets.value, nbytes.value) == (2, 5)
+    assert transport.sent == 2
+
+
+@pytest.mark.asyncio
+async def test_server_protocol_counts_traffic(event_loop, tmpdir):
+    registry = metrics.default_registry
+    before = registry.snapshot()
+    protocol = RemoteServerProtocol(Mock(), new_hmac_from_key('key'),
+                                    loop=event_loop, root=str(tmpdir))
+    protocol.connection_made(NullTransport())
+
+    packet, size = heartbeat()
+    data = packet.to_bytes()
+    protocol.datagram_received(data, ('127.0.0.1', 1234))
+    bad = build_tell_heartbeat('user', 'session').gen_signature(
+        new_hmac_from_key('other')).to_bytes()
+    protocol.datagram_received(bad, ('127.0.0.1', 1234))
+    protocol.datagram_received(b'junk', ('127.0.0.1', 1234))
+    protocol.transport.sendto(b'reply', ('127.0.0.1', 1234))
+
+    after = registry.snapshot()
+
+    def delta(name):
+        return after[name] - before.get(name, 0)
+
+    assert delta('server.packets_in') == 3
+    assert delta('server.bytes_in') == len(data) + len(bad) + 4
+    assert delta('server.invalid_dropped') == 1
+    assert delta('server.malformed_dropped') == 1
+    assert delta('server.packets_out') == 1
+    assert delta('server.bytes_out') == 5
+    assert after['server.queued.TREE_ASK'] == 0
+    assert (after['packet.decode_seconds']['count'] -
+            before['packet.decode_seconds']['count']) >= 2
+
+
+def connected_client(event_loop):
+    client = RemoteClient(Mock(), event_loop, '127.0.0.1', 0, 'key',
+                          index=FileIndex(None))
+    client.protocol = RemoteClientProtocol(Mock(), client.hmac)
+    return client
+
+
+def test_clients_share_rtt_histogram(event_loop):
+    first = connected_client(event_loop)
+    second = connected_client(event_loop)
+
+    assert first._rtt is second._rtt
+    assert first._session_rtt is not second._session_rtt
+
+
+def test_stopped_client_removes_its_metrics(event_loop):
+    first = connected_client(event_loop)
+    second = connected_client(event_loop)
+    queued = list(second.protocol.gauges)
+    own = ['client.rtt.{}'.format(c.info['session'])
+           for c in (first, second)]
+
+    # Gauges taken over by the second client outlive the first
+    first.stop()
+    names = metrics.default_registry.snapshot()
+    assert own[0] not in names
+    assert own[1] in names
+    assert 'client.transfers_pending' in names
+    assert queued and all(name in names for name in queued)
+
+    second.stop()
+    names = metrics.default_registry.snapshot()
+    assert own[1] not in names
+    assert 'client.transfers_pending' not in names
+    assert not any(name in names for name in queued)
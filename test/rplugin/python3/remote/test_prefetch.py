@@ -0,0 +1,143 @@
+# =============================================================================
+# FILE: test_prefetch.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+import os
+import pytest
+from remote.prefetch import Prefetcher, find_references
+
+TEST_SIZE = 10
+
+
+class FakeRemote(object):
+    def __init__(self, tmpdir, files):
+        self.tmpdir = tmpdir
+        self.files = files
+        self.retrieved = []
+        self.listed = []
+        self.idle = True
+
+    async def retrieve(self, path, max_length):
+        if (path not in self.files or self.files[path] > max_length):
+            return None
+        self.retrieved.append(path)
+        local_path = str(self.tmpdir.join(path.replace(os.sep, '_')))
+        with open(local_path, 'wb') as f:
+            f.write(b'x' * self.files[path])
+        return local_path
+
+    def list_tree(self, directory):
+        self.listed.append(directory)
+
+        async def entries():
+            children = set()
+            for path in self.files:
+                if (os.path.dirname(path) == directory):
+                    children.add((os.path.basename(path), False))
+                elif (path.startswith(os.path.join(directory, ''))):
+                    name = path[len(directory):].lstrip(os.sep)
+                    children.add((name.split(os.sep)[0], True))
+            for name, is_dir in sorted(children):
+                yield [name, is_dir, b'']
+        return entries()
+
+
+def prefetcher(event_loop, remote, budget=1000):
+    return Prefetcher(event_loop, remote.retrieve, remote.list_tree,
+                      lambda: remote.idle, budget=budget, idle_poll=0.01)
+
+
+async def settle(p):
+    for _ in range(100):
+        if (p._task is None):
+            return
+        await asyncio.sleep(0.01)
+
+
+def test_find_references():
+    text = 'import "util.py"\nsee ../README.md and lib/helper.c'
+    actual = find_references(text, os.path.join('src', 'main.c'))
+    assert os.path.join('src', 'util.py') in actual
+    assert 'util.py' in actual
+    assert os.path.join('src', 'lib', 'helper.c') in actual
+    assert 'README.md' in actual
+    assert os.path.join('src', 'main.c') not in actual
+
+
+class TestPrefetcher(object):
+    @pytest.mark.asyncio
+    async def test_references_before_siblings(self, event_loop, tmpdir):
+        opened = tmpdir.join('opened')
+        opened.write('see b.txt')
+        remote = FakeRemote(tmpdir, {'a.txt': TEST_SIZE, 'b.txt': TEST_SIZE,
+                                     'main.c': TEST_SIZE})
+        p = prefetcher(event_loop, remote)
+        p.opened('main.c', str(opened))
+        await settle(p)
+
+        assert remote.retrieved == ['b.txt', 'a.txt']
+        assert p.used() == 2 * TEST_SIZE
+
+    @pytest.mark.asyncio
+    async def test_budget_bounds_prefetch(self, event_loop, tmpdir):
+        remote = FakeRemote(tmpdir, {'a': TEST_SIZE, 'b': TEST_SIZE,
+                                     'c': TEST_SIZE, 'main': TEST_SIZE})
+        p = prefetcher(event_loop, remote, budget=TEST_SIZE * 2)
+        p.opened('main')
+        await settle(p)
+
+        assert remote.retrieved == ['a', 'b']
+
+    @pytest.mark.asyncio
+    async def test_waits_for_idle(self, event_loop, tmpdir):
+        remote = FakeRemote(tmpdir, {'a': TEST_SIZE, 'main': TEST_SIZE})
+        remote.idle = False
+        p = prefetcher(event_loop, remote)
+        p.opened('main')
+        await asyncio.sleep(0.05)
+        assert remote.retrieved == []
+
+        remote.idle = True
+        await settle(p)
+        assert remote.retrieved == ['a']
+
+    @pytest.mark.asyncio
+    async def test_recent_files_suggested(self, event_loop, tmpdir):
+        remote = FakeRemote(tmpdir, {'a': TEST_SIZE})
+        p = prefetcher(event_loop, remote)
+        p.opened(os.path.join('x', 'first'))
+        await settle(p)
+        p.opened(os.path.join('y', 'second'))
+        assert p.pending() == [os.path.join('x', 'first')]
+        p.cancel()
+
+    @pytest.mark.asyncio
+    async def test_siblings_listed_from_directory(self, event_loop, tmpdir):
+        remote = FakeRemote(tmpdir, {
+            os.path.join('src', 'a.txt'): TEST_SIZE,
+            os.path.join('src', 'b.c'): TEST_SIZE,
+            os.path.join('src', 'main.c'): TEST_SIZE,
+            os.path.join('src', 'lib', 'c.c'): TEST_SIZE,
+        })
+        p = prefetcher(event_loop, remote)
+        p.opened(os.path.join('src', 'main.c'))
+        await settle(p)
+
+        assert remote.listed == ['src']
+        assert remote.retrieved == [os.path.join('src', 'b.c'),
+                                    os.path.join('src', 'a.txt')]
+
+    @pytest.mark.asyncio
+    async def test_fetched_paths_bounded(self, event_loop, tmpdir,
+                                         monkeypatch):
+        monkeypatch.setattr('remote.prefetch.MAX_FETCHED', 2)
+        remote = FakeRemote(tmpdir, {'a': TEST_SIZE, 'b': TEST_SIZE,
+                                     'c': TEST_SIZE, 'main': TEST_SIZE})
+        p = prefetcher(event_loop, remote)
+        p.opened('main')
+        await settle(p)
+
+        assert remote.retrieved == ['a', 'b', 'c']
+        assert list(p._fetched) == ['b', 'c']
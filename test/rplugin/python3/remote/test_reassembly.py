@@ -0,0 +1,193 @@
+# =============================================================================
+# FILE: test_reassembly.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import os
+import pytest
+import time
+from remote.reassembly import (
+    ChunkBitmap,
+    ChunkReassembler,
+    ReassemblyManager,
+    TransferStore,
+)
+
+TEST_DATA = b'0123456789'
+TEST_CHUNK_SIZE = 4
+TEST_CHUNKS = [b'0123', b'4567', b'89']
+TEST_SESSION = 'session'
+
+
+@pytest.fixture()
+def path(tmpdir):
+    return str(tmpdir.join('out', 'file.bin'))
+
+
+class TestChunkBitmap(object):
+    def test_set_and_has(self):
+        b = ChunkBitmap(10)
+        assert b.set(9)
+        assert not b.set(9)
+        assert b.has(9)
+        assert not b.has(0)
+        assert b.count() == 1
+
+    def test_missing(self):
+        b = ChunkBitmap(10)
+        for i in [0, 1, 2, 3, 4, 5, 6, 7, 9]:
+            b.set(i)
+        assert list(b.missing()) == [8]
+        assert not b.complete()
+        b.set(8)
+        assert b.complete()
+
+    def test_bytes_roundtrip(self):
+        b = ChunkBitmap(12)
+        b.set(3)
+        b.set(11)
+        actual = ChunkBitmap.from_bytes(12, b.to_bytes())
+        assert actual.count() == 2
+        assert list(actual.missing()) == list(b.missing())
+
+
+class TestChunkReassembler(object):
+    def test_out_of_order_writes(self, path):
+        r = ChunkReassembler(path, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+        assert os.path.getsize(r.temp_path) == len(TEST_DATA)
+
+        for i in [2, 0, 1]:
+            assert r.write(i, TEST_CHUNKS[i])
+            assert not os.path.exists(path)
+        assert not r.write(1, TEST_CHUNKS[1])
+
+        assert r.complete()
+        r.commit()
+        assert not os.path.exists(r.temp_path)
+        with open(path, 'rb') as f:
+            assert f.read() == TEST_DATA
+
+    def test_wrong_length_chunks_rejected(self, path):
+        r = ChunkReassembler(path, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+        assert not r.write(0, b'01234567')
+        assert not r.write(1, b'45')
+        assert not r.write(2, b'89ab')
+        assert r.bitmap.count() == 0
+
+        for i in [0, 1, 2]:
+            assert r.write(i, TEST_CHUNKS[i])
+        r.commit()
+        with open(path, 'rb') as f:
+            assert f.read() == TEST_DATA
+
+    def test_abort_removes_temp_file(self, path):
+        r = ChunkReassembler(path, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+        r.write(0, TEST_CHUNKS[0])
+        r.abort()
+        assert not os.path.exists(r.temp_path)
+        assert not os.path.exists(path)
+
+
+class TestReassemblyManager(object):
+    def test_complete_transfer(self, path):
+        m = ReassemblyManager()
+        assert m.start(TEST_SESSION, path, 1, len(TEST_DATA), 3,
+                       TEST_CHUNK_SIZE) is None
+        assert m.receive(TEST_SESSION, path, 1, 1, TEST_CHUNKS[1]) is None
+        assert m.receive(TEST_SESSION, path, 1, 2, TEST_CHUNKS[2]) is None
+        assert m.receive(TEST_SESSION, path, 1, 0, TEST_CHUNKS[0]) == path
+        with open(path, 'rb') as f:
+            assert f.read() == TEST_DATA
+
+    def test_chunks_before_start_are_buffered(self, path):
+        m = ReassemblyManager()
+        for i in range(3):
+            m.receive(TEST_SESSION, path, 1, i, TEST_CHUNKS[i])
+        assert m.buffered_bytes() == len(TEST_DATA)
+
+        done = m.start(TEST_SESSION, path, 1, len(TEST_DATA), 3,
+                       TEST_CHUNK_SIZE)
+        assert done == path
+        assert m.buffered_bytes() == 0
+
+    def test_buffer_cap_drops_chunks(self, path):
+        m = ReassemblyManager(max_buffered=TEST_CHUNK_SIZE)
+        m.receive(TEST_SESSION, path, 1, 0, TEST_CHUNKS[0])
+        m.receive(TEST_SESSION, path, 1, 1, TEST_CHUNKS[1])
+        assert m.buffered_bytes() == TEST_CHUNK_SIZE
+
+    def test_newer_version_supersedes(self, path):
+        m = ReassemblyManager()
+        m.start(TEST_SESSION, path, 1, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+        m.receive(TEST_SESSION, path, 1, 0, b'xxxx')
+        m.start(TEST_SESSION, path, 2, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+
+        # Chunks of the old version are ignored
+        m.receive(TEST_SESSION, path, 1, 1, b'xxxx')
+        for i in range(3):
+            m.receive(TEST_SESSION, path, 2, i, TEST_CHUNKS[i])
+        with open(path, 'rb') as f:
+            assert f.read() == TEST_DATA
+        assert os.listdir(os.path.dirname(path)) == ['file.bin']
+
+
+class TestTransferStore(object):
+    def test_resume_after_suspend(self, tmpdir, path):
+        store = TransferStore(str(tmpdir.join('state')))
+        m = ReassemblyManager(store=store)
+        m.start(TEST_SESSION, path, 1, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+        m.receive(TEST_SESSION, path, 1, 2, TEST_CHUNKS[2])
+        m.suspend_all()
+
+        # A new manager (as after a restart) picks up where the old left off
+        m = ReassemblyManager(store=store)
+        m.start('new session', path, 1, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+        received = m.received('new session', path, 1, 3)
+        assert list(received.missing()) == [0, 1]
+
+        m.receive('new session', path, 1, 0, TEST_CHUNKS[0])
+        assert m.receive('new session', path, 1, 1, TEST_CHUNKS[1]) == path
+        with open(path, 'rb') as f:
+            assert f.read() == TEST_DATA
+        assert store.load(path) is None
+
+    def test_state_of_other_version_discarded(self, tmpdir, path):
+        store = TransferStore(str(tmpdir.join('state')))
+        m = ReassemblyManager(store=store)
+        m.start(TEST_SESSION, path, 1, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+        m.receive(TEST_SESSION, path, 1, 2, TEST_CHUNKS[2])
+        m.suspend_all()
+        old_temp_path = store.load(path)['temp_path']
+
+        m = ReassemblyManager(store=store)
+        m.start(TEST_SESSION, path, 2, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+        assert m.received(TEST_SESSION, path, 2, 3).count() == 0
+        assert not os.path.exists(old_temp_path)
+
+    def test_state_saved_periodically(self, tmpdir, path):
+        store = TransferStore(str(tmpdir.join('state')))
+        m = ReassemblyManager(store=store, save_interval=2)
+        m.start(TEST_SESSION, path, 1, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+        m.receive(TEST_SESSION, path, 1, 0, TEST_CHUNKS[0])
+        assert store.load(path) is None
+        m.receive(TEST_SESSION, path, 1, 1, TEST_CHUNKS[1])
+        assert store.load(path)['version'] == 1
+
+    def test_received_after_complete(self, path):
+        m = ReassemblyManager()
+        m.start(TEST_SESSION, path, 1, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+        for i in range(3):
+            m.receive(TEST_SESSION, path, 1, i, TEST_CHUNKS[i])
+        assert m.received(TEST_SESSION, path, 1, 3).complete()
+
+    def test_collect_stale(self, tmpdir, path):
+        store = TransferStore(str(tmpdir.join('state')))
+        m = ReassemblyManager(store=store)
+        m.start(TEST_SESSION, path, 1, len(TEST_DATA), 3, TEST_CHUNK_SIZE)
+        m.suspend_all()
+        temp_path = store.load(path)['temp_path']
+
+        assert store.collect(max_age=60) == 0
+        assert store.collect(max_age=60, now=time.time() + 120) == 1
+        assert store.load(path) is None
+        assert not os.path.exists(temp_path)
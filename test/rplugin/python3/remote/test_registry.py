@@ -3,16 +3,36 @@
 # AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.cop>
 # License: Apache 2.0 License
 # =============================================================================
+import asyncio
+import pytest
+from remote.constants import (
+    PACKET_TYPE_ASK_TREE,
+    PACKET_TYPE_TELL_HEARTBEAT,
+    PACKET_TYPE_UPDATE_ARCHIVE_DATA,
+    PACKET_TYPE_UPDATE_FILE_DATA,
+)
 from remote.packet import (
     Content,
     Header,
     Packet,
 )
 from remote.registry import (
+    PRIORITY_BULK,
+    PRIORITY_CONTROL,
+    PRIORITY_INTERACTIVE,
     ActionRegistry,
 )
 
-TEST_TYPE = 'some type'
+TEST_TYPE = PACKET_TYPE_UPDATE_FILE_DATA
+TEST_OTHER_TYPE = PACKET_TYPE_TELL_HEARTBEAT
+
+
+def packet_of(packet_type, data=None):
+    return (Packet()
+            .set_header(Header()
+                        .set_type(packet_type))
+            .set_content(Content()
+                         .set_data(data)))
 
 
 class TestActionRegistry(object):
@@ -24,6 +44,7 @@ class TestActionRegistry(object):
         ar.register(TEST_TYPE, my_action)
 
         assert ar.lookup(TEST_TYPE) == my_action
+        assert ar.lookup(TEST_OTHER_TYPE) is None
 
     def test_process(self):
         def my_action(p):
@@ -42,3 +63,148 @@ class TestActionRegistry(object):
 
         assert ar.process(p) == 999
         assert p.get_content().get_data() == 1000
+
+    @pytest.mark.asyncio
+    async def test_process_coroutine_action(self, event_loop):
+        async def my_action(p):
+            return p.get_content().get_data()
+
+        ar = ActionRegistry(loop=event_loop)
+        ar.register(TEST_TYPE, my_action)
+
+        assert await ar.process(packet_of(TEST_TYPE, 999)) == 999
+
+    def test_middleware_wraps_actions(self):
+        calls = []
+
+        def middleware(name):
+            def wrap(dispatch, action, packet):
+                calls.append(name)
+                return dispatch(action, packet) + 1
+            return wrap
+
+        ar = ActionRegistry()
+        ar.register(TEST_TYPE, lambda p: calls.append('action') or 0)
+        ar.use(middleware('outer'))
+        ar.use(middleware('inner'))
+
+        assert ar.process(packet_of(TEST_TYPE)) == 2
+        assert calls == ['outer', 'inner', 'action']
+
+
+class TestActionRegistryQueues(object):
+    @pytest.mark.asyncio
+    async def test_control_ahead_of_queued(self, event_loop):
+        processed = []
+
+        ar = ActionRegistry(loop=event_loop)
+        ar.register(TEST_TYPE, lambda p: processed.append('bulk'),
+                    priority=PRIORITY_BULK, workers=1)
+        ar.register(TEST_OTHER_TYPE, lambda p: processed.append('control'))
+
+        assert ar.process(packet_of(TEST_TYPE)) is None
+        ar.process(packet_of(TEST_OTHER_TYPE))
+        assert ar.queued(TEST_TYPE) == 1
+
+        await ar.join()
+        assert processed == ['control', 'bulk']
+        assert ar.queued(TEST_TYPE) == 0
+
+    @pytest.mark.asyncio
+    async def test_priority_then_arrival_order(self, event_loop):
+        processed = []
+
+        ar = ActionRegistry(loop=event_loop)
+        bulk = PACKET_TYPE_UPDATE_FILE_DATA
+        bulk2 = PACKET_TYPE_UPDATE_ARCHIVE_DATA
+        interactive = PACKET_TYPE_ASK_TREE
+        control = PACKET_TYPE_TELL_HEARTBEAT
+        for packet_type, priority in [(bulk, PRIORITY_BULK),
+                                      (bulk2, PRIORITY_BULK),
+                                      (interactive, PRIORITY_INTERACTIVE),
+                                      (control, PRIORITY_CONTROL)]:
+            ar.register(packet_type,
+                        lambda p: processed.append(
+                            p.get_content().get_data()),
+                        priority=priority, workers=1)
+
+        for packet_type, data in [(bulk, 1), (bulk2, 2), (bulk, 3),
+                                  (interactive, 4), (control, 5)]:
+            ar.process(packet_of(packet_type, data))
+        await ar.join()
+
+        assert processed == [5, 4, 1, 2, 3]
+
+    @pytest.mark.asyncio
+    async def test_workers_limit_coroutines(self, event_loop):
+        running = []
+        peak = []
+        release = asyncio.Event()
+
+        async def my_action(p):
+            running.append(p)
+            peak.append(len(running))
+            await release.wait()
+            running.remove(p)
+
+        ar = ActionRegistry(loop=event_loop)
+        ar.register(TEST_TYPE, my_action, workers=2)
+        for i in range(5):
+            ar.process(packet_of(TEST_TYPE, i))
+
+        await asyncio.sleep(0.01)
+        assert ar.active(TEST_TYPE) == 2
+        assert ar.queued(TEST_TYPE) == 3
+
+        release.set()
+        await asyncio.wait_for(ar.join(), 1)
+        assert max(peak) == 2
+        assert ar.active(TEST_TYPE) == 0
+
+    @pytest.mark.asyncio
+    async def test_overflow_drops(self, event_loop):
+        processed = []
+
+        ar = ActionRegistry(loop=event_loop)
+        ar.register(TEST_TYPE, processed.append, workers=1, max_queued=2)
+        for i in range(5):
+            ar.process(packet_of(TEST_TYPE, i))
+        await ar.join()
+
+        assert len(processed) == 2
+        assert ar.dropped(TEST_TYPE) == 3
+
+    @pytest.mark.asyncio
+    async def test_full_queue_leaves_other_types(self, event_loop):
+        processed = []
+
+        ar = ActionRegistry(loop=event_loop, batch=1)
+        ar.register(TEST_TYPE, processed.append, priority=PRIORITY_BULK,
+                    workers=1, max_queued=2)
+        ar.register(TEST_OTHER_TYPE, processed.append)
+        for i in range(4):
+            ar.process(packet_of(TEST_TYPE, i))
+        ar.process(packet_of(TEST_OTHER_TYPE, 4))
+        await ar.join()
+
+        assert len(processed) == 3
+        assert processed[0].get_header().get_type() == TEST_OTHER_TYPE
+        assert ar.dropped(TEST_TYPE) == 2
+
+    @pytest.mark.asyncio
+    async def test_failed_action_frees_worker(self, event_loop):
+        processed = []
+
+        def my_action(p):
+            if (p.get_content().get_data() == 0):
+                raise ValueError('bad packet')
+            processed.append(p)
+
+        ar = ActionRegistry(loop=event_loop)
+        ar.register(TEST_TYPE, my_action, workers=1)
+        ar.process(packet_of(TEST_TYPE, 0))
+        ar.process(packet_of(TEST_TYPE, 1))
+        await ar.join()
+
+        assert len(processed) == 1
+        assert ar.active(TEST_TYPE) == 0
@@ -0,0 +1,87 @@
+# =============================================================================
+# FILE: test_scheduler.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import pytest
+import asyncio
+from remote.scheduler import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_CURRENT,
+    PRIORITY_VISIBLE,
+    TransferScheduler,
+)
+
+TEST_CHUNK = 10
+
+
+def sends(name, count, log):
+    for i in range(count):
+        log.append(name)
+        yield TEST_CHUNK
+
+
+class TestTransferScheduler(object):
+    @pytest.mark.asyncio
+    async def test_transfer_completes(self, event_loop):
+        log = []
+        s = TransferScheduler(event_loop)
+        sent = await s.submit('a', sends('a', 3, log))
+
+        assert sent == 3 * TEST_CHUNK
+        assert log == ['a', 'a', 'a']
+        assert s.pending() == []
+
+    @pytest.mark.asyncio
+    async def test_fair_within_class(self, event_loop):
+        log = []
+        s = TransferScheduler(event_loop)
+        fa = s.submit('a', sends('a', 3, log), PRIORITY_VISIBLE)
+        fb = s.submit('b', sends('b', 3, log), PRIORITY_VISIBLE)
+        await asyncio.gather(fa, fb)
+
+        assert log == ['a', 'b', 'a', 'b', 'a', 'b']
+
+    @pytest.mark.asyncio
+    async def test_higher_class_goes_first(self, event_loop):
+        log = []
+        s = TransferScheduler(event_loop)
+        fa = s.submit('bulk', sends('bulk', 3, log), PRIORITY_BACKGROUND)
+        fb = s.submit('cur', sends('cur', 3, log), PRIORITY_CURRENT)
+        await asyncio.gather(fa, fb)
+
+        assert log == ['cur', 'cur', 'cur', 'bulk', 'bulk', 'bulk']
+
+    @pytest.mark.asyncio
+    async def test_higher_class_preempts_when_full(self, event_loop):
+        log = []
+        s = TransferScheduler(event_loop, max_concurrent=1)
+        fa = s.submit('bulk', sends('bulk', 3, log), PRIORITY_BACKGROUND)
+        assert s.active() == ['bulk']
+
+        fb = s.submit('cur', sends('cur', 2, log), PRIORITY_CURRENT)
+        assert s.active() == ['cur']
+
+        await asyncio.gather(fa, fb)
+        assert log == ['cur', 'cur', 'bulk', 'bulk', 'bulk']
+
+    @pytest.mark.asyncio
+    async def test_submit_supersedes_same_key(self, event_loop):
+        log = []
+        s = TransferScheduler(event_loop)
+        old = s.submit('a', sends('old', 3, log))
+        new = s.submit('a', sends('new', 1, log))
+        await new
+
+        assert old.cancelled()
+        assert log == ['new']
+
+    @pytest.mark.asyncio
+    async def test_failed_transfer_sets_exception(self, event_loop):
+        def failing():
+            yield TEST_CHUNK
+            raise ValueError('Test Failure')
+
+        s = TransferScheduler(event_loop)
+        with pytest.raises(ValueError):
+            await s.submit('a', failing())
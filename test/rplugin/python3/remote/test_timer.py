@@ -5,8 +5,15 @@
 # =============================================================================
 import pytest
 import asyncio
+import time
 from unittest.mock import Mock
-from remote.timer import Timer
+from remote.timer import (
+    OVERLAP_QUEUE,
+    POLICY_FIXED_RATE_BURST,
+    POLICY_FIXED_RATE_SKIP,
+    Timer,
+    TimingWheel,
+)
 
 TEST_INTVL = 0.001
 TEST_ARGS = [1, 2, 3]
@@ -129,3 +136,266 @@ class TestTimer(object):
 
     def test_count_default(self, timer):
         assert timer.count() == 0
+
+    def test_unknown_policy(self, event_loop):
+        with pytest.raises(AssertionError):
+            Timer(event_loop, TEST_INTVL, policy='unknown')
+
+
+def stalled_once(event_loop, stall):
+    times = []
+
+    def handler():
+        times.append(event_loop.time())
+        if (len(times) == 1):
+            time.sleep(stall)
+    return times, handler
+
+
+class TestTimerPolicy(object):
+    @pytest.mark.asyncio
+    async def test_fixed_rate_keeps_schedule(self, event_loop):
+        interval = 0.02
+        times = []
+        timer = Timer(event_loop, interval, policy=POLICY_FIXED_RATE_SKIP)
+        timer.set_handler(lambda: times.append(event_loop.time()))
+        timer.set_limit(10).start()
+
+        await asyncio.sleep(interval * 15)
+        assert len(times) == 10
+
+        # Lateness of one run does not push back the runs after it
+        assert abs(times[-1] - times[0] - 9 * interval) < interval / 2
+
+    @pytest.mark.asyncio
+    async def test_fixed_rate_skip_drops_missed_runs(self, event_loop):
+        interval = 0.01
+        times, handler = stalled_once(event_loop, interval * 3.5)
+        timer = Timer(event_loop, interval, policy=POLICY_FIXED_RATE_SKIP)
+        timer.set_handler(handler).start()
+
+        await asyncio.sleep(interval * 8)
+        timer.stop()
+        assert timer.skipped() == 3
+        assert times[1] - times[0] >= interval * 4 - 1e-3
+
+    @pytest.mark.asyncio
+    async def test_fixed_rate_burst_makes_up_runs(self, event_loop):
+        interval = 0.01
+        times, handler = stalled_once(event_loop, interval * 3.5)
+        timer = Timer(event_loop, interval, policy=POLICY_FIXED_RATE_BURST)
+        timer.set_handler(handler).start()
+
+        await asyncio.sleep(interval * 8)
+        timer.stop()
+        assert timer.skipped() == 0
+        assert times[3] - times[1] < interval
+
+    @pytest.mark.asyncio
+    async def test_lateness_recorded(self, event_loop):
+        interval = 0.01
+        times, handler = stalled_once(event_loop, interval * 2)
+        timer = Timer(event_loop, interval, policy=POLICY_FIXED_RATE_BURST)
+        timer.set_handler(handler).set_limit(3).start()
+
+        await asyncio.sleep(interval * 6)
+        lateness = timer.lateness()
+        assert lateness.max >= interval
+        assert 0 < lateness.mean <= lateness.max
+
+
+class TestTimingWheel(object):
+    @pytest.mark.asyncio
+    async def test_callbacks_run_in_order(self, event_loop):
+        wheel = TimingWheel(event_loop, tick=TEST_INTVL)
+        calls = []
+        for delay in [0.01, 0.005, 0.02]:
+            wheel.call_later(delay, calls.append, delay)
+        assert wheel.count() == 3
+
+        await asyncio.sleep(0.05)
+        assert calls == [0.005, 0.01, 0.02]
+        assert wheel.count() == 0
+
+    @pytest.mark.asyncio
+    async def test_never_runs_early(self, event_loop):
+        wheel = TimingWheel(event_loop, tick=TEST_INTVL)
+        when = event_loop.time() + 0.01
+        times = []
+        wheel.call_at(when, lambda: times.append(event_loop.time()))
+
+        await asyncio.sleep(0.03)
+        assert times and times[0] >= when - 1e-6
+
+    @pytest.mark.asyncio
+    async def test_cancel(self, event_loop):
+        wheel = TimingWheel(event_loop, tick=TEST_INTVL)
+        f = Mock(return_value=None)
+        handle = wheel.call_later(0.005, f)
+        handle.cancel()
+
+        assert handle.cancelled()
+        assert wheel.count() == 0
+        await asyncio.sleep(0.02)
+        f.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_cascades_through_levels(self, event_loop):
+        # Two levels of four slots cover sixteen ticks, so later callbacks
+        # are held aside and cascade down as the wheel turns
+        wheel = TimingWheel(event_loop, tick=TEST_INTVL, slots=4, levels=2)
+        calls = []
+        delays = [0.002, 0.007, 0.013, 0.021, 0.040]
+        for delay in reversed(delays):
+            wheel.call_later(delay, calls.append, delay)
+
+        await asyncio.sleep(0.07)
+        assert calls == delays
+
+    @pytest.mark.asyncio
+    async def test_single_loop_callback(self, event_loop):
+        wheel = TimingWheel(event_loop, tick=TEST_INTVL)
+        f = Mock(return_value=None)
+        handles = [wheel.call_later(0.01 + i * 1e-5, f) for i in range(1000)]
+
+        assert wheel._handle is not None
+        for handle in handles[::2]:
+            handle.cancel()
+        await asyncio.sleep(0.03)
+        assert f.call_count == 500
+
+    @pytest.mark.asyncio
+    async def test_timer_on_wheel(self, event_loop):
+        wheel = TimingWheel(event_loop, tick=TEST_INTVL)
+        f = Mock(return_value=None)
+        timer = Timer(event_loop, TEST_INTVL, wheel=wheel).set_handler(
+            f, *TEST_ARGS, **TEST_KWARGS).set_limit(3).start()
+
+        await asyncio.sleep(TEST_INTVL * 20)
+        assert not timer.running()
+        assert f.call_count == 3
+        f.assert_called_with(*TEST_ARGS, **TEST_KWARGS)
+        assert wheel.count() == 0
+
+    @pytest.mark.asyncio
+    async def test_timer_stop_cancels_pending(self, event_loop):
+        wheel = TimingWheel(event_loop, tick=TEST_INTVL)
+        f = Mock(return_value=None)
+        Timer(event_loop, 1, wheel=wheel).set_handler(f).start().stop()
+
+        assert wheel.count() == 0
+        await asyncio.sleep(TEST_INTVL * 5)
+        f.assert_not_called()
+
+
+class TestAsyncTimer(object):
+    @pytest.mark.asyncio
+    async def test_coroutine_handler(self, event_loop):
+        calls = []
+
+        async def handler(*args, **kwargs):
+            calls.append((args, kwargs))
+            await asyncio.sleep(0)
+
+        timer = Timer(event_loop, TEST_INTVL).set_handler(
+            handler, *TEST_ARGS, **TEST_KWARGS).set_limit(3).start()
+        await asyncio.sleep(TEST_INTVL * 20)
+
+        assert calls == [(tuple(TEST_ARGS), TEST_KWARGS)] * 3
+        assert timer.durations().max > 0
+        assert timer.active() == 0
+
+    @pytest.mark.asyncio
+    async def test_overlapping_runs_skipped(self, event_loop):
+        started = []
+
+        async def handler():
+            started.append(event_loop.time())
+            await asyncio.sleep(TEST_INTVL * 10)
+
+        timer = Timer(event_loop, TEST_INTVL).set_handler(handler).start()
+        await asyncio.sleep(TEST_INTVL * 5)
+
+        assert len(started) == 1
+        assert timer.active() == 1
+        assert timer.skipped() > 0
+        timer.stop()
+
+    @pytest.mark.asyncio
+    async def test_concurrent_runs_allowed(self, event_loop):
+        async def handler():
+            await asyncio.sleep(1)
+
+        timer = Timer(event_loop, TEST_INTVL, max_overlap=3).set_handler(
+            handler).start()
+        await asyncio.sleep(TEST_INTVL * 10)
+
+        assert timer.active() == 3
+        timer.stop()
+
+    @pytest.mark.asyncio
+    async def test_overlapping_runs_queued(self, event_loop):
+        release = asyncio.Event()
+        started = []
+
+        async def handler():
+            started.append(len(started))
+            if (len(started) == 1):
+                await release.wait()
+
+        timer = Timer(event_loop, TEST_INTVL, overlap=OVERLAP_QUEUE)
+        timer.set_handler(handler).set_limit(5).start()
+        await asyncio.sleep(TEST_INTVL * 10)
+        assert started == [0]
+
+        # Only as many runs are held as may go at once
+        assert timer.queued() == 1
+        assert timer.skipped() > 0
+
+        release.set()
+        await asyncio.sleep(TEST_INTVL * 10)
+        assert timer.count() == 5
+
+    @pytest.mark.asyncio
+    async def test_stop_cancels_runs(self, event_loop):
+        cancelled = []
+
+        async def handler():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        timer = Timer(event_loop, TEST_INTVL).set_handler(handler).start()
+        await asyncio.sleep(TEST_INTVL * 2)
+        timer.stop()
+        await asyncio.sleep(TEST_INTVL)
+
+        assert cancelled == [True]
+        assert timer.active() == 0
+
+    @pytest.mark.asyncio
+    async def test_async_exceptions_recorded(self, event_loop):
+        async def handler():
+            raise Exception('Test Failure')
+
+        timer = Timer(event_loop, TEST_INTVL).set_handler(handler).start()
+        await asyncio.sleep(TEST_INTVL * 3)
+        timer.stop()
+        assert len(timer.exceptions()) > 0
+
+    @pytest.mark.asyncio
+    async def test_limit_lets_last_run_finish(self, event_loop):
+        finished = []
+
+        async def handler():
+            await asyncio.sleep(TEST_INTVL * 2)
+            finished.append(True)
+
+        timer = Timer(event_loop, TEST_INTVL).set_handler(
+            handler).set_limit(1).start()
+        await asyncio.sleep(TEST_INTVL * 10)
+
+        assert not timer.running()
+        assert finished == [True]
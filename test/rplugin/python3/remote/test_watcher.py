@@ -0,0 +1,93 @@
+# =============================================================================
+# FILE: test_watcher.py
+# AUTHOR: Chip Senkbeil <chip.senkbeil at gmail.com>
+# License: Apache 2.0 License
+# =============================================================================
+import asyncio
+import os
+import pytest
+from remote.constants import (
+    MESSAGE_DEFAULT_FILE_LENGTH,
+    MESSAGE_DEFAULT_FILE_VERSION,
+)
+from remote.index import FileIndex
+from remote.watcher import (
+    ChangeBatcher,
+    FileWatcher,
+    describe_changes,
+    split_changes,
+)
+
+TEST_WINDOW = 0.01
+
+
+class TestChangeBatcher(object):
+    @pytest.mark.asyncio
+    async def test_changes_deduplicated_within_window(self, event_loop):
+        batches = []
+        b = ChangeBatcher(event_loop, batches.append, TEST_WINDOW)
+        b.add('a')
+        b.add('b')
+        b.add('a', deleted=True)
+        await asyncio.sleep(TEST_WINDOW * 5)
+
+        assert batches == [[('a', True), ('b', False)]]
+        assert b.pending() == []
+
+    @pytest.mark.asyncio
+    async def test_ignored_paths_dropped(self, event_loop):
+        batches = []
+        b = ChangeBatcher(event_loop, batches.append, TEST_WINDOW,
+                          is_ignored=lambda path: path.endswith('.swp'))
+        b.add('a.swp')
+        assert b.pending() == []
+
+    @pytest.mark.asyncio
+    async def test_waits_for_previous_emit(self, event_loop):
+        batches = []
+        release = event_loop.create_future()
+
+        async def emit(changes):
+            batches.append(changes)
+            await release
+
+        b = ChangeBatcher(event_loop, emit, TEST_WINDOW)
+        b.add('a')
+        b.flush()
+        b.add('b')
+        await asyncio.sleep(TEST_WINDOW * 5)
+        assert batches == [[('a', False)]]
+
+        release.set_result(None)
+        await asyncio.sleep(TEST_WINDOW * 5)
+        assert batches == [[('a', False)], [('b', False)]]
+
+
+class TestFileWatcher(object):
+    def test_ignores_any_component(self, event_loop, tmpdir):
+        w = FileWatcher(event_loop, str(tmpdir), lambda changes: None)
+        assert w.is_ignored(str(tmpdir.join('.git', 'HEAD')))
+        assert not w.is_ignored(str(tmpdir.join('src', 'main.py')))
+
+
+def test_describe_changes(tmpdir):
+    tmpdir.join('a.txt').write('hello')
+    index = FileIndex(None)
+    entries = describe_changes(index, str(tmpdir), [
+        (str(tmpdir.join('a.txt')), False),
+        (str(tmpdir.join('gone.txt')), True),
+    ])
+
+    assert entries[0] == ['a.txt', index.lookup(
+        str(tmpdir.join('a.txt'))).version, 5]
+    assert entries[1] == ['gone.txt', MESSAGE_DEFAULT_FILE_VERSION,
+                          MESSAGE_DEFAULT_FILE_LENGTH]
+
+
+def test_split_changes():
+    entries = [[os.path.join('dir', str(i)), 1, 10] for i in range(100)]
+    groups = list(split_changes(entries, max_bytes=300))
+
+    assert len(groups) > 1
+    assert [e for g in groups for e in g] == entries
+    assert list(split_changes([])) == []